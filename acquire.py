@@ -0,0 +1,302 @@
+"""Optional multi-process acquisition, enabled with acquisition mode process in wxstation.yaml.
+Each listed sensor's driver runs in its own worker process, so anemometer callbacks and hardware
+reads never wait on the GIL behind database retries or APRS-IS connections in the reporting process.
+Workers publish samples to a ring buffer in shared memory, which the reporting process reads in
+place, and a supervisor restarts workers that exit or stop sending heartbeats."""
+import logging, os, signal
+import multiprocessing as mp
+from math import isnan, nan
+from multiprocessing import shared_memory
+from threading import Thread, Event, Lock
+from time import time, monotonic, sleep
+from drivers import DRIVERS
+
+# Header slots at the start of each ring, all float64 like the samples
+COUNT = 0 # Samples written, the newest is sample COUNT - 1
+HEARTBEAT = 1 # monotonic() of the worker's last heartbeat, the clock is shared by every process
+OPENED = 2 # 1 once the worker's driver has opened its hardware
+ERRORS = 3 # Failed reads by the worker's driver
+STOP = 4 # Set by the reporting process to ask the worker to exit
+HEADER_SLOTS = 8
+RING_SIZE = 64 # Samples kept, so a slow reader is never racing the writer for the same slot
+HEARTBEAT_INTERVAL = 0.5 # Seconds between heartbeats, also how often workers publish new samples
+STARTUP_SECONDS = 30 # Time a new worker has to send its first heartbeat, starting Python is slow on a Pi Zero
+
+class SampleRing:
+    """Single writer ring of samples in shared memory. Each slot holds its sequence number, the sample
+    time and one float64 per field, with NaN for None. The writer marks a slot -1 while filling it and
+    readers check the slot's sequence number before and after reading, so a torn sample is never returned."""
+    def __init__(self, fields, size=RING_SIZE, name=None):
+        self.fields = fields
+        self.width = len(fields) + 2
+        self.size = size
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=(HEADER_SLOTS + size * self.width) * 8 if create else 0)
+        self.name = self.shm.name
+        self.view = self.shm.buf.cast('d')
+        self.header = self.view[:HEADER_SLOTS]
+        self.slots = self.view[HEADER_SLOTS:HEADER_SLOTS + size * self.width] # New shared memory is zero filled
+
+    def append(self, when, values):
+        n = int(self.header[COUNT])
+        base = (n % self.size) * self.width
+        slots = self.slots
+        slots[base] = -1.0
+        slots[base + 1] = when
+        for i, key in enumerate(self.fields):
+            value = values.get(key)
+            slots[base + 2 + i] = nan if value is None else value
+        slots[base] = n
+        self.header[COUNT] = n + 1
+
+    def latest(self):
+        """(sequence number, time, {field: value}) of the newest sample, read in place. None if nothing has been written."""
+        for attempt in range(3):
+            n = int(self.header[COUNT]) - 1
+            if n < 0:
+                return None
+            base = (n % self.size) * self.width
+            slots = self.slots
+            if slots[base] != n:
+                continue # Being rewritten, the writer has lapped the ring since COUNT was read
+            when = slots[base + 1]
+            values = {key: slots[base + 2 + i] for i, key in enumerate(self.fields)}
+            if slots[base] == n:
+                return n, when, {key: None if isnan(value) else value for key, value in values.items()}
+        return None
+
+    def close(self):
+        # Views have to be released before the mapping can be closed
+        self.header.release()
+        self.slots.release()
+        self.view.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+def driver_healthy(driver, started):
+    """True while the driver's thread is sampling on schedule and its readings are fresh. A read blocked
+    on I2C or serial stops the heartbeats, so the supervisor kills and restarts the worker."""
+    if not driver.thread.is_alive() or driver.alive_until is None or monotonic() > driver.alive_until:
+        return False
+    return time() - (driver.updated or started) <= driver.max_age
+
+def worker_main(key, config, options, ring_name, parent_pid):
+    """Runs in the worker process: drive the sensor and publish its samples until asked to stop"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C reaches every process, the reporting process stops the workers
+    logging.basicConfig(level=config.get('loglevel', 'INFO'), format=f"%(levelname)s:{key} worker:%(message)s")
+    driver_class = DRIVERS[key]
+    ring = SampleRing(driver_class.shared_fields, name=ring_name)
+    if config.get('simulate'):
+        from simulate import Simulator
+        simulator = Simulator.from_config(config)
+        simulator.start(wind=key == 'wspeed', rain=False)
+        hardware = simulator.hardware().get(key)
+        if hardware:
+            options['hardware'] = hardware
+    journal = None
+    journal_config = config.get('journal') or {}
+    if journal_config.get('enabled', False):
+        from journal import Journal
+        journal = Journal.from_config(journal_config, name=key) # Segments of its own, read_journal merges every writer's
+        journal.start()
+        options['journal'] = journal
+    driver = driver_class(config, **options)
+    driver.start()
+    started = time()
+    updated = None
+    header = ring.header
+    while header[STOP] == 0 and os.getppid() == parent_pid: # Exit if the reporting process died
+        if driver_healthy(driver, started):
+            header[HEARTBEAT] = monotonic()
+        header[ERRORS] = driver.errors
+        header[OPENED] = driver.opened
+        if driver.updated != updated:
+            updated = driver.updated
+            ring.append(updated, driver.shared_values())
+        sleep(HEARTBEAT_INTERVAL)
+    driver.stop()
+    driver.thread.join(5) # The driver closes its hardware as its thread finishes
+    if journal is not None:
+        journal.stop()
+    ring.close()
+
+class ProcessDriver:
+    """Stands in for a SensorDriver running in a worker process, with the same read and report interface.
+    Readings come from the worker's shared memory ring, the worker is restarted with backoff if it dies."""
+    def __init__(self, key, config, options, heartbeat_timeout=10):
+        self.key = key
+        self.driver_class = DRIVERS[key]
+        self.name = self.driver_class.name
+        self.config = dict(config) # A copy, the running config is updated in place when it's reloaded
+        self.options = options
+        self.new_options = options # Set by reconfigure, applied by apply_config
+        self.heartbeat_timeout = heartbeat_timeout # Seconds without a heartbeat before the worker is killed and restarted
+        # Never started, it only holds the driver's intervals and staleness rules
+        self.template = self.driver_class(config, **options)
+        self.ring = SampleRing(self.driver_class.shared_fields)
+        self.monitor = None # The monitor lives in the worker
+        self.process = None
+        self.values = {}
+        self.updated = None
+        self.lock = Lock()
+        self.control = Lock() # Held while the worker is checked, restarted or stopped
+        self.reported = None # Published values at the last report
+        self.first_seq = 0 # Samples before this are from a previous worker
+        self.restarts = 0
+        self.past_errors = 0 # Errors counted by previous workers
+        self.backoff = self.template.retry
+        self.restart_at = None
+        self.spawned = None
+        self.stopping = False
+
+    @property
+    def thread(self):
+        return self.process # is_alive() like the driver's thread
+
+    @property
+    def opened(self):
+        return bool(self.ring.header[OPENED])
+
+    @property
+    def errors(self):
+        return self.past_errors + int(self.ring.header[ERRORS])
+
+    def spawn(self):
+        header = self.ring.header
+        self.past_errors += int(header[ERRORS])
+        header[ERRORS] = header[OPENED] = header[STOP] = header[HEARTBEAT] = 0
+        self.first_seq = int(header[COUNT])
+        self.reported = None
+        options = {key: value for key, value in self.options.items() if key != 'hardware'}
+        self.process = mp.get_context('spawn').Process(target=worker_main, args=(self.key, self.config, options, self.ring.name, os.getpid()),
+            daemon=True, name=f"{self.name}_worker")
+        self.process.start()
+        self.spawned = monotonic()
+        self.restart_at = None
+        logging.info(f"Started {self.name} worker process {self.process.pid}")
+
+    def start(self):
+        logging.info(f"Starting {self.name} driver in a worker process.")
+        self.spawn()
+        SUPERVISOR.add(self)
+
+    def check(self):
+        """Called by the supervisor, restarts the worker if it exited or stopped sending heartbeats"""
+        with self.control:
+            if not self.stopping:
+                self.check_worker()
+
+    def check_worker(self):
+        now = monotonic()
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.restarts += 1
+                self.spawn()
+            return
+        beat = self.ring.header[HEARTBEAT]
+        if self.process.is_alive():
+            if now - max(beat, self.spawned + STARTUP_SECONDS) <= self.heartbeat_timeout:
+                if now - self.spawned > self.template.max_retry:
+                    self.backoff = self.template.retry # Ran long enough to start backing off from the beginning again
+                return
+            logging.error(f"{self.name} worker process {self.process.pid} stopped sending heartbeats, killing it")
+            self.process.kill()
+            self.process.join(5)
+        else:
+            logging.error(f"{self.name} worker process {self.process.pid} exited with code {self.process.exitcode}")
+        logging.error(f"Restarting {self.name} worker in {self.backoff} seconds. Total restarts: {self.restarts}")
+        self.restart_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, self.template.max_retry)
+
+    def poll(self, advance=False):
+        sample = self.ring.latest()
+        if sample is None or sample[0] < self.first_seq:
+            return
+        seq, when, shared = sample
+        values = self.driver_class.combine(shared, self.reported)
+        if advance:
+            self.reported = shared
+        values = {key: value for key, value in values.items() if value is not None}
+        if values:
+            with self.lock:
+                self.values.update(values)
+                self.updated = when
+
+    def snapshot(self):
+        with self.lock:
+            values, updated = dict(self.values), self.updated
+        return {'values': values, 'updated': updated, 'stale': updated is None or time() - updated > self.template.max_age}
+
+    def read(self):
+        self.poll()
+        return self.snapshot()
+
+    def report(self):
+        self.poll(advance=True)
+        return self.snapshot()
+
+    def reconfigure(self, **options):
+        self.template.reconfigure(**options)
+        self.new_options = {key: value for key, value in options.items() if value is not None}
+
+    def apply_config(self, config):
+        """Restart the worker if its options or the config keys its driver reads changed"""
+        changed = self.new_options != self.options or any(config.get(key) != self.config.get(key) for key in self.driver_class.config_keys)
+        self.template.apply_config(config)
+        self.config = dict(config) # The worker has its own copy, so compare against the config it was started with
+        self.options = self.new_options
+        with self.control:
+            if changed and not self.stopping:
+                logging.info(f"{self.name} settings changed, restarting its worker process")
+                self.stop_worker()
+                self.spawn()
+
+    def stop_worker(self):
+        self.ring.header[STOP] = 1
+        self.process.join(10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(5)
+
+    def stop(self):
+        SUPERVISOR.remove(self)
+        with self.control:
+            self.stopping = True
+            self.stop_worker()
+        self.ring.close()
+        self.ring.unlink()
+
+class Supervisor:
+    """Checks every worker process once a second on a daemon thread"""
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.workers = []
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+
+    def add(self, driver):
+        with self.lock:
+            self.workers.append(driver)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True, name="Thread-Supervisor")
+                self.thread.start()
+
+    def remove(self, driver):
+        with self.lock:
+            if driver in self.workers:
+                self.workers.remove(driver)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                workers = list(self.workers)
+            for driver in workers:
+                try:
+                    driver.check()
+                except Exception as e:
+                    logging.exception(f"Unable to check {driver.name} worker process: {e}")
+
+SUPERVISOR = Supervisor()
@@ -1,11 +1,12 @@
-import aprslib, time
+import time
 from math import trunc
-from db import WeatherDatabase
-import logging
+import logging, metrics
 
 class SendAprs:
-    def __init__(self, db, loglevel="DEBUG"):
+    def __init__(self, db, loglevel="DEBUG", rain_window=None, uplink=None):
         self.db = db
+        self.rain_window = rain_window # RainWindow used for rain totals instead of querying the database
+        self.uplink = uplink # AprsUplink with open sessions to the APRS-IS servers, created on first send if not given
         logging.basicConfig(level=loglevel)
         
     # Convert temperature, wind direction, wind speed, and wind gusts to 3 digits
@@ -47,7 +48,26 @@ class SendAprs:
         else:
             return str(num)
 
-    def make_packet(self, data, config):
+    # e.g. " Dewpt 52F WC 38F Pres +1.2hPa/3h", only the values that are known and meaningful
+    def format_derived(self, data):
+        parts = []
+        if data.get('dew_point') is not None:
+            parts.append(f"Dewpt {round(data['dew_point'])}F")
+        temperature = data.get('temperature')
+        if data.get('heat_index') is not None and temperature is not None and temperature >= 80:
+            parts.append(f"HI {round(data['heat_index'])}F")
+        elif data.get('wind_chill') is not None and temperature is not None and data['wind_chill'] < temperature:
+            parts.append(f"WC {round(data['wind_chill'])}F")
+        if data.get('pressure_tendency') is not None:
+            parts.append(f"Pres {data['pressure_tendency']:+.1f}hPa/3h")
+        return "".join(f" {part}" for part in parts)
+
+    def make_packet(self, data, config, rain_totals=None):
+        """rain_totals overrides the rain window and database, used for readings pushed by other stations"""
+        with metrics.timer('wx_packet_build_seconds'):
+            return self._make_packet(data, config, rain_totals)
+
+    def _make_packet(self, data, config, rain_totals=None):
         tmp = data.copy() # Create copy so that original data dictionary is not modified
         tmp['pressure'] = trunc(round(tmp['pressure'], 2) * 10.) # shift decimal point to the left 1 and round
         tmp['temperature'] = self.add_zeros(round(tmp['temperature']))
@@ -56,7 +76,12 @@ class SendAprs:
         tmp['humidity'] = self.format_humidity(round(tmp['humidity']))
         tmp['ztime'] = time.strftime('%d%H%M', time.gmtime()) # Get zulu/UTC time
 
-        all_rain_avgs = self.db.get_all_rain_avg()
+        if rain_totals is not None:
+            all_rain_avgs = rain_totals
+        elif self.rain_window is not None:
+            all_rain_avgs = self.rain_window.totals()
+        else:
+            all_rain_avgs = self.db.get_all_rain_avg()
         tmp['rain1h'] = self.format_rain(all_rain_avgs['1'])
         tmp['rain24h'] = self.format_rain(all_rain_avgs['24'])
         tmp['rain00m'] = self.format_rain(all_rain_avgs['00'])
@@ -65,19 +90,17 @@ class SendAprs:
         tmp['wdir'] = self.add_zeros(tmp['wdir'])
 
         self.packet = f"{config['aprs']['callsign']}>APRS,TCPIP*:@{tmp['ztime']}z{config['aprs']['longitude']}/{config['aprs']['latitude']}_{tmp['wdir']}/{tmp['wspeed']}g{tmp['wgusts']}t{tmp['temperature']}r{tmp['rain1h']}p{tmp['rain24h']}P{tmp['rain00m']}b{tmp['pressure']}h{tmp['humidity']}{config['aprs']['comment']}"
+        if config['aprs'].get('derived_comment'):
+            self.packet += self.format_derived(data) # Computed by derived.py with the readings, no database queries
         del(tmp) # Clean up temporary dictionary
         return self.packet
             
     def send_data(self, data, config):
         packet = self.make_packet(data, config)
         if config['aprs']['sendall']:
-            for server in config['aprs']['servers']:
-                AIS = aprslib.IS(config['aprs']['callsign'], str(config['aprs']['passwd']), config['aprs']['servers'][server], config['aprs']['port'])
-                try:
-                    AIS.connect()
-                    AIS.sendall(packet)
-                    logging.info(f"Packet transmitted to {config['aprs']['servers'][server]} at {time.strftime('%Y-%m-%d %H:%M', time.gmtime())} UTC time")
-                except Exception as e:
-                    logging.exception(f"An exception occured trying to send packet to {server}\nException: {e}")
-                finally:
-                    AIS.close()
+            if self.uplink is None:
+                from uplink import AprsUplink
+                self.uplink = AprsUplink.from_config(config['aprs'])
+                self.uplink.start()
+            self.uplink.send(packet)
+            logging.debug(f"APRS-IS server statistics: {self.uplink.stats()}")
@@ -0,0 +1,290 @@
+"""Columnar archive of closed days of sensors rows.
+Each day is written as one typed NumPy array per column under path/station/day, and closed
+months are compacted into path/station/month. Queries memory map the arrays, so a year of
+readings is aggregated without loading it through MariaDB. Archived rows can be pruned from
+the sensors table once they are older than keep_days.
+    python3 archive.py [--config wxstation.yaml] [--prune]
+    python3 archive.py --aggregate 2024-01-01 2025-01-01 --width 1d --channels ambient_temperature,rainfall"""
+import argparse, json, logging, os, shutil
+from datetime import date, datetime, timedelta
+from threading import Thread, Event
+import numpy as np
+from db import SENSOR_COLUMNS, ROLLUP_CHANNELS
+
+CHANNELS = SENSOR_COLUMNS[2:] # Every column after stationid and created, stored as float32 with NaN for NULL
+WIDTH_SECONDS = {'1m': 60, '1h': 3600, '1d': 86400}
+NO_STATION = "_" # Directory for rows saved without a stationid
+
+def station_dir(station):
+    return (station or NO_STATION).replace('/', '_')
+
+def day_start(day):
+    return datetime.combine(day, datetime.min.time())
+
+def to_columns(rows):
+    """Sensors rows as tuples in SENSOR_COLUMNS order to {'created': int64 epoch seconds, channel: float32}"""
+    columns = {'created': np.array([row[1].timestamp() for row in rows], dtype=np.int64)}
+    for i, ch in enumerate(CHANNELS, start=2):
+        columns[ch] = np.array([np.nan if row[i] is None else float(row[i]) for row in rows], dtype=np.float32)
+    order = np.argsort(columns['created'], kind='stable')
+    return {name: values[order] for name, values in columns.items()}
+
+def concat(parts):
+    if not parts:
+        return {name: np.empty(0, dtype=np.int64 if name == 'created' else np.float32) for name in ('created',) + CHANNELS}
+    if len(parts) == 1:
+        return parts[0]
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(columns['created'], kind='stable') # Stations are interleaved in time
+    return {name: values[order] for name, values in columns.items()}
+
+def aggregate(columns, start, end, width='1h', channels=ROLLUP_CHANNELS):
+    """Per bucket count, min, max, sum and avg in the same shape as WeatherDatabase.aggregates.
+    columns must be sorted by created. Buckets are width seconds counted from start."""
+    width = WIDTH_SECONDS.get(width, width)
+    start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+    created = columns['created']
+    lo, hi = np.searchsorted(created, [start_ts, end_ts])
+    index = (created[lo:hi] - start_ts) // width
+    buckets = -(-(end_ts - start_ts) // width)
+    samples = np.bincount(index, minlength=buckets)
+    # Sorted, so each bucket is one contiguous run and reduceat handles min and max in one pass
+    occupied = np.flatnonzero(samples)
+    offsets = np.searchsorted(index, occupied)
+    results = [{'bucket': str(datetime.fromtimestamp(start_ts + int(b) * width)), 'samples': int(samples[b])} for b in occupied]
+    for ch in channels:
+        values = columns[ch][lo:hi]
+        valid = ~np.isnan(values)
+        counts = np.bincount(index[valid], minlength=buckets)[occupied]
+        sums = np.bincount(index[valid], weights=values[valid], minlength=buckets)[occupied]
+        if len(occupied):
+            # fmin and fmax skip NaN, a bucket with no valid values stays NaN
+            lows, highs = np.fmin.reduceat(values, offsets), np.fmax.reduceat(values, offsets)
+        else:
+            lows = highs = sums
+        for result, count, low, high, total in zip(results, counts, lows, highs, sums):
+            count = int(count)
+            result[ch] = {'count': count, 'min': round(float(low), 3) if count else None, 'max': round(float(high), 3) if count else None,
+                'sum': round(float(total), 3) if count else None, 'avg': round(float(total) / count, 3) if count else None}
+    return results
+
+class Archive:
+    def __init__(self, path="archive"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, "manifest.json")
+        try:
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = {'days': {}} # Day -> {'rows', 'pruned'}
+
+    def save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file, indent=1, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def archived_until(self):
+        """Day after the newest archived day, days before it are read from the archive"""
+        days = self.manifest['days']
+        return date.fromisoformat(max(days)) + timedelta(days=1) if days else None
+
+    def write_columns(self, directory, columns):
+        """Write every column into directory, replacing it only once all columns are complete"""
+        tmp_dir = f"{directory}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, values in columns.items():
+            with open(os.path.join(tmp_dir, f"{name}.npy"), 'wb') as file:
+                np.save(file, values)
+                file.flush()
+                os.fsync(file.fileno())
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp_dir, directory)
+
+    def write_day(self, day, rows):
+        """Archive one closed day of sensors rows, replacing that day if it was archived before"""
+        by_station = {}
+        for row in rows:
+            by_station.setdefault(station_dir(row[0]), []).append(row)
+        for station, station_rows in by_station.items():
+            self.write_columns(os.path.join(self.path, station, day.isoformat()), to_columns(station_rows))
+        self.manifest['days'][day.isoformat()] = {'rows': len(rows), 'pruned': False}
+        self.save_manifest()
+
+    def stations(self):
+        return sorted(entry for entry in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, entry)))
+
+    def segments(self, station):
+        """Month and day directories of a station in time order, days already compacted into their month are skipped"""
+        directory = os.path.join(self.path, station)
+        names = sorted(name for name in os.listdir(directory) if not name.endswith('.tmp'))
+        months = {name for name in names if len(name) == 7}
+        return [os.path.join(directory, name) for name in names if len(name) == 7 or name[:7] not in months]
+
+    def compact(self, month):
+        """Merge the day directories of a closed month into one month directory per station"""
+        for station in self.stations():
+            directory = os.path.join(self.path, station)
+            days = sorted(name for name in os.listdir(directory) if len(name) == 10 and name.startswith(month))
+            if not days:
+                continue
+            parts = [self.load(os.path.join(directory, day), mmap=False) for day in days]
+            if not os.path.exists(os.path.join(directory, month)):
+                self.write_columns(os.path.join(directory, month), concat(parts))
+            for day in days:
+                shutil.rmtree(os.path.join(directory, day))
+        logging.info(f"Compacted archive month {month}")
+
+    def load(self, directory, mmap=True):
+        return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+            for name in ('created',) + CHANNELS}
+
+    def columns(self, start, end, station=None):
+        """Memory mapped columns from start up to end, sorted by created"""
+        start_ts, end_ts = start.timestamp(), end.timestamp()
+        stations = [station_dir(station)] if station else self.stations()
+        parts = []
+        for name in stations:
+            if not os.path.isdir(os.path.join(self.path, name)):
+                continue
+            for segment in self.segments(name):
+                columns = self.load(segment)
+                created = columns['created']
+                if not len(created) or created[-1] < start_ts or created[0] >= end_ts:
+                    continue # Segment is outside of the range, none of it is read from disk
+                lo, hi = np.searchsorted(created, [start_ts, end_ts])
+                parts.append({key: values[lo:hi] for key, values in columns.items()})
+        return concat(parts)
+
+def combined_columns(archive, db, start, end, station=None):
+    """Columns from the archive for archived days and from the sensors table for the rest"""
+    until = archive.archived_until()
+    split = start if until is None else min(max(day_start(until), start), end)
+    parts = []
+    if split > start:
+        parts.append(archive.columns(start, split, station))
+    if end > split:
+        rows = list(db.stream_sensors(split, end, station))
+        if rows:
+            parts.append(to_columns(rows))
+    return concat(parts)
+
+def combined_aggregates(archive, db, start, end, width='1h', station=None, channels=ROLLUP_CHANNELS):
+    return aggregate(combined_columns(archive, db, start, end, station), start, end, width, channels)
+
+class Archiver:
+    """Archives closed days of the sensors table and prunes them once they are older than keep_days"""
+    def __init__(self, db, archive, prune=False, keep_days=30, interval=3600):
+        self.db = db
+        self.archive = archive
+        self.prune = prune
+        self.keep_days = keep_days
+        self.interval = interval # Seconds between checks for newly closed days
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, daemon=True, name="Thread-Archiver")
+
+    def archive_closed_days(self, today=None):
+        today = today or date.today()
+        until = self.archive.archived_until()
+        if until is None:
+            first = self.db.first_created()
+            if first is None:
+                return
+            until = first.date()
+        day = until
+        while day < today and not self.stop_event.is_set():
+            rows = list(self.db.stream_sensors(day_start(day), day_start(day + timedelta(days=1))))
+            self.archive.write_day(day, rows)
+            logging.info(f"Archived {len(rows)} sensors rows from {day}")
+            day += timedelta(days=1)
+
+    def prune_days(self, today=None):
+        cutoff = (today or date.today()) - timedelta(days=self.keep_days)
+        for name, entry in sorted(self.archive.manifest['days'].items()):
+            day = date.fromisoformat(name)
+            if entry['pruned'] or day >= cutoff or self.stop_event.is_set():
+                continue
+            start, end = day_start(day), day_start(day + timedelta(days=1))
+            count = self.db.count_sensors(start, end) # Only read the day's rows back if they changed
+            if count != entry['rows'] and name[:7] in self.archive.manifest.get('compacted', []):
+                logging.error(f"{day} has {count} sensors rows but {entry['rows']} were archived and its month is compacted, not pruning it")
+                continue
+            if count != entry['rows']:
+                # Rows arrived after the day was archived, such as replayed spool rows
+                logging.warning(f"{day} has {count} sensors rows but {entry['rows']} were archived, archiving it again")
+                self.archive.write_day(day, list(self.db.stream_sensors(start, end)))
+            deleted = self.db.delete_sensors(start, end)
+            self.archive.manifest['days'][name]['pruned'] = True
+            self.archive.save_manifest()
+            logging.info(f"Pruned {deleted} archived sensors rows from {day}")
+
+    def compact_months(self, today=None):
+        """Months that ended more than keep_days ago won't be archived again"""
+        cutoff = (today or date.today()) - timedelta(days=self.keep_days)
+        months = {name[:7] for name in self.archive.manifest['days']}
+        compacted = set(self.archive.manifest.get('compacted', []))
+        for month in sorted(months - compacted):
+            first = date.fromisoformat(f"{month}-01")
+            following = (first + timedelta(days=32)).replace(day=1)
+            if following > cutoff:
+                continue
+            self.archive.compact(month)
+            compacted.add(month)
+            self.archive.manifest['compacted'] = sorted(compacted)
+            self.archive.save_manifest()
+
+    def run_once(self):
+        self.archive_closed_days()
+        if self.prune:
+            self.prune_days()
+        self.compact_months()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"Archiving sensors rows failed, retrying in {self.interval} seconds: {e}")
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+def from_config(db, config):
+    archive_config = config.get('archive') or {}
+    return Archiver(db, Archive(archive_config.get('path', 'archive')), archive_config.get('prune', False),
+        archive_config.get('keep_days', 30), archive_config.get('interval', 3600))
+
+if __name__ == "__main__":
+    from yaml import safe_load
+    from db import open_database
+    parser = argparse.ArgumentParser(description="Archive closed days of sensors rows to columnar files")
+    parser.add_argument('--config', default='wxstation.yaml')
+    parser.add_argument('--prune', action='store_true', help="Delete archived rows older than keep_days from the database")
+    parser.add_argument('--aggregate', nargs=2, metavar=('START', 'END'), help="Print aggregates over the archive and database instead")
+    parser.add_argument('--width', default='1d', help="Bucket width for --aggregate, 1m, 1h, 1d or seconds")
+    parser.add_argument('--channels', default=",".join(ROLLUP_CHANNELS))
+    parser.add_argument('--station')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as file:
+        config = safe_load(file)
+    db = open_database(config)
+    archiver = from_config(db, config)
+    if args.aggregate:
+        start, end = (datetime.fromisoformat(value) for value in args.aggregate)
+        width = WIDTH_SECONDS.get(args.width) or int(args.width)
+        for row in combined_aggregates(archiver.archive, db, start, end, width, args.station, args.channels.split(',')):
+            print(json.dumps(row))
+    else:
+        archiver.prune = archiver.prune or args.prune
+        archiver.run_once()
+    db.close()
@@ -0,0 +1,319 @@
+"""Benchmarks of the report path that run without any hardware or database server:
+    python3 bench.py                              # print latency percentiles and memory of every case
+    python3 bench.py --save bench_baseline.json   # keep the results as the baseline
+    python3 bench.py --compare bench_baseline.json [--tolerance 0.25]
+    python3 bench.py --only aprs,db --years 3 --db /tmp/bench.db
+Database cases run against a throwaway SQLite file seeded with years of synthetic 5 minute rows
+ending now, kept with --db so it is only seeded once. --compare exits with 1 if the median time
+or peak memory of any case grew by more than the tolerance, so it can gate a change."""
+import argparse, gc, json, logging, math, os, platform, random, resource, sys, tempfile, tracemalloc
+from datetime import datetime, timedelta
+from itertools import count
+from time import perf_counter, perf_counter_ns, time, monotonic
+
+SAMPLE_NS = 50_000 # Calls are timed in groups lasting at least this long, so timer overhead doesn't swamp fast cases
+MIN_SAMPLES = 30
+ROW_SECONDS = 300 # Synthetic rows are one report every 5 minutes
+SEED_BATCH = 5000
+WIND_MPH = 150 # Anemometer pulses kept for the wind cases, at 150 mph the pulse ring has wrapped
+MEMORY_SLACK = 4096 # Bytes of peak memory growth ignored by --compare, allocator noise on tiny cases
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of an ordered list"""
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def measure(func, ops=1, seconds=0.5):
+    """Time func for about seconds, ops is how many operations one call does.
+    Returns microseconds per operation at each percentile, operations per second and peak bytes allocated by one call."""
+    func() # Warm up caches and lazy imports
+    inner = 1
+    while True:
+        start = perf_counter_ns()
+        for _ in range(inner):
+            func()
+        if perf_counter_ns() - start >= SAMPLE_NS or inner >= 1 << 20:
+            break
+        inner *= 2
+    samples = []
+    gc.collect()
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline or len(samples) < MIN_SAMPLES:
+        start = perf_counter_ns()
+        for _ in range(inner):
+            func()
+        samples.append((perf_counter_ns() - start) / inner / ops / 1000)
+    samples.sort()
+    # Memory in a separate pass, tracing allocations slows every call down
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    mean = sum(samples) / len(samples)
+    return {
+        'calls': len(samples) * inner,
+        'p50': round(percentile(samples, 0.5), 3),
+        'p90': round(percentile(samples, 0.9), 3),
+        'p99': round(percentile(samples, 0.99), 3),
+        'max': round(samples[-1], 3),
+        'ops': round(1e6 / mean) if mean else None,
+        'peak_bytes': max(peak, 0)
+    }
+
+def each(func, values):
+    """Call func with every value, without building a list of results that would count as memory used"""
+    for value in values:
+        func(value)
+
+def readings(rng):
+    """A report's data dictionary with plausible values"""
+    return {
+        'callsign': 'BENCH', 'temperature': rng.uniform(20, 95), 'humidity': rng.uniform(10, 100),
+        'pressure': rng.uniform(980, 1040), 'wdir': rng.randint(0, 359), 'wspeed': rng.uniform(0, 30),
+        'wgusts': rng.uniform(0, 45), 'rainfall': rng.choice((0.0, 0.0, 0.0, 0.011)), 'pm25_avg': rng.uniform(1, 40),
+        'pm10_avg': rng.uniform(2, 60)
+    }
+
+def aprs_cases(args):
+    from aprs import SendAprs
+    aprs = SendAprs(None, loglevel="WARNING")
+    config = {'aprs': {'callsign': 'NOCALL', 'longitude': '0000.00N', 'latitude': '00000.00W', 'comment': 'RPIWxstationV1', 'derived_comment': True}}
+    data = dict(readings(random.Random(1)), dew_point=52.3, heat_index=71.0, wind_chill=71.0, pressure_tendency=-1.2)
+    totals = {'00': 0.12, '1': 0.03, '24': 1.25}
+    numbers = list(range(-99, 1000))
+    rains = [round(i * 0.011, 3) for i in range(200)] + [0.0]
+    return [
+        ('aprs.make_packet', lambda: aprs.make_packet(data, config, totals), 1),
+        ('aprs.add_zeros', lambda: each(aprs.add_zeros, numbers), len(numbers)),
+        ('aprs.format_rain', lambda: each(aprs.format_rain, rains), len(rains))
+    ]
+
+def wdir_cases(args):
+    from wdir import WindDirectionMonitor, VANE_RESISTANCES, VIN, R1, ADC_STEPS
+    rng = random.Random(2)
+    # Raw ADC values of a vane swinging around, as FakeMCP3008 in simulate.py makes them
+    positions = [round(VIN * r2 / (R1 + r2) / VIN * (ADC_STEPS - 1)) for r2 in VANE_RESISTANCES]
+    codes = [max(0, min(ADC_STEPS - 1, rng.choice(positions) + rng.randint(-2, 2))) for _ in range(args.angles)]
+    monitor = WindDirectionMonitor()
+    for code in codes:
+        monitor.record(code)
+    return [
+        ('wdir.record', lambda: each(monitor.record, codes), len(codes)),
+        ('wdir.average', lambda: monitor.average(reset=False), 1) # A report's mean of every reading since the last one
+    ]
+
+def wspeed_cases(args):
+    from wspeed import WindMonitor, PULSES_PER_ROTATION, CIRCUMFERENCE_MILES
+    monitor = WindMonitor()
+    rate = WIND_MPH / (CIRCUMFERENCE_MILES * 3600 * monitor.ADJUSTMENT) * PULSES_PER_ROTATION # Pulses per second
+    rng = random.Random(3)
+    now = monotonic()
+    t = now - 700
+    while t < now:
+        monitor.pulses[monitor.count % monitor.size] = t
+        monitor.count += 1
+        t += rng.uniform(0.5, 1.5) / rate
+    monitor.started = now - 700
+    spinner = WindMonitor(size=1024)
+    return [
+        ('wspeed.spin', spinner.spin, 1), # gpiozero's callback for every pulse
+        ('wspeed.wind', lambda: monitor.wind(300, now), 1),
+        ('wspeed.average', lambda: monitor.average(600, now), 1),
+        ('wspeed.gust', lambda: monitor.gust(300, now), 1)
+    ]
+
+class FramePort:
+    """Serial port holding a block of SDS011 measurement frames, read again and again"""
+    def __init__(self, frames):
+        self.block = frames
+        self.in_waiting = len(frames)
+
+    def read(self, size=1):
+        return self.block
+
+    def write(self, frame):
+        pass
+
+def sds011_cases(args):
+    from pysds011 import MonitorAirQuality, RunningStats
+    rng = random.Random(4)
+    block = bytearray()
+    for _ in range(args.frames):
+        pm25, pm10 = rng.randint(10, 400), rng.randint(20, 600)
+        data = [pm25 & 0xFF, pm25 >> 8, pm10 & 0xFF, pm10 >> 8, 0x01, 0x02]
+        block += bytes([0xAA, 0xC0] + data + [sum(data) & 0xFF, 0xAB])
+    monitor = MonitorAirQuality(port=FramePort(bytes(block)))
+    stats = {'pm25': RunningStats(), 'pm10': RunningStats()}
+    monitor.read_sds011(stats)
+    monitor.latest = {'pm25': stats['pm25'].summary(), 'pm10': stats['pm10'].summary(), 'started': time(), 'finished': time()}
+    return [
+        ('sds011.read_frames', lambda: monitor.read_sds011(stats), args.frames),
+        ('sds011.average', monitor.average, 1)
+    ]
+
+def report_cases(args):
+    from derived import DerivedMetrics
+    from qc import QualityControl
+    rng = random.Random(5)
+    data = readings(rng)
+    clock = count(time(), ROW_SECONDS) # Each call is the next report
+    qc, derived = QualityControl(), DerivedMetrics()
+    return [
+        ('report.qc', lambda: qc.apply(dict(data), next(clock)), 1),
+        ('report.derived', lambda: derived.update(dict(data), next(clock)), 1)
+    ]
+
+def journal_cases(args):
+    from journal import Journal, read_journal
+    directory = tempfile.TemporaryDirectory(prefix="wxbench")
+    args.cleanup.append(directory.cleanup)
+    journal = Journal(directory.name) # Flushed by the cases, its thread is never started
+    clock = count(time() - 3600, 0.01)
+    def flush():
+        journal.extend('wdir', [(next(clock), 180.0) for _ in range(1000)])
+        journal.flush()
+    for _ in range(360): # An hour of readings at 100 per second
+        flush()
+    journal.close_segment()
+    start = time() - 1800
+    return [
+        ('journal.append', lambda: journal.append('wdir', 180.0), 1), # Flushed by the write case
+        ('journal.flush', flush, 1000), # One group commit of 1000 samples with its fsync
+        ('journal.read', lambda: sum(1 for _ in read_journal(directory.name, start, start + 60)), 6000)
+    ]
+
+def synthetic_rows(db, start, end, rng):
+    """Rows every ROW_SECONDS from start up to end with daily and seasonal cycles and the odd shower"""
+    created = start
+    raining = 0
+    while created < end:
+        day = created.timetuple().tm_yday / 365 * 2 * math.pi
+        hour = (created.hour + created.minute / 60) / 24 * 2 * math.pi
+        if raining:
+            raining -= 1
+        elif rng.random() < 0.002:
+            raining = rng.randint(3, 36) # A shower of 15 minutes to 3 hours
+        data = readings(rng)
+        data['temperature'] = 55 - 20 * math.cos(day) - 8 * math.cos(hour) + rng.gauss(0, 1)
+        data['rainfall'] = 0.011 * rng.randint(0, 4) if raining else 0.0
+        yield db.sensor_row(data, created.strftime('%Y-%m-%d %H:%M:%S'))
+        created += timedelta(seconds=ROW_SECONDS)
+
+def seed_database(db, years):
+    """Fill the database with rows for the past years, or top it up to now if it was seeded before"""
+    import migrate
+    migrate.upgrade(db)
+    end = datetime.now()
+    last = db.last_created()
+    start = end - timedelta(days=round(365 * years)) if last is None else last + timedelta(seconds=ROW_SECONDS)
+    started, seeded, rows = monotonic(), 0, []
+    for row in synthetic_rows(db, start, end, random.Random(6)):
+        rows.append(row)
+        if len(rows) >= SEED_BATCH:
+            db.insert_many(rows)
+            seeded += len(rows)
+            rows = []
+    if rows:
+        db.insert_many(rows)
+        seeded += len(rows)
+    if seeded:
+        logging.warning(f"Seeded {seeded} sensors rows from {start:%Y-%m-%d} in {round(monotonic() - started, 1)} seconds")
+
+def db_cases(args):
+    from db import ROLLUP_VERSION
+    from sqlitedb import SqliteDatabase
+    path = args.db
+    if path is None:
+        directory = tempfile.TemporaryDirectory(prefix="wxbench")
+        args.cleanup.append(directory.cleanup)
+        path = os.path.join(directory.name, "bench.db")
+    db = SqliteDatabase(path)
+    args.cleanup.append(db.close)
+    seed_database(db, args.years)
+    raw = SqliteDatabase(path)
+    args.cleanup.append(raw.close)
+    raw.version = ROLLUP_VERSION - 1 # Query the sensors table like a schema without rollups does
+    data = readings(random.Random(7))
+    return [
+        ('db.rain_avg.00', lambda: db.rain_avg('00'), 1),
+        ('db.rain_avg.1', lambda: db.rain_avg('1'), 1),
+        ('db.rain_avg.24', lambda: db.rain_avg('24'), 1),
+        ('db.rain_avg.24.raw', lambda: raw.rain_avg('24'), 1),
+        ('db.get_all_rain_avg', db.get_all_rain_avg, 1),
+        ('db.read_save_sensors', lambda: db.read_save_sensors(data), 1) # One report's insert with its rollups
+    ]
+
+GROUPS = {'aprs': aprs_cases, 'wdir': wdir_cases, 'wspeed': wspeed_cases, 'sds011': sds011_cases, 'report': report_cases, 'journal': journal_cases, 'db': db_cases}
+
+def run(args):
+    results = {}
+    groups = args.only.split(',') if args.only else list(GROUPS)
+    args.cleanup = []
+    try:
+        for group in groups:
+            for name, func, ops in GROUPS[group](args):
+                results[name] = measure(func, ops, args.seconds)
+                print_result(name, results[name])
+    finally:
+        for cleanup in reversed(args.cleanup):
+            cleanup()
+    return results
+
+def print_result(name, result, change=""):
+    print(f"{name:<24}{result['p50']:>11}{result['p90']:>11}{result['p99']:>11}{result['max']:>11}{result['ops']:>13}"
+        f"{round(result['peak_bytes'] / 1024, 1):>11}  {change}")
+
+def compare(results, baseline, tolerance):
+    """Print each case against the baseline, returns the names of the cases that regressed"""
+    regressed = []
+    print(f"\nAgainst baseline from {baseline.get('saved')} on {baseline.get('machine')}, tolerance {round(tolerance * 100)}%")
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None:
+            print(f"{name:<24}new case")
+            continue
+        slower = result['p50'] / old['p50'] - 1 if old['p50'] else 0.0
+        grown = result['peak_bytes'] - old['peak_bytes']
+        problems = []
+        if slower > tolerance:
+            problems.append("SLOWER")
+        if grown > MEMORY_SLACK and grown > old['peak_bytes'] * tolerance:
+            problems.append("MORE MEMORY")
+        if problems:
+            regressed.append(name)
+        print(f"{name:<24}p50 {old['p50']} -> {result['p50']} us ({slower:+.0%}), peak {old['peak_bytes']} -> {result['peak_bytes']} bytes  {' '.join(problems)}")
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the station's report path without hardware")
+    parser.add_argument('--only', help=f"Comma separated groups to run: {', '.join(GROUPS)}")
+    parser.add_argument('--seconds', type=float, default=0.5, help="Seconds spent timing each case")
+    parser.add_argument('--years', type=float, default=2, help="Years of synthetic rows the database is seeded with")
+    parser.add_argument('--db', help="SQLite file to seed and keep between runs, default a temporary file")
+    parser.add_argument('--angles', type=int, default=36000, help="Wind vane readings recorded per call, an hour at 10 per second")
+    parser.add_argument('--frames', type=int, default=1000, help="SDS011 frames parsed per call")
+    parser.add_argument('--save', metavar='FILE', help="Save the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="Compare the results against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Fraction a case may get slower or use more memory before it counts as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    unknown = set(args.only.split(',')) - set(GROUPS) if args.only else set()
+    if unknown:
+        parser.error(f"Unknown groups: {', '.join(sorted(unknown))}")
+    print(f"{'case (us per op)':<24}{'p50':>11}{'p90':>11}{'p99':>11}{'max':>11}{'ops/s':>13}{'peak KiB':>11}")
+    results = run(args)
+    # ru_maxrss is in KiB on Linux
+    print(f"\nMax resident memory {round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)} MiB, Python {platform.python_version()}")
+    if args.save:
+        baseline = {'saved': datetime.now().isoformat(timespec='seconds'), 'machine': platform.node(), 'python': platform.python_version(), 'results': results}
+        tmp_path = f"{args.save}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(baseline, file, indent=1)
+        os.replace(tmp_path, args.save)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressed = compare(results, json.load(file), args.tolerance)
+        if regressed:
+            print(f"\n{len(regressed)} regressions: {', '.join(regressed)}")
+            sys.exit(1)
@@ -0,0 +1,381 @@
+"""Central collector for several stations.
+Stations push readings as fixed size binary frames over UDP or HTTP. The collector drops
+retransmitted frames, batch inserts every station's rows into one database and sends the
+APRS packets of all stations through one set of APRS-IS sessions.
+    python3 collector.py --config collector.yaml"""
+import argparse, logging, socket, struct, zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+from time import time, strftime, localtime, sleep
+from urllib.parse import urlparse
+from derived import DerivedMetrics
+
+MAGIC = b'WX'
+VERSION = 2 # Version 2 added qc_flags, version 1 frames from stations that haven't been upgraded are still accepted
+# Readings carried in every frame, missing readings are sent as NaN
+FRAME_FIELDS = ('temperature', 'wdir', 'wspeed', 'wgusts', 'humidity', 'pressure', 'rainfall', 'rain_rate',
+    'pm25_avg', 'pm10_avg', 'rain1h', 'rain24h', 'rain00m')
+QC_MISSING = 0xFFFFFFFFFFFFFFFF # qc_flags sent by a station without quality control
+# magic, version, flags, sequence number, created (epoch seconds), callsign, readings, then packed qc_flags from version 2
+FRAME_BODIES = {
+    1: struct.Struct(f"!2sBBII9s{len(FRAME_FIELDS)}f"),
+    2: struct.Struct(f"!2sBBII9s{len(FRAME_FIELDS)}fQ")
+}
+FRAME_BODY = FRAME_BODIES[VERSION]
+FRAME_CRC = struct.Struct("!I")
+FRAME_SIZE = FRAME_BODY.size + FRAME_CRC.size
+MAX_DATAGRAM = 8192
+DEDUP_WINDOW = 64 # Sequence numbers remembered per station
+MAX_SEQ = 0xFFFFFFFF # Sequence numbers are sent as unsigned 32 bit ints
+UDP_PORT = 9120
+HTTP_PORT = 9121
+APRS_FIELDS = ('temperature', 'wdir', 'wspeed', 'wgusts', 'humidity', 'pressure') # Needed to build a packet
+
+class FrameError(ValueError):
+    pass
+
+def encode_frame(callsign, seq, created, data, flags=0):
+    values = [float('nan') if data.get(key) is None else float(data[key]) for key in FRAME_FIELDS]
+    qc_flags = QC_MISSING if data.get('qc_flags') is None else int(data['qc_flags'])
+    body = FRAME_BODY.pack(MAGIC, VERSION, flags, seq & 0xFFFFFFFF, int(created), callsign.encode('ascii')[:9], *values, qc_flags)
+    return body + FRAME_CRC.pack(zlib.crc32(body))
+
+def frame_body(frame, offset=0):
+    """Body layout of the frame at offset, from its version"""
+    if frame[offset:offset + 2] != MAGIC or len(frame) < offset + 3 or frame[offset + 2] not in FRAME_BODIES:
+        raise FrameError(f"unsupported frame {bytes(frame[offset:offset + 3])!r}")
+    return FRAME_BODIES[frame[offset + 2]]
+
+def decode_frame(frame):
+    """Returns (callsign, seq, created, data), readings that weren't sent are None"""
+    layout = frame_body(frame)
+    body = frame[:layout.size]
+    if FRAME_CRC.unpack_from(frame, layout.size)[0] != zlib.crc32(body):
+        raise FrameError("bad CRC")
+    magic, version, flags, seq, created, callsign, *values = layout.unpack(body)
+    qc_flags = values.pop() if version >= 2 else QC_MISSING
+    # NaN != NaN, rounding drops float32 noise such as 70.19999694824219
+    data = {key: round(value, 4) if value == value else None for key, value in zip(FRAME_FIELDS, values)}
+    data['qc_flags'] = None if qc_flags == QC_MISSING else qc_flags
+    return callsign.rstrip(b'\0').decode('ascii'), seq, created, data
+
+def decode_frames(payload):
+    """Split a datagram or request body into frames, yielding (frame, error)"""
+    offset = 0
+    while offset < len(payload):
+        try:
+            size = frame_body(payload, offset).size + FRAME_CRC.size
+        except FrameError as e:
+            yield None, FrameError(f"{e} at byte {offset}, the rest of the payload can't be split into frames")
+            return
+        try:
+            yield decode_frame(payload[offset:offset + size]), None
+        except (FrameError, struct.error, UnicodeDecodeError) as e:
+            yield None, e
+        offset += size
+
+class StationState:
+    """Sliding window of the sequence numbers seen from one station, like IPsec replay protection"""
+    __slots__ = ('highest', 'seen', 'created', 'last_aprs')
+
+    def __init__(self):
+        self.highest = None
+        self.seen = 0 # Bit n is set if highest - n has been received
+        self.created = 0 # Newest created time received
+        self.last_aprs = 0
+
+    def accept(self, seq, created):
+        """True the first time a sequence number is seen"""
+        if type(seq) is not int or not 0 <= seq <= MAX_SEQ:
+            raise FrameError(f"invalid sequence number {seq!r}")
+        if self.highest is None or seq > self.highest:
+            # A jump past the window forgets everything, without building a huge int first
+            shift = DEDUP_WINDOW if self.highest is None else min(seq - self.highest, DEDUP_WINDOW)
+            self.seen = ((self.seen << shift) | 1) & ((1 << DEDUP_WINDOW) - 1)
+            self.highest = seq
+        elif self.highest - seq < DEDUP_WINDOW:
+            bit = 1 << (self.highest - seq)
+            if self.seen & bit:
+                return False
+            self.seen |= bit
+        elif created > self.created:
+            # Far behind the window but newer readings, the station restarted with a lower sequence number
+            self.highest, self.seen = seq, 1
+        else:
+            return False
+        self.created = max(self.created, created)
+        return True
+
+class Collector:
+    def __init__(self, db_writer=None, uplink=None, aprs_config=None, stations=None, aprs_interval=300):
+        self.db_writer = db_writer # WriteBehindQueue shared by every station, None to only count readings
+        self.uplink = uplink
+        self.aprs_config = aprs_config or {}
+        self.stations = stations or {} # Callsign -> latitude, longitude and comment for APRS packets
+        self.aprs_interval = aprs_interval # Seconds between packets from one station, CWOP asks for 5 minutes
+        self.state = {}
+        self.derived = {} # Callsign -> DerivedMetrics, the same windows a station keeps when saving to its own database
+        self.lock = Lock()
+        self.stats = {'frames': 0, 'accepted': 0, 'duplicates': 0, 'invalid': 0, 'aprs_queued': 0, 'aprs_dropped': 0}
+        self.packets = Queue(10000)
+        self.stop_event = Event()
+        self.threads = []
+        self.aprs = None
+        if uplink is not None:
+            from aprs import SendAprs
+            self.aprs = SendAprs(None, logging.getLevelName(logging.getLogger().level), uplink=uplink)
+
+    def ingest(self, payload, source=None):
+        """Handle one datagram or request body, returns (accepted, duplicates, invalid)"""
+        accepted = duplicates = invalid = 0
+        for frame, error in decode_frames(payload):
+            if error is not None:
+                invalid += 1
+                logging.debug(f"Invalid frame from {source}: {error}")
+                continue
+            callsign, seq, created, data = frame
+            with self.lock:
+                state = self.state.get(callsign)
+                if state is None:
+                    state = self.state[callsign] = StationState()
+                    logging.info(f"New station {callsign} from {source}")
+                try:
+                    fresh = state.accept(seq, created)
+                except FrameError as e:
+                    invalid += 1
+                    logging.debug(f"Invalid frame from {source}: {e}")
+                    continue
+                if not fresh:
+                    duplicates += 1
+                    continue
+                send_aprs = (self.aprs is not None and callsign in self.stations and created - state.last_aprs >= self.aprs_interval
+                    and all(data[key] is not None for key in APRS_FIELDS))
+                if send_aprs:
+                    state.last_aprs = created
+            accepted += 1
+            data['callsign'] = callsign
+            self.derived_metrics(callsign).update(data, created)
+            if self.db_writer is not None:
+                self.db_writer.put(data, strftime('%Y-%m-%d %H:%M:%S', localtime(created)))
+            if send_aprs:
+                self.queue_packet(callsign, data)
+        with self.lock:
+            self.stats['frames'] += accepted + duplicates + invalid
+            self.stats['accepted'] += accepted
+            self.stats['duplicates'] += duplicates
+            self.stats['invalid'] += invalid
+        return accepted, duplicates, invalid
+
+    def derived_metrics(self, callsign):
+        with self.lock:
+            derived = self.derived.get(callsign)
+            if derived is None:
+                derived = self.derived[callsign] = DerivedMetrics()
+            return derived
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def station_config(self, callsign):
+        return {'aprs': dict(self.aprs_config, callsign=callsign, **self.stations[callsign])}
+
+    def queue_packet(self, callsign, data):
+        # Only rain can be missing here, derived readings stay None so they're left out of the comment
+        data = {key: 0.0 if value is None and key in FRAME_FIELDS else value for key, value in data.items()}
+        data['wdir'] = round(data['wdir'])
+        rain = {'1': data['rain1h'], '24': data['rain24h'], '00': data['rain00m']}
+        try:
+            packet = self.aprs.make_packet(data, self.station_config(callsign), rain)
+            self.packets.put_nowait(packet)
+            self.count('aprs_queued')
+        except Full:
+            self.count('aprs_dropped')
+            logging.error(f"APRS packet queue is full, dropping packet from {callsign}")
+        except ValueError as e:
+            logging.error(f"Unable to build APRS packet for {callsign}: {e}")
+
+    def fan_out(self):
+        """Send queued packets, everything waiting goes out in one write per server"""
+        while not self.stop_event.is_set():
+            try:
+                packets = [self.packets.get(timeout=1)]
+            except Empty:
+                continue
+            while len(packets) < 100:
+                try:
+                    packets.append(self.packets.get_nowait())
+                except Empty:
+                    break
+            self.uplink.send("\r\n".join(packets))
+
+    def serve_udp(self, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024) # Ride out bursts while a batch is inserted
+        sock.bind((host, port))
+        sock.settimeout(1)
+        logging.info(f"Receiving station frames on udp://{host}:{port}")
+        while not self.stop_event.is_set():
+            try:
+                payload, address = sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            self.ingest(payload, address[0])
+        sock.close()
+
+    def serve_http(self, host, port):
+        collector = self
+
+        class IngestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if urlparse(self.path).path != '/ingest':
+                    self.send_error(404)
+                    return
+                if length > MAX_DATAGRAM * 64:
+                    self.send_error(413)
+                    return
+                accepted, duplicates, invalid = collector.ingest(self.rfile.read(length), self.client_address[0])
+                body = f'{{"accepted": {accepted}, "duplicates": {duplicates}, "invalid": {invalid}}}'.encode()
+                self.send_response(400 if invalid and not accepted and not duplicates else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), IngestHandler)
+        server.daemon_threads = True
+        logging.info(f"Receiving station frames on http://{host}:{port}/ingest")
+        Thread(target=lambda: (self.stop_event.wait(), server.shutdown()), daemon=True).start()
+        server.serve_forever()
+
+    def start(self, host="0.0.0.0", udp_port=UDP_PORT, http_port=HTTP_PORT):
+        targets = []
+        if udp_port:
+            targets.append(("Thread-Collector_UDP", self.serve_udp, (host, udp_port)))
+        if http_port:
+            targets.append(("Thread-Collector_HTTP", self.serve_http, (host, http_port)))
+        if self.uplink is not None:
+            targets.append(("Thread-Collector_APRS", self.fan_out, ()))
+        for name, target, args in targets:
+            thread = Thread(target=target, args=args, daemon=True, name=name)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+
+class StationPusher:
+    """Station side of the collector. UDP datagrams repeat the last few frames so a lost
+    datagram is filled in by the next one, HTTP keeps unacknowledged frames until a post succeeds."""
+    def __init__(self, callsign, url, redundancy=2, backlog=288, timeout=10):
+        self.callsign = callsign
+        self.url = urlparse(url if '://' in url else f"udp://{url}")
+        self.seq = int(time()) # Starts past any sequence number used before a restart
+        self.timeout = timeout
+        self.recent = deque(maxlen=redundancy + 1) # Frames repeated in each datagram
+        self.pending = deque(maxlen=backlog) # Frames not yet acknowledged over HTTP, a day of 5 minute reports
+        self.sock = None
+        if self.url.scheme == 'udp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.address = (self.url.hostname, self.url.port or UDP_PORT)
+        elif self.url.scheme not in ('http', 'https'):
+            raise ValueError(f"collector url must be udp://, http:// or https://, got {url}")
+
+    @classmethod
+    def from_config(cls, callsign, collector_config):
+        return cls(callsign, collector_config['url'], collector_config.get('redundancy', 2),
+            collector_config.get('backlog', 288), collector_config.get('timeout', 10))
+
+    def push(self, data, rain_totals=None, created=None):
+        readings = dict(data)
+        if rain_totals is not None:
+            readings.update(rain1h=rain_totals['1'], rain24h=rain_totals['24'], rain00m=rain_totals['00'])
+        frame = encode_frame(self.callsign, self.seq, created or time(), readings)
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if self.sock is not None:
+            self.recent.append(frame)
+            self.sock.sendto(b''.join(self.recent), self.address)
+            return True
+        self.pending.append(frame)
+        return self.flush()
+
+    def flush(self):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        frames = list(self.pending)
+        url = self.url._replace(path=self.url.path or '/ingest').geturl()
+        try:
+            with urlopen(Request(url, data=b''.join(frames), method='POST'), timeout=self.timeout) as response:
+                response.read()
+        except HTTPError as e:
+            if e.code >= 500:
+                logging.error(f"Collector {url} failed with {e.code}, {len(frames)} frames waiting: {e.reason}")
+                return False
+            # The collector rejected the batch, sending it again would fail the same way and hold up newer frames
+            logging.error(f"Collector {url} rejected {len(frames)} frames with {e.code}, dropping them: {e.reason}")
+            for _ in frames:
+                self.pending.popleft()
+            return False
+        except OSError as e:
+            logging.error(f"Unable to push readings to collector {url}, {len(frames)} frames waiting: {e}")
+            return False
+        for _ in frames:
+            self.pending.popleft()
+        return True
+
+def main():
+    from yaml import safe_load
+    parser = argparse.ArgumentParser(description="Collect readings pushed by several stations")
+    parser.add_argument('--config', default='collector.yaml')
+    parser.add_argument('--no-db', action='store_true', help="Count readings without saving them, for benchmarking")
+    args = parser.parse_args()
+    with open(args.config, 'r') as file:
+        config = safe_load(file)
+    logging.basicConfig(level=config.get('loglevel', 'INFO'))
+    db_writer = None
+    if not args.no_db:
+        from db import WeatherDatabase
+        from writebehind import WriteBehindQueue
+        db_config = config['db']
+        if db_config.get('engine', 'mariadb') == 'sqlite':
+            from sqlitedb import SqliteDatabase
+            db = SqliteDatabase(db_config.get('path', 'collector.db'), pool_size=db_config.get('pool_size', 4))
+            import migrate
+            migrate.upgrade(db) # Creates the tables in a new file
+        else:
+            db = WeatherDatabase(db_config.get('user', 'wxstation'), db_config['pass'], db_config.get('host', '127.0.0.1'),
+                pool_size=db_config.get('pool_size', 4), connect_retries=1)
+        queue_config = config.get('db_queue', {})
+        # Rows from every station share the queue, so batches are much larger than on a station
+        db_writer = WriteBehindQueue(db, spool_path=queue_config.get('spool', 'collector_spool.db'), maxsize=queue_config.get('size', 100000),
+            batch_size=queue_config.get('batch_size', 1000), flush_interval=queue_config.get('flush_interval', 1))
+        db_writer.start()
+        if (config.get('archive') or {}).get('enabled', False):
+            import archive
+            archive.from_config(db, config).start()
+    uplink = None
+    aprs_config = config.get('aprs')
+    if aprs_config and aprs_config.get('sendall'):
+        from uplink import AprsUplink
+        uplink = AprsUplink.from_config(aprs_config)
+        uplink.start()
+    collector = Collector(db_writer, uplink, aprs_config, config.get('stations'), config.get('aprs_interval', 300))
+    collector.start(config.get('host', '0.0.0.0'), config.get('udp_port', UDP_PORT), config.get('http_port', HTTP_PORT))
+    try:
+        while True:
+            sleep(config.get('stats_interval', 60))
+            queued = f", {db_writer.depth()} rows queued" if db_writer is not None else ""
+            logging.info(f"{len(collector.state)} stations, {collector.stats}{queued}")
+    except KeyboardInterrupt:
+        collector.stop()
+        if db_writer is not None:
+            db_writer.stop(10)
+
+if __name__ == "__main__":
+    main()
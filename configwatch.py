@@ -0,0 +1,138 @@
+"""Validation and hot reload of wxstation.yaml.
+The file is reloaded on SIGHUP or when it changes on disk. A new config is only applied if it
+passes validation, otherwise the running config is kept and the problems are logged."""
+import logging, os, signal
+from threading import Thread, Event
+from yaml import safe_load
+
+# Keys that are only read at startup, changing them logs a warning instead of being applied
+RESTART_KEYS = ('db_engine', 'db_path', 'db_host', 'db_pass', 'db_pool_size', 'db_queue', 'db_migrate', 'db_partition', 'rain_log', 'wind_buffer_size',
+    'collector', 'acquisition', 'journal', 'metrics', 'history', 'archive', 'simulate', 'dev_mode')
+RESTART_SDS011_KEYS = ('tty', 'baudrate')
+
+def positive(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+def validate_config(config):
+    """Returns a list of problems with config, empty if it can be used"""
+    if not isinstance(config, dict):
+        return ["config is empty or not a mapping"]
+    problems = []
+    if not positive(config.get('report_interval')):
+        problems.append("report_interval must be a positive number of seconds")
+    if not isinstance(config.get('dev_mode'), bool):
+        problems.append("dev_mode must be True or False")
+    if not isinstance(config.get('sensors'), dict):
+        problems.append("sensors must be a mapping of sensor to True or False")
+    sds011 = config.get('sds011')
+    if not isinstance(sds011, dict) or not isinstance(sds011.get('enabled'), bool):
+        problems.append("sds011 must have enabled set to True or False")
+    elif sds011['enabled']:
+        if not positive(sds011.get('interval')):
+            problems.append("sds011 interval must be a positive number of seconds")
+        for key in ('warmup', 'sleep'):
+            if key in sds011 and not (sds011[key] == 0 or positive(sds011[key])):
+                problems.append(f"sds011 {key} must be 0 or more seconds")
+    aprs = config.get('aprs')
+    if not isinstance(aprs, dict):
+        problems.append("aprs section is missing")
+    else:
+        for key in ('callsign', 'longitude', 'latitude'):
+            if not aprs.get(key):
+                problems.append(f"aprs {key} is missing")
+        if aprs.get('sendall') and not (isinstance(aprs.get('servers'), dict) and aprs['servers']):
+            problems.append("aprs servers must list at least one server when sendall is True")
+        for key in ('port', 'timeout', 'keepalive'):
+            if key in aprs and not positive(aprs[key]):
+                problems.append(f"aprs {key} must be a positive number")
+    drivers = config.get('drivers') or {}
+    if not isinstance(drivers, dict):
+        problems.append("drivers must be a mapping of sensor to options")
+    else:
+        for name, options in drivers.items():
+            for key, value in (options or {}).items():
+                if not positive(value):
+                    problems.append(f"drivers {name} {key} must be a positive number")
+    acquisition = config.get('acquisition') or {}
+    if acquisition.get('mode', 'thread') not in ('thread', 'process'):
+        problems.append("acquisition mode must be thread or process")
+    journal = config.get('journal') or {}
+    for key in ('flush_interval', 'segment_mb', 'segment_hours', 'max_mb'):
+        if key in journal and not positive(journal[key]):
+            problems.append(f"journal {key} must be a positive number")
+    if positive(journal.get('flush_interval')) and journal['flush_interval'] > 300:
+        problems.append("journal flush_interval must be at most 300 seconds")
+    if config.get('db_engine', 'mariadb') not in ('mariadb', 'sqlite'):
+        problems.append("db_engine must be mariadb or sqlite")
+    if 'wdir_sample_rate' in config and not positive(config['wdir_sample_rate']):
+        problems.append("wdir_sample_rate must be a positive number")
+    return problems
+
+def restart_changes(old, new):
+    """Keys that changed but only take effect after a restart"""
+    changed = [key for key in RESTART_KEYS if old.get(key) != new.get(key)]
+    old_sds011, new_sds011 = old.get('sds011') or {}, new.get('sds011') or {}
+    changed += [f"sds011 {key}" for key in RESTART_SDS011_KEYS if old_sds011.get(key) != new_sds011.get(key)]
+    return changed
+
+class ConfigWatcher:
+    """Calls on_change(config) with the validated new config on SIGHUP or when the file changes"""
+    def __init__(self, path, on_change, poll_interval=5):
+        self.path = path
+        self.on_change = on_change
+        self.poll_interval = poll_interval # Seconds between checks of the file's modification time
+        self.reload_event = Event()
+        self.stop_event = Event()
+        self.signature = self.stat()
+        self.thread = Thread(target=self.run, daemon=True, name="Thread-Config_Watcher")
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                config = safe_load(file)
+        except Exception as e:
+            logging.error(f"Unable to reload {self.path}, keeping the running config: {e}")
+            return None
+        problems = validate_config(config)
+        if problems:
+            logging.error(f"Not reloading {self.path}, keeping the running config:\n\t" + "\n\t".join(problems))
+            return None
+        return config
+
+    def check(self):
+        signature = self.stat()
+        requested = self.reload_event.is_set()
+        self.reload_event.clear()
+        if not requested and (signature is None or signature == self.signature):
+            return
+        self.signature = signature
+        config = self.load()
+        if config is None:
+            return
+        logging.info(f"Reloading {self.path}{' on SIGHUP' if requested else ', the file changed'}")
+        try:
+            self.on_change(config)
+        except Exception as e:
+            logging.exception(f"Applying the reloaded config failed: {e}")
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.reload_event.wait(self.poll_interval)
+            if not self.stop_event.is_set():
+                self.check()
+
+    def start(self):
+        """Must be called from the main thread to install the SIGHUP handler"""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_event.set())
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.reload_event.set()
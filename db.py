@@ -1,18 +1,271 @@
-import mariadb as db
-from time import sleep
-import logging
+try:
+    import mariadb as db
+except ImportError:
+    db = None # Only the SQLite engine can be used, see sqlitedb.py
+from contextlib import contextmanager
+from collections import deque
+from threading import Condition
+from time import sleep, strftime, localtime, monotonic
+import logging, metrics
+
+# Columns written for every report, rows are dictionaries keyed by these names
+SENSOR_COLUMNS = ('stationid', 'created', 'ambient_temperature', 'wind_direction', 'wind_speed', 'wind_gust_speed', 'humidity', 'air_pressure', 'rainfall', 'pm25', 'pm10')
+SENSORS_INSERT = f"""INSERT INTO sensors({', '.join(SENSOR_COLUMNS)})
+        VALUES({', '.join('?' * len(SENSOR_COLUMNS))});"""
+# Readings computed by derived.py, in the data dictionary and sensors table under the same names
+DERIVED_COLUMNS = ('dew_point', 'heat_index', 'wind_chill', 'pressure_tendency', 'temperature_min', 'temperature_max')
+# Queries total rainfall between now and 00:00 of today
+RAIN_SINCE_MIDNIGHT = """SELECT ROUND(SUM(rainfall), 3) FROM sensors WHERE created BETWEEN CURRENT_DATE() AND NOW();"""
+# Queries total rainfall for the past hour or 24 hours
+RAIN_PAST_HOURS = """SELECT ROUND(SUM(rainfall), 3) FROM sensors WHERE created >= NOW() - INTERVAL ? HOUR;"""
+# Rain totals read from the rollup tables once they exist
+RAIN_ROLLUP_SINCE_MIDNIGHT = """SELECT ROUND(SUM(rainfall_sum), 3) FROM sensors_1d WHERE bucket = CURRENT_DATE();"""
+# Whole hours come from sensors_1h, only the partial hour at the start of the window from sensors_1m
+RAIN_ROLLUP_PAST_HOURS = """SELECT ROUND(COALESCE((SELECT SUM(rainfall_sum) FROM sensors_1m WHERE bucket >= w.start AND bucket < w.boundary), 0)
+        + COALESCE((SELECT SUM(rainfall_sum) FROM sensors_1h WHERE bucket >= w.boundary), 0), 3)
+    FROM (SELECT start, TIMESTAMP(DATE_FORMAT(start, '%Y-%m-%d %H:00:00')) + INTERVAL 1 HOUR AS boundary
+        FROM (SELECT NOW() - INTERVAL ? HOUR AS start) n) w;"""
+RAIN_HISTORY = """SELECT created, rainfall FROM sensors WHERE created >= NOW() - INTERVAL ? HOUR AND rainfall > 0;"""
+
+# Channels summarised in the rollup tables created by migrate.py
+ROLLUP_CHANNELS = ('ambient_temperature', 'wind_speed', 'wind_gust_speed', 'humidity', 'air_pressure', 'rainfall', 'pm25', 'pm10')
+# Rollup tables and how many characters of created are kept for their bucket, the rest is zero filled
+ROLLUPS = {'sensors_1m': 16, 'sensors_1h': 13, 'sensors_1d': 10}
+ROLLUP_VERSION = 2 # Schema version that added the rollup tables
+QC_VERSION = 3 # Schema version that added sensors.qc_flags
+DERIVED_VERSION = 4 # Schema version that added the derived columns
+# Columns added by later migrations, only written once the schema has them.
+# qc_flags holds the quality control flags of each row, packed by qc.pack_flags.
+VERSIONED_COLUMNS = ((QC_VERSION, ('qc_flags',)), (DERIVED_VERSION, DERIVED_COLUMNS))
+
+def insert_columns(version):
+    """Columns of the sensors table at a schema version and the insert statement writing them"""
+    columns = SENSOR_COLUMNS + tuple(column for added, names in VERSIONED_COLUMNS if added <= version for column in names)
+    return columns, f"""INSERT INTO sensors({', '.join(columns)})
+        VALUES({', '.join('?' * len(columns))});"""
+
+def bucket(created, width):
+    return created[:width] + '0000-00-00 00:00:00'[width:]
+
+def rollup_upsert(table, sqlite=False):
+    """Insert a single row into a rollup bucket, or merge it into the bucket if it already exists"""
+    least, greatest, new = ('MIN', 'MAX', "excluded.{}") if sqlite else ('LEAST', 'GREATEST', "VALUES({})")
+    columns, updates = ['stationid', 'bucket', 'samples'], ['samples = samples + 1']
+    for ch in ROLLUP_CHANNELS:
+        columns += [f"{ch}_count", f"{ch}_min", f"{ch}_max", f"{ch}_sum"]
+        count, low, high, total = (new.format(f"{ch}_{part}") for part in ('count', 'min', 'max', 'sum'))
+        updates += [
+            f"{ch}_count = {ch}_count + {count}",
+            # LEAST, GREATEST and + return NULL when either side is NULL, so fall back to whichever is set
+            f"{ch}_min = COALESCE({least}({ch}_min, {low}), {ch}_min, {low})",
+            f"{ch}_max = COALESCE({greatest}({ch}_max, {high}), {ch}_max, {high})",
+            f"{ch}_sum = COALESCE({ch}_sum + {total}, {ch}_sum, {total})"
+        ]
+    conflict = "ON CONFLICT(stationid, bucket) DO UPDATE SET" if sqlite else "ON DUPLICATE KEY UPDATE"
+    return f"""INSERT INTO {table}({', '.join(columns)}) VALUES({', '.join('?' * len(columns))})
+        {conflict} {', '.join(updates)};"""
+
+ROLLUP_UPSERTS = {table: rollup_upsert(table) for table in ROLLUPS}
+
+# Bucket widths for history aggregates, the rollup table holding them and the matching DATE_FORMAT
+AGGREGATE_WIDTHS = {
+    '1m': ('sensors_1m', '%Y-%m-%d %H:%i:00'),
+    '1h': ('sensors_1h', '%Y-%m-%d %H:00:00'),
+    '1d': ('sensors_1d', '%Y-%m-%d 00:00:00')
+}
+# Bucket of each sensors row when aggregating without rollups
+BUCKET_EXPRESSIONS = {width: f"DATE_FORMAT(created, '{date_format}')" for width, (table, date_format) in AGGREGATE_WIDTHS.items()}
+STREAM_BATCH = 1000 # Rows fetched at a time when streaming history
+
+def aggregate_query(width, rollups, station, buckets=BUCKET_EXPRESSIONS):
+    """Per bucket count, min, max and sum of every rollup channel between two times, summed over stations unless station is given"""
+    table = AGGREGATE_WIDTHS[width][0]
+    if rollups:
+        selects = ["bucket", "SUM(samples)"]
+        for ch in ROLLUP_CHANNELS:
+            selects += [f"SUM({ch}_count)", f"MIN({ch}_min)", f"MAX({ch}_max)", f"SUM({ch}_sum)"]
+        where = "bucket >= ? AND bucket < ?" + (" AND stationid = ?" if station else "")
+        return f"SELECT {', '.join(selects)} FROM {table} WHERE {where} GROUP BY bucket ORDER BY bucket;"
+    # Without rollups the sensors table is grouped directly, much slower over long ranges
+    selects = [f"{buckets[width]} AS b", "COUNT(*)"]
+    for ch in ROLLUP_CHANNELS:
+        selects += [f"COUNT({ch})", f"MIN({ch})", f"MAX({ch})", f"SUM({ch})"]
+    where = "created >= ? AND created < ?" + (" AND stationid = ?" if station else "")
+    return f"SELECT {', '.join(selects)} FROM sensors WHERE {where} GROUP BY b ORDER BY b;"
+
+SENSORS_LATEST = f"SELECT {', '.join(SENSOR_COLUMNS)} FROM sensors ORDER BY id DESC LIMIT 1;"
+SENSORS_LATEST_STATION = f"SELECT {', '.join(SENSOR_COLUMNS)} FROM sensors WHERE stationid = ? ORDER BY created DESC LIMIT 1;"
+SENSORS_FIRST = "SELECT MIN(created) FROM sensors;"
+SENSORS_LAST = "SELECT MAX(created) FROM sensors;"
+SENSORS_COUNT_RANGE = "SELECT COUNT(*) FROM sensors WHERE created >= ? AND created < ?;"
+# The schema_version table is created by the first migration
+SCHEMA_VERSION_EXISTS = "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'schema_version';"
+# Deleted a batch at a time so archiving never holds locks on the table for long
+SENSORS_DELETE_RANGE = "DELETE FROM sensors WHERE created >= ? AND created < ? LIMIT ?;"
+
+def sensors_range(columns=SENSOR_COLUMNS, station=False):
+    return f"SELECT {', '.join(columns)} FROM sensors WHERE created >= ? AND created < ?{' AND stationid = ?' if station else ''} ORDER BY created;"
+
+def number(value):
+    # DECIMAL columns come back as Decimal, which json can't encode
+    return None if value is None else float(value)
+
+class PooledConnection:
+    """MariaDB connection kept open by ConnectionPool, along with its prepared statements"""
+    # Driver errors, a connection that raised one is closed instead of being reused.
+    # Exception is never reached without the connector, as no MariaDB connection can be opened.
+    error = db.Error if db is not None else Exception
+    # Errors caused by the rows written rather than the server, retrying them can never succeed
+    data_errors = (db.DataError, db.IntegrityError) if db is not None else ()
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = {} # SQL text -> prepared cursor
+
+    def statement(self, sql):
+        # Prepared cursors ignore the SQL text after their first execute, so one cursor is kept per statement
+        if sql not in self.statements:
+            self.statements[sql] = self.conn.cursor(prepared=True)
+        return self.statements[sql]
+
+    def healthy(self):
+        try:
+            self.conn.ping()
+            return True
+        except self.error as e:
+            logging.error(f"Pooled MariaDB connection failed health check: {e}")
+            return False
+
+    def reconnect(self):
+        self.close_statements()
+        self.conn.reconnect()
+
+    def close_statements(self):
+        for cur in self.statements.values():
+            try:
+                cur.close()
+            except self.error:
+                pass
+        self.statements.clear()
+
+    def close(self):
+        self.close_statements()
+        try:
+            self.conn.close()
+        except self.error:
+            pass
+
+class ConnectionPool:
+    """Fixed size pool of database connections. Connections are created as needed up to size,
+    health checked before being handed out and reconnected if the server dropped them."""
+    def __init__(self, connect, size=2, pooled=PooledConnection, timeout=30):
+        self.connect = connect # Function returning a new connection or None
+        self.size = size
+        self.pooled = pooled # Wrapper keeping each connection's statements, by engine
+        self.timeout = timeout # Seconds to wait for a connection while all of them are in use
+        self.idle = deque()
+        self.created = 0
+        # Notified whenever a connection is returned or discarded, so a waiter can take it or open a new one
+        self.available = Condition()
+
+    def _acquire(self):
+        deadline = monotonic() + self.timeout
+        with self.available:
+            while not self.idle and self.created >= self.size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise self.pooled.error(f"Timed out after {self.timeout} seconds waiting for a database connection")
+                self.available.wait(remaining)
+            pooled = self.idle.popleft() if self.idle else None
+            if pooled is None:
+                self.created += 1
+        if pooled is None:
+            try:
+                conn = self.connect()
+            except BaseException:
+                self._forget()
+                raise
+            if conn is None:
+                self._forget()
+                raise self.pooled.error("Unable to open a new database connection")
+            return self.pooled(conn)
+        if not pooled.healthy():
+            try:
+                pooled.reconnect()
+                logging.info("Reconnected pooled database connection")
+            except pooled.error as e:
+                self._discard(pooled)
+                raise pooled.error(f"Unable to reconnect pooled database connection: {e}")
+        return pooled
+
+    def _forget(self):
+        with self.available:
+            self.created -= 1
+            self.available.notify()
+
+    def _release(self, pooled):
+        with self.available:
+            self.idle.append(pooled)
+            self.available.notify()
+
+    def _discard(self, pooled):
+        pooled.close()
+        self._forget()
+
+    @contextmanager
+    def connection(self):
+        pooled = self._acquire()
+        try:
+            yield pooled
+        except pooled.error:
+            # Don't hand a connection in an unknown state to the next caller
+            self._discard(pooled)
+            raise
+        except BaseException:
+            self._release(pooled)
+            raise
+        else:
+            self._release(pooled)
+
+    def close(self):
+        while True:
+            with self.available:
+                if not self.idle:
+                    break
+                pooled = self.idle.popleft()
+            self._discard(pooled)
 
 class WeatherDatabase:
-    def __init__(self, user="wxstation", password="password", host="127.0.0.1", port=3306, database="weather"):
+    """Sensors table in MariaDB. SqliteDatabase in sqlitedb.py is the embedded engine, it replaces
+    the pool and the SQL below where the dialects differ and shares everything else."""
+    engine = 'mariadb'
+    rain_since_midnight = RAIN_SINCE_MIDNIGHT
+    rain_past_hours = RAIN_PAST_HOURS
+    rain_rollup_since_midnight = RAIN_ROLLUP_SINCE_MIDNIGHT
+    rain_rollup_past_hours = RAIN_ROLLUP_PAST_HOURS
+    rain_history_query = RAIN_HISTORY
+    rollup_upserts = ROLLUP_UPSERTS
+    bucket_expressions = BUCKET_EXPRESSIONS
+    sensors_delete_range = SENSORS_DELETE_RANGE
+    sensors_first = SENSORS_FIRST
+    sensors_last = SENSORS_LAST
+    schema_version_exists = SCHEMA_VERSION_EXISTS
+
+    def __init__(self, user="wxstation", password="password", host="127.0.0.1", port=3306, database="weather", pool_size=2, connect_retries=3):
+        if db is None:
+            raise ImportError("The mariadb package is needed for db_engine mariadb, install it or set db_engine to sqlite")
         # Set custom options if given, use defaults if not
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.database = database
+        self.connect_retries = connect_retries
+        self.version = None # Schema version, checked on first use
+        self.pool = ConnectionPool(lambda: self.db_connect(self.connect_retries), pool_size)
 
-    def db_connect(self):
-        for i in range(1, 4): # Retry 3 times increasing delay by 10 seconds each time
+    def db_connect(self, retries=3):
+        for i in range(1, retries + 1): # Retry increasing delay by 10 seconds each time
             try:
                 conn = db.connect(
                     user = self.user,
@@ -24,53 +277,123 @@ class WeatherDatabase:
                 return conn
             except db.Error as e:
                 # Increase delay by 10 seconds
+                if i == retries:
+                    logging.critical(f"Error connecting to MariaDB Server: {e}\n\t Giving up after {retries} attempts")
+                    break
                 delay = i * 10
                 logging.critical(f"Error connecting to MariaDB Server: {e}\n\t Retry number {i}\n\t Retrying in {delay} seconds...")
                 sleep(delay)
                 continue
 
+    def sensor_row(self, data, created=None):
+        """Convert a report's data dictionary into a sensors row, created defaults to now in local time"""
+        return {
+            'stationid': data['callsign'],
+            'created': created or strftime('%Y-%m-%d %H:%M:%S', localtime()),
+            'ambient_temperature': data['temperature'],
+            'wind_direction': data['wdir'],
+            'wind_speed': data['wspeed'],
+            'wind_gust_speed': data['wgusts'],
+            'humidity': data['humidity'],
+            'air_pressure': None if data['pressure'] is None else round(data['pressure'], 2),
+            'rainfall': data['rainfall'],
+            'pm25': data['pm25_avg'],
+            'pm10': data['pm10_avg'],
+            'qc_flags': data.get('qc_flags'),
+            **{column: data.get(column) for column in DERIVED_COLUMNS}
+        }
+
+    def schema_version(self, conn):
+        """Newest migration applied, 0 before the first one. Errors are raised, not taken to mean version 0."""
+        cur = conn.conn.cursor()
+        try:
+            cur.execute(self.schema_version_exists)
+            if not cur.fetchone()[0]:
+                return 0
+            cur.execute("SELECT MAX(version) FROM schema_version;")
+            return cur.fetchone()[0] or 0
+        finally:
+            cur.close()
+
+    def cached_version(self, conn):
+        if self.version is None:
+            version = self.schema_version(conn) # Only kept once it has been read, a failed read is retried next time
+            if version < DERIVED_VERSION:
+                logging.info(f"Database schema is at version {version}, run migrate.py to add the newer tables and columns")
+            self.version = version
+        return self.version
+
+    def has_rollups(self, conn):
+        return self.cached_version(conn) >= ROLLUP_VERSION
+
+    def rollup_rows(self, rows):
+        """Rows for the rollup upserts, one per table per sensors row"""
+        rollup_tuples = {}
+        for table, width in ROLLUPS.items():
+            rollup_tuples[table] = []
+            for row in rows:
+                values = [row.get('stationid') or '', bucket(row['created'], width), 1]
+                for ch in ROLLUP_CHANNELS:
+                    value = row.get(ch)
+                    values += [0 if value is None else 1, value, value, value]
+                rollup_tuples[table].append(tuple(values))
+        return rollup_tuples
+
+    def insert_many(self, rows):
+        # Missing columns are written as NULL so rows saved by older versions can still be inserted
+        with metrics.timer('wx_db_seconds', op='insert'), self.pool.connection() as conn:
+            columns, insert = insert_columns(self.cached_version(conn))
+            try:
+                data_tuples = [tuple(row.get(column) for column in columns) for row in rows]
+                conn.statement(insert).executemany(insert, data_tuples)
+                if self.has_rollups(conn):
+                    # Rollups are updated in the same transaction so they always match the sensors table
+                    for table, rollup_tuples in self.rollup_rows(rows).items():
+                        conn.statement(self.rollup_upserts[table]).executemany(self.rollup_upserts[table], rollup_tuples)
+                conn.conn.commit()
+            except conn.data_errors + (TypeError, ValueError, KeyError):
+                conn.conn.rollback() # The connection is still good, don't leave half the batch in its transaction
+                raise
+
+    def bad_data(self, error):
+        """True if error came from the rows being written, not from the database being unreachable"""
+        return isinstance(error, self.pool.pooled.data_errors + (TypeError, ValueError, KeyError))
+
     def read_save_sensors(self, data):
-        # Create query to insert data into database
-        sensors_insert = """INSERT INTO sensors(stationid, ambient_temperature, wind_direction, wind_speed, wind_gust_speed, humidity, air_pressure, rainfall, pm25, pm10) 
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
-        # Create tuple to combine with insert statement
-        data_tuple = (data['callsign'], data['temperature'], data['wdir'], data['wspeed'], data['wgusts'], data['humidity'], round(data['pressure'], 2), data['rainfall'], data['pm25_avg'], data['pm10_avg'])
-        # Connect to database
-        conn = self.db_connect()
-        cur = conn.cursor()
-        # Execute insert statement
-        cur.execute(sensors_insert, data_tuple)
-        conn.commit()
-        conn.close()
+        self.insert_many([self.sensor_row(data)])
 
     def rain_avg(self, hours):
-        """valid arguements are 00 for since midnight, 1 for past hour, 24 for past 24 hours"""
-        if hours == 00:
-            # Queries average rainfall between now and 00:00 of today
-            query = """SELECT ROUND(AVG(rainfall), 3) FROM sensors where created between CURRENT_DATE() AND NOW();"""
-        elif hours == 1 or 24:
-            # Queries average rainfall for the past hour or 24 hours
-            query = f"SELECT ROUND(AVG(rainfall), 3) FROM sensors WHERE created <= now() - INTERVAL {hours} HOUR;"
-        else:
+        """valid arguements are 00 for since midnight, 1 for past hour, 24 for past 24 hours
+        Returns rain totals from the rollup tables if they exist"""
+        hours = int(hours)
+        if hours not in (0, 1, 24):
             raise ValueError("rain average hours must be 00, 1, or 24.")
 
-        conn = self.db_connect()
-        cur = conn.cursor()
-        cur.execute(query)
-        row = cur.fetchone()
-        if row[0] is None:
-            logging.debug(f"Query returned None: {query}")
-            query = """SELECT rainfall FROM sensors ORDER BY id DESC LIMIT 1;"""
-            logging.debug(f"Running Query: {query}")
-            cur.execute(query)
-            latest = cur.fetchone()
-            conn.close()
-            logging.debug(f"Returned: {latest[0]}")
-            return latest[0]
-        else:
-            conn.close()
-            logging.debug(f"Query successful: {query}\nReturned row: {row[0]}")
-            return row[0]
+        with metrics.timer('wx_db_seconds', op='rain_query'), self.pool.connection() as conn:
+            if self.has_rollups(conn):
+                query = self.rain_rollup_since_midnight if hours == 0 else self.rain_rollup_past_hours
+                params = () if hours == 0 else (hours,)
+                cur = conn.statement(query)
+                cur.execute(query, params)
+                row = cur.fetchone()
+                logging.debug(f"Query successful: {query}\nReturned row: {row[0]}")
+                return row[0] if row[0] is not None else 0.0 # No rollup rows means no rain was recorded
+            query = self.rain_since_midnight if hours == 0 else self.rain_past_hours
+            params = () if hours == 0 else (hours,)
+            cur = conn.statement(query)
+            cur.execute(query, params)
+            row = cur.fetchone()
+        logging.debug(f"Query successful: {query}\nReturned row: {row[0]}")
+        return row[0] if row[0] is not None else 0.0 # Totals like the rollups, no rows means no rain was recorded
+
+    def rain_history(self, hours=24):
+        """Returns rows of (created, rainfall) with rain from the past hours, used to seed the rain window"""
+        with metrics.timer('wx_db_seconds', op='rain_history'), self.pool.connection() as conn:
+            cur = conn.statement(self.rain_history_query)
+            cur.execute(self.rain_history_query, (int(hours),))
+            rows = cur.fetchall()
+        logging.debug(f"Query successful: {self.rain_history_query}\nReturned {len(rows)} rows")
+        return rows
 
     def get_all_rain_avg(self):
         all_rain_avgs = {}
@@ -79,4 +402,98 @@ class WeatherDatabase:
         logging.debug(f"\n\nRain averages collected:\nRain from now to 00:00: {all_rain_avgs['00']}")
         logging.debug(f"Rain from the past hour: {all_rain_avgs['1']}")
         logging.debug(f"Rain from the past 24 hours: {all_rain_avgs['24']}\n")
-        return all_rain_avgs
\ No newline at end of file
+        return all_rain_avgs
+
+    def aggregates(self, start, end, width='1h', station=None):
+        """Rows of {'bucket', 'samples', channel: {'count', 'min', 'max', 'sum', 'avg'}} for buckets starting
+        from start up to but not including end"""
+        params = (start, end, station) if station else (start, end)
+        with metrics.timer('wx_db_seconds', op='aggregates'), self.pool.connection() as conn:
+            query = aggregate_query(width, self.has_rollups(conn), station, self.bucket_expressions)
+            cur = conn.statement(query)
+            cur.execute(query, params)
+            rows = cur.fetchall()
+        results = []
+        for row in rows:
+            result = {'bucket': str(row[0]), 'samples': int(row[1])}
+            for i, ch in enumerate(ROLLUP_CHANNELS):
+                count, low, high, total = row[2 + i * 4:6 + i * 4]
+                count = int(count or 0)
+                result[ch] = {'count': count, 'min': number(low), 'max': number(high), 'sum': number(total),
+                    'avg': round(float(total) / count, 3) if count else None}
+            results.append(result)
+        return results
+
+    def latest(self, station=None):
+        """Newest sensors row as a dictionary, or None if there are no rows"""
+        query = SENSORS_LATEST_STATION if station else SENSORS_LATEST
+        with metrics.timer('wx_db_seconds', op='latest'), self.pool.connection() as conn:
+            cur = conn.statement(query)
+            cur.execute(query, (station,) if station else ())
+            row = cur.fetchone()
+        return None if row is None else dict(zip(SENSOR_COLUMNS, row))
+
+    def stream_cursor(self, conn):
+        # Unbuffered, so rows stay on the server until they are fetched
+        return conn.conn.cursor(buffered=False)
+
+    def stream_sensors(self, start, end, station=None, columns=SENSOR_COLUMNS):
+        """Yield sensors rows between start and end as tuples in columns order.
+        Rows are read from an unbuffered server side cursor a batch at a time, so memory use
+        doesn't depend on the size of the range. The pooled connection is held until the generator finishes."""
+        query = sensors_range(columns, station)
+        with self.pool.connection() as conn:
+            cur = self.stream_cursor(conn)
+            try:
+                cur.execute(query, (start, end, station) if station else (start, end))
+                while True:
+                    rows = cur.fetchmany(STREAM_BATCH)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cur.close()
+
+    def first_created(self):
+        """Time of the oldest sensors row, None if the table is empty"""
+        with self.pool.connection() as conn:
+            cur = conn.statement(self.sensors_first)
+            cur.execute(self.sensors_first)
+            return cur.fetchone()[0]
+
+    def last_created(self):
+        """Time of the newest sensors row, None if the table is empty"""
+        with self.pool.connection() as conn:
+            cur = conn.statement(self.sensors_last)
+            cur.execute(self.sensors_last)
+            return cur.fetchone()[0]
+
+    def count_sensors(self, start, end):
+        """Number of sensors rows from start up to end, counted on the server"""
+        with metrics.timer('wx_db_seconds', op='count'), self.pool.connection() as conn:
+            cur = conn.statement(SENSORS_COUNT_RANGE)
+            cur.execute(SENSORS_COUNT_RANGE, (start, end))
+            return cur.fetchone()[0]
+
+    def delete_sensors(self, start, end, batch=5000):
+        """Delete sensors rows from start up to end, returns how many were deleted"""
+        deleted = 0
+        while True:
+            with metrics.timer('wx_db_seconds', op='delete'), self.pool.connection() as conn:
+                cur = conn.statement(self.sensors_delete_range)
+                cur.execute(self.sensors_delete_range, (start, end, batch))
+                count = cur.rowcount
+                conn.conn.commit()
+            deleted += count
+            if count < batch:
+                return deleted
+
+    def close(self):
+        self.pool.close()
+
+def open_database(config, connect_retries=3):
+    """WeatherDatabase or SqliteDatabase for db_engine in wxstation.yaml"""
+    if config.get('db_engine', 'mariadb') == 'sqlite':
+        from sqlitedb import SqliteDatabase
+        return SqliteDatabase(config.get('db_path', 'weather.db'), pool_size=config.get('db_pool_size', 2))
+    return WeatherDatabase(password=config['db_pass'], host=config['db_host'], pool_size=config.get('db_pool_size', 2), connect_retries=connect_retries)
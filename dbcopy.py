@@ -0,0 +1,69 @@
+"""Copy readings between the MariaDB and SQLite engines, e.g. before switching db_engine:
+    python3 dbcopy.py --to sqlite [--config wxstation.yaml] [--start 2024-01-01] [--end 2025-01-01]
+    python3 dbcopy.py --to mariadb
+Both sides use the database settings in the config. The target's schema is upgraded first and rollups
+are rebuilt as rows are inserted. Without --start the copy carries on after the newest row already
+in the target, so an interrupted copy can be run again."""
+import argparse, logging
+from datetime import datetime, timedelta
+from time import monotonic
+from db import open_database, insert_columns, STREAM_BATCH
+from sqlitedb import TIME_FORMAT
+import migrate
+
+def copy_sensors(source, target, start=None, end=None, station=None, batch=STREAM_BATCH):
+    """Copy sensors rows from start up to end, returns how many were copied"""
+    target_version = migrate.upgrade(target)
+    with source.pool.connection() as conn:
+        source_version = source.cached_version(conn)
+    # Columns both schemas have, newer ones are left NULL in the target
+    columns = insert_columns(min(source_version, target_version))[0]
+    if start is None:
+        last = target.last_created()
+        start = source.first_created() if last is None else last + timedelta(seconds=1)
+        if start is None:
+            logging.info(f"No sensors rows in the {source.engine} database to copy")
+            return 0
+    end = end or datetime.now() + timedelta(seconds=1)
+    logging.info(f"Copying sensors rows from {source.engine} to {target.engine}, {start} up to {end}")
+    copied, rows, started = 0, [], monotonic()
+    for values in source.stream_sensors(start, end, station, columns):
+        row = dict(zip(columns, values))
+        row['created'] = row['created'].strftime(TIME_FORMAT) # Rollup buckets are cut from the text
+        rows.append(row)
+        if len(rows) >= batch:
+            target.insert_many(rows) # One transaction per batch
+            copied += len(rows)
+            rows = []
+            if copied % (batch * 100) == 0:
+                logging.info(f"Copied {copied} rows, up to {row['created']}")
+    if rows:
+        target.insert_many(rows)
+        copied += len(rows)
+    logging.info(f"Copied {copied} sensors rows in {round(monotonic() - started, 1)} seconds")
+    return copied
+
+if __name__ == "__main__":
+    from yaml import safe_load
+    parser = argparse.ArgumentParser(description="Copy readings between the MariaDB and SQLite databases")
+    parser.add_argument('--to', required=True, choices=('sqlite', 'mariadb'), help="Engine to copy to, the other one is copied from")
+    parser.add_argument('--config', default='wxstation.yaml', help="wxstation config file with database settings")
+    parser.add_argument('--path', help="SQLite file, overrides db_path")
+    parser.add_argument('--start', type=datetime.fromisoformat, help="Copy rows from this time, default after the newest row in the target")
+    parser.add_argument('--end', type=datetime.fromisoformat, help="Copy rows up to this time, default now")
+    parser.add_argument('--station', help="Only copy this station's rows")
+    parser.add_argument('--batch', type=int, default=STREAM_BATCH, help="Rows inserted per transaction")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as file:
+        config = safe_load(file)
+    if args.path:
+        config['db_path'] = args.path
+    source_engine = 'mariadb' if args.to == 'sqlite' else 'sqlite'
+    source = open_database(dict(config, db_engine=source_engine))
+    target = open_database(dict(config, db_engine=args.to))
+    try:
+        copy_sensors(source, target, args.start, args.end, args.station, args.batch)
+    finally:
+        source.close()
+        target.close()
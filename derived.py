@@ -0,0 +1,166 @@
+"""Readings derived from the report stream: dew point, heat index, wind chill, the 3 hour pressure
+tendency and today's temperature extremes. Each report updates rolling windows in memory, so none of
+them query the sensors table and make_packet can use them as soon as they are computed.
+Units match the data dictionary: Fahrenheit, hPa, percent and mph."""
+import json, logging, os
+from collections import deque
+from datetime import datetime
+from math import log
+from threading import Lock
+from time import time
+
+TREND_SECONDS = 3 * 3600 # Pressure tendency is the change over the past 3 hours, like synoptic reports
+TREND_TOLERANCE = 900 # Seconds short of 3 hours the oldest reading may be, so reports a little late still give a tendency
+MAGNUS_B = 17.625 # Magnus formula coefficients for saturation vapour pressure over water
+MAGNUS_C = 243.04
+
+def to_celsius(f):
+    return (f - 32) * 5 / 9
+
+def to_fahrenheit(c):
+    return c * 9 / 5 + 32
+
+def dew_point(temperature, humidity):
+    """Magnus formula, None if humidity is 0 or missing"""
+    if temperature is None or not humidity or humidity <= 0:
+        return None
+    t = to_celsius(temperature)
+    gamma = log(min(humidity, 100) / 100) + MAGNUS_B * t / (MAGNUS_C + t)
+    return to_fahrenheit(MAGNUS_C * gamma / (MAGNUS_B - gamma))
+
+def heat_index(temperature, humidity):
+    """NWS heat index, the simple formula below 80F and the Rothfusz regression with its adjustments above"""
+    if temperature is None or humidity is None:
+        return None
+    t, rh = temperature, humidity
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + rh * 0.094)
+    if (simple + t) / 2 < 80:
+        return simple
+    hi = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 0.00683783 * t * t
+        - 0.05481717 * rh * rh + 0.00122874 * t * t * rh + 0.00085282 * t * rh * rh - 0.00000199 * t * t * rh * rh)
+    if rh < 13 and 80 <= t <= 112:
+        hi -= (13 - rh) / 4 * ((17 - abs(t - 95)) / 17) ** 0.5
+    elif rh > 85 and 80 <= t <= 87:
+        hi += (rh - 85) / 10 * (87 - t) / 5
+    return hi
+
+def wind_chill(temperature, wspeed):
+    """NWS wind chill, only defined at or below 50F with at least 3 mph of wind, otherwise the temperature"""
+    if temperature is None:
+        return None
+    if temperature > 50 or wspeed is None or wspeed < 3:
+        return temperature
+    v = wspeed ** 0.16
+    return 35.74 + 0.6215 * temperature - 35.75 * v + 0.4275 * temperature * v
+
+class PressureTrend:
+    """Pressure readings of the past 3 hours plus the newest one older than that, which the tendency is measured from"""
+    def __init__(self, seconds=TREND_SECONDS, tolerance=TREND_TOLERANCE):
+        self.seconds = seconds
+        self.tolerance = tolerance
+        self.samples = deque() # (when, pressure), oldest first
+
+    def add(self, pressure, when):
+        if self.samples and when <= self.samples[-1][0]:
+            return # Clock stepped backwards or a repeated report
+        self.samples.append((when, pressure))
+        # Drop readings once the next one is also old enough to measure from
+        while len(self.samples) > 1 and self.samples[1][0] <= when - self.seconds:
+            self.samples.popleft()
+
+    def tendency(self):
+        """hPa change over the past 3 hours, None until the readings cover them"""
+        if len(self.samples) < 2:
+            return None
+        (start, old), (end, new) = self.samples[0], self.samples[-1]
+        if end - start < self.seconds - self.tolerance:
+            return None
+        return new - old
+
+class DailyExtremes:
+    """Lowest and highest reading since local midnight"""
+    def __init__(self):
+        self.day = None
+        self.low = None
+        self.high = None
+
+    def add(self, value, when):
+        day = datetime.fromtimestamp(when).date().isoformat()
+        if self.day is not None and day < self.day:
+            return # Clock stepped backwards or a late report from a day that has ended
+        if day != self.day:
+            self.day, self.low, self.high = day, value, value
+            return
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+
+class DerivedMetrics:
+    """Adds derived readings to each report's data, with optional snapshots so the windows survive restarts"""
+    def __init__(self, snapshot_path=None):
+        self.pressure = PressureTrend()
+        self.temperature = DailyExtremes()
+        self.snapshot_path = snapshot_path
+        self.lock = Lock()
+
+    def update(self, readings, when=None):
+        """Add the derived keys to readings in place and return them"""
+        when = time() if when is None else when
+        temperature, humidity, pressure = readings.get('temperature'), readings.get('humidity'), readings.get('pressure')
+        with self.lock:
+            if pressure: # 0 until the BME280 has been read
+                self.pressure.add(pressure, when)
+            if temperature is not None:
+                self.temperature.add(temperature, when)
+            derived = {
+                'dew_point': dew_point(temperature, humidity),
+                'heat_index': heat_index(temperature, humidity),
+                'wind_chill': wind_chill(temperature, readings.get('wspeed')),
+                'pressure_tendency': self.pressure.tendency(),
+                'temperature_min': self.temperature.low,
+                'temperature_max': self.temperature.high
+            }
+        readings.update({key: None if value is None else round(value, 2) for key, value in derived.items()})
+        return readings
+
+    def snapshot(self):
+        if self.snapshot_path is None:
+            return
+        with self.lock:
+            state = {
+                'pressure': list(self.pressure.samples),
+                'day': self.temperature.day,
+                'low': self.temperature.low,
+                'high': self.temperature.high
+            }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump(state, file)
+            os.replace(tmp_path, self.snapshot_path) # Atomic so a crash never leaves a partial snapshot
+        except OSError as e:
+            logging.error(f"Unable to save derived metrics snapshot to {self.snapshot_path}: {e}")
+
+    def load(self):
+        """Restore from snapshot, returns False if there is no usable snapshot"""
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                state = json.load(file)
+            samples = [(float(when), float(pressure)) for when, pressure in state['pressure']]
+            day, low, high = state['day'], state['low'], state['high']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Unable to load derived metrics snapshot {self.snapshot_path}: {e}")
+            return False
+        now = time()
+        with self.lock:
+            self.pressure.samples.clear()
+            for when, pressure in samples:
+                self.pressure.add(pressure, when)
+            # Readings from before a long stop are no use for the tendency
+            while self.pressure.samples and self.pressure.samples[-1][0] < now - self.pressure.seconds:
+                self.pressure.samples.popleft()
+            if day == datetime.fromtimestamp(now).date().isoformat():
+                self.temperature.day, self.temperature.low, self.temperature.high = day, low, high
+        logging.info(f"Loaded derived metrics snapshot from {self.snapshot_path}")
+        return True
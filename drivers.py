@@ -0,0 +1,356 @@
+"""Sensor drivers sharing one interface. Each driver samples its hardware on its own thread
+and keeps the last good reading, so reports read cached values and never wait on a sensor.
+With acquisition mode process, drivers run in worker processes instead, see acquire.py."""
+import logging, math, metrics
+from statistics import median
+from threading import Thread, Event, Lock
+from time import time, monotonic
+
+class SensorDriver:
+    name = "sensor"
+    shared_fields = None # Values a worker process publishes to shared memory, None if the driver can't run in one
+    config_keys = () # Config keys the driver reads, a worker is restarted when they change
+
+    def __init__(self, config, interval=10, max_age=None, burst=1, retry=10, max_retry=300, hardware=None, journal=None):
+        self.config = config
+        self.hardware = hardware or {} # Keyword arguments replacing the monitor's hardware, used by the simulator
+        self.journal = journal # Journal of raw samples the monitor writes to, see journal.py
+        self.interval = interval # Seconds between samples
+        self.max_age = max_age or interval * 3 # Seconds before the last good reading is stale
+        self.burst = burst # Readings per sample, combined with a median to reject spikes
+        self.retry = retry
+        self.max_retry = max_retry
+        self.opened = False
+        self.values = {} # Last good reading, keys match the report's data dictionary
+        self.updated = None # When the last good reading was taken
+        self.errors = 0
+        self.alive_until = None # monotonic() by which the driver's thread should have started its next sample
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, daemon=True, name=f"Thread-{self.name}_Driver")
+
+    def open(self):
+        """Create the hardware objects, called on the driver's thread and retried with backoff"""
+        pass
+
+    def sample(self):
+        """Read the hardware once and return a dictionary of values"""
+        raise NotImplementedError
+
+    def burst_sample(self):
+        if self.burst <= 1:
+            return self.sample()
+        readings = [self.sample() for _ in range(self.burst)]
+        return {key: median(r[key] for r in readings) for key in readings[0]}
+
+    def store(self, values):
+        values = {key: value for key, value in values.items() if value is not None}
+        if not values:
+            return # Nothing new, let the last good reading age
+        with self.lock:
+            self.values.update(values)
+            self.updated = time()
+
+    def run(self):
+        backoff = self.retry
+        while not self.stop_event.is_set():
+            try:
+                if not self.opened:
+                    start = monotonic()
+                    self.open()
+                    self.opened = True
+                    logging.info(f"{self.name} driver opened its hardware in {round(monotonic() - start, 3)} seconds")
+                with metrics.timer('wx_sensor_read_seconds', sensor=self.name):
+                    values = self.burst_sample()
+                self.store(values)
+                backoff, wait = self.retry, self.interval
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"{self.name} driver failed: {e}\n\tRetrying in {backoff} seconds. Total errors: {self.errors}")
+                backoff, wait = min(backoff * 2, self.max_retry), backoff
+            self.alive_until = monotonic() + wait
+            self.stop_event.wait(wait)
+        if self.opened:
+            try:
+                self.close()
+            except Exception as e:
+                logging.error(f"Unable to close {self.name} driver: {e}")
+
+    def read(self):
+        """Last good reading with its age, never touches the hardware"""
+        with self.lock:
+            values, updated = dict(self.values), self.updated
+        return {'values': values, 'updated': updated, 'stale': updated is None or time() - updated > self.max_age}
+
+    def report(self):
+        """Values for a report, drivers that reset per report override this"""
+        return self.read()
+
+    def shared_values(self):
+        """Values published by a worker process, called in the worker"""
+        with self.lock:
+            return dict(self.values)
+
+    @staticmethod
+    def combine(shared, reported):
+        """Report values from the newest published values and those at the last report, called in the reporting process"""
+        return shared
+
+    def reconfigure(self, interval=None, max_age=None, burst=None, retry=None, max_retry=None):
+        """Apply new options from a reloaded config, the last good reading and any accumulated readings are kept"""
+        if interval is not None:
+            self.interval = interval
+            self.max_age = max_age or interval * 3
+        elif max_age is not None:
+            self.max_age = max_age
+        self.burst = burst or self.burst
+        self.retry = retry or self.retry
+        self.max_retry = max_retry or self.max_retry
+
+    def apply_config(self, config):
+        """Update settings the monitor reads while running, called after the config is reloaded"""
+        self.config = config
+
+    def close(self):
+        """Release the hardware, called on the driver's thread once it stops"""
+        pass
+
+    def start(self):
+        logging.info(f"Starting {self.name} driver thread.")
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+class BME280Driver(SensorDriver):
+    name = "bme280"
+    shared_fields = ('temperature', 'pressure', 'humidity')
+    config_keys = ('bme280_addr',)
+
+    def __init__(self, config, interval=30, burst=3, **options):
+        super().__init__(config, interval, burst=burst, **options)
+
+    def open(self):
+        if 'sensor' in self.hardware:
+            self.sensor = self.hardware['sensor']
+            return
+        from bme280pi import Sensor
+        try:
+            self.sensor = Sensor(self.config.get('bme280_addr', 0x76))
+        except Exception as e:
+            raise RuntimeError(f"{e}\nMaybe try reloading i2c-dev and i2c_bcm2835 kernel modules?")
+        try:
+            chipid, version = self.sensor._get_info_about_sensor()
+            logging.info(f"BME280 Information:\n\tChipID: {chipid}\n\tVersion: {version}")
+        except Exception as e:
+            logging.error(f"{e}: Unable to get BME280 ChipID and Version")
+
+    def sample(self):
+        return {
+            'temperature': self.sensor.get_temperature(unit='F'),
+            'pressure': self.sensor.get_pressure(),
+            'humidity': self.sensor.get_humidity()
+        }
+
+class WindSpeedDriver(SensorDriver):
+    name = "wspeed"
+    shared_fields = ('wspeed', 'wgusts', 'wspeed10m')
+    config_keys = ('wind_buffer_size', 'report_interval')
+
+    def __init__(self, config, interval=10, **options):
+        super().__init__(config, interval, **options)
+
+    def open(self):
+        from wspeed import WindMonitor
+        self.monitor = WindMonitor(size=self.config.get('wind_buffer_size', 131072))
+        self.monitor.monitor_wind()
+        if self.journal is not None:
+            from journal import PulseFeed
+            self.feed = PulseFeed(self.journal, self.monitor)
+            self.journal.add_feed(self.feed)
+
+    def sample(self):
+        wind = self.monitor.wind(self.config['report_interval'])
+        return {'wspeed': wind['speed_2m'], 'wgusts': wind['gust'], 'wspeed10m': wind['speed_10m']}
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.remove_feed(self.feed)
+        self.monitor.close()
+
+class WindDirectionDriver(SensorDriver):
+    name = "wdir"
+    # Running sums are never reset in a worker, the reporting process averages the change since its last report
+    shared_fields = ('sin_sum', 'cos_sum', 'samples')
+    config_keys = ('wdir_sample_rate',)
+
+    def __init__(self, config, interval=10, **options):
+        super().__init__(config, interval, **options)
+
+    def open(self):
+        from wdir import WindDirectionMonitor
+        self.monitor = WindDirectionMonitor(sample_rate=self.config.get('wdir_sample_rate', 1), journal=self.journal, **self.hardware)
+        Thread(target=self.monitor.monitor, daemon=True, name="Thread-Wind_Direction").start()
+
+    def sample(self):
+        # Peek at the running mean without resetting it, report() resets it once per report
+        return {'wdir': self.monitor.average(reset=False)}
+
+    def apply_config(self, config):
+        self.config = config
+        if self.opened:
+            self.monitor.sample_rate = config.get('wdir_sample_rate', 1)
+
+    def close(self):
+        self.monitor.stop()
+
+    def report(self):
+        if self.opened:
+            self.store({'wdir': self.monitor.average()})
+        return self.read()
+
+    def shared_values(self):
+        with self.monitor.lock:
+            return {'sin_sum': self.monitor.sin_sum, 'cos_sum': self.monitor.cos_sum, 'samples': self.monitor.samples}
+
+    @staticmethod
+    def combine(shared, reported):
+        if reported is None or shared['samples'] < reported['samples']:
+            reported = {'sin_sum': 0.0, 'cos_sum': 0.0, 'samples': 0} # First report or the worker was restarted
+        if shared['samples'] == reported['samples']:
+            return {} # No readings since the last report
+        s, c = shared['sin_sum'] - reported['sin_sum'], shared['cos_sum'] - reported['cos_sum']
+        return {'wdir': round(math.degrees(math.atan2(s, c))) % 360}
+
+class RainDriver(SensorDriver):
+    name = "rain"
+
+    def __init__(self, config, interval=10, tip_callbacks=(), **options):
+        super().__init__(config, interval, **options)
+        self.tip_callbacks = list(tip_callbacks)
+
+    def open(self):
+        from rainfall import RainMonitor
+        self.monitor = RainMonitor(log_path=self.config.get('rain_log'))
+        self.monitor.tip_callbacks.extend(self.tip_callbacks)
+        self.monitor.monitor()
+
+    def sample(self):
+        return {'rain_rate': self.monitor.rain_rate()}
+
+    def close(self):
+        self.monitor.close()
+
+    def report(self):
+        if self.opened:
+            self.store({'rainfall': self.monitor.take(), 'rain_rate': self.monitor.rain_rate()}) # Tips after this are counted in the next report
+        return self.read()
+
+class AirQualityDriver(SensorDriver):
+    name = "sds011"
+    shared_fields = ('pm25_avg', 'pm10_avg')
+    config_keys = ('sds011',)
+
+    def __init__(self, config, interval=30, **options):
+        sds011 = config['sds011']
+        # A window only completes once per duty cycle, so it isn't stale until a cycle has been missed
+        cycle = sds011.get('warmup', 30) + sds011['interval'] + sds011.get('sleep', 0)
+        options.setdefault('max_age', cycle * 2)
+        super().__init__(config, interval, **options)
+
+    def open(self):
+        from pysds011 import MonitorAirQuality
+        sds011 = self.config['sds011']
+        self.monitor = MonitorAirQuality(baudrate=sds011.get('baudrate', 9600), tty=sds011.get('tty') or "/dev/ttyUSB0",
+            interval=sds011['interval'], warmup=sds011.get('warmup', 30), sleep_time=sds011.get('sleep', 0), journal=self.journal,
+            retry=self.retry, max_retry=self.max_retry, **self.hardware)
+        self.monitor.start()
+
+    def apply_config(self, config):
+        self.config = config
+        sds011 = config['sds011']
+        if self.opened:
+            # Read by the monitor at the start of every duty cycle
+            self.monitor.interval = float(sds011['interval'])
+            self.monitor.warmup = float(sds011.get('warmup', 30))
+            self.monitor.sleep_time = float(sds011.get('sleep', 0))
+        options = config.get('drivers', {}).get(self.name) or {}
+        self.max_age = options.get('max_age') or (sds011.get('warmup', 30) + sds011['interval'] + sds011.get('sleep', 0)) * 2
+
+    def close(self):
+        self.monitor.stop()
+
+    def sample(self):
+        if not self.monitor.thread.is_alive():
+            self.monitor.close_port()
+            self.opened = False # open() starts a new monitor on the next attempt
+            raise RuntimeError("SDS011 monitor thread has stopped")
+        if self.monitor.window() is None:
+            return {} # First window hasn't completed yet
+        averages = self.monitor.average()
+        return {} if averages is None else {'pm25_avg': averages[0], 'pm10_avg': averages[1]}
+
+    def store(self, values):
+        window = self.monitor.window()
+        if not values or window is None:
+            return
+        with self.lock:
+            self.values.update(values)
+            self.updated = window['finished'] # Age of the reading is the age of the window
+
+# Config key under sensors (or sds011 enabled) for each driver
+DRIVERS = {
+    'bme280': BME280Driver,
+    'wspeed': WindSpeedDriver,
+    'wdir': WindDirectionDriver,
+    'rain1h': RainDriver,
+    'sds011': AirQualityDriver
+}
+
+def enabled_drivers(config):
+    enabled = [key for key in DRIVERS if key != 'sds011' and config['sensors'].get(key)]
+    if config['sds011']['enabled']:
+        enabled.append('sds011')
+    return enabled
+
+def build_drivers(config, tip_callbacks=(), hardware=None, keys=None, journal=None):
+    """Create drivers for the enabled sensors, options come from the drivers section of the config.
+    hardware optionally maps driver keys to replacement hardware for the monitors.
+    Monitors on threads write raw samples to journal, worker processes open their own."""
+    drivers = {}
+    acquisition = config.get('acquisition') or {}
+    processes = (acquisition.get('sensors') or ()) if acquisition.get('mode') == 'process' else ()
+    for key in enabled_drivers(config) if keys is None else keys:
+        options = dict(config.get('drivers', {}).get(key) or {})
+        if key in processes and DRIVERS[key].shared_fields:
+            # Worker processes create their own hardware, or their own simulator in simulation mode
+            from acquire import ProcessDriver
+            drivers[key] = ProcessDriver(key, config, options, acquisition.get('heartbeat_timeout', 10))
+            continue
+        if key in processes:
+            logging.warning(f"{key} driver can't run in a worker process, running it on a thread")
+        if hardware and key in hardware:
+            options['hardware'] = hardware[key]
+        if key == 'rain1h':
+            options['tip_callbacks'] = tip_callbacks
+        options['journal'] = journal
+        drivers[key] = DRIVERS[key](config, **options)
+    return drivers
+
+def reload_drivers(drivers, config, tip_callbacks=(), hardware=None, journal=None):
+    """Apply a reloaded config to running drivers. Drivers for sensors that were disabled are stopped,
+    newly enabled ones are started and the rest keep running with their readings and accumulators."""
+    enabled = enabled_drivers(config)
+    for key in [key for key in drivers if key not in enabled]:
+        logging.info(f"Stopping {key} driver, it was disabled in the config")
+        drivers.pop(key).stop()
+    for key, driver in drivers.items():
+        options = config.get('drivers', {}).get(key) or {}
+        driver.reconfigure(**{name: options.get(name) for name in ('interval', 'max_age', 'burst', 'retry', 'max_retry')})
+        driver.apply_config(config)
+    added = build_drivers(config, tip_callbacks, hardware, keys=[key for key in enabled if key not in drivers], journal=journal)
+    for key, driver in added.items():
+        logging.info(f"Starting {key} driver, it was enabled in the config")
+        driver.start()
+        drivers[key] = driver
+    return drivers
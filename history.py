@@ -0,0 +1,188 @@
+"""Read API for saved readings, as Python methods and a local HTTP service.
+    curl 'localhost:9111/aggregates?start=2024-06-01&end=2024-06-02&width=1h&channels=ambient_temperature,rainfall'
+    curl 'localhost:9111/latest?station=NOCALL'
+    curl 'localhost:9111/export.csv?start=2024-01-01&end=2025-01-01' > sensors.csv
+Aggregates and latest readings are cached, so dashboards polling every few seconds don't reach MariaDB."""
+import json, logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import chain
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import monotonic
+from urllib.parse import urlparse, parse_qs
+from db import SENSOR_COLUMNS, ROLLUP_CHANNELS, AGGREGATE_WIDTHS
+
+WIDTH_SECONDS = {'1m': 60, '1h': 3600, '1d': 86400}
+MAX_BUCKETS = 2000 # Largest aggregates reply, about a day of 1m, 80 days of 1h or 5 years of 1d buckets
+
+class HistoryCache:
+    """Least recently used cache where every entry also expires after its own ttl"""
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def cached(self, key, ttl, load):
+        value = self.get(key)
+        if value is None:
+            value = load()
+            self.put(key, value, ttl)
+        return value
+
+def align(when, width):
+    """Start of the bucket holding when, days start at local midnight like the rollup tables"""
+    if width == '1d':
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    if width == '1h':
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(second=0, microsecond=0)
+
+def parse_time(value):
+    """ISO date or datetime, or seconds since the epoch"""
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+class History:
+    def __init__(self, db, cache_size=256, ttl=10, closed_ttl=3600, max_buckets=MAX_BUCKETS):
+        self.db = db
+        self.cache = HistoryCache(cache_size)
+        self.max_buckets = max_buckets # Longer ranges need a wider width, so one request can't build and cache millions of rows
+        self.ttl = ttl # Seconds to cache anything that includes the current bucket, which is still filling
+        self.closed_ttl = closed_ttl # Seconds to cache ranges entirely in the past, their buckets won't change
+
+    def aggregates(self, start, end, width='1h', station=None, channels=None):
+        """Per bucket min, max, avg, sum and count of channels from start up to end.
+        start is rounded down and end up to whole buckets, so the bucket still filling is included and
+        polls within the same bucket share a cache entry."""
+        if width not in AGGREGATE_WIDTHS:
+            raise ValueError(f"width must be one of {', '.join(AGGREGATE_WIDTHS)}")
+        start = align(start, width)
+        aligned = align(end, width)
+        end = aligned if aligned == end else aligned + timedelta(seconds=WIDTH_SECONDS[width])
+        if end <= start:
+            end = start + timedelta(seconds=WIDTH_SECONDS[width])
+        buckets = (end - start).total_seconds() / WIDTH_SECONDS[width]
+        if buckets > self.max_buckets:
+            raise ValueError(f"{int(buckets)} buckets of {width} requested, at most {self.max_buckets} are returned, use a wider width or a shorter range")
+        current = align(datetime.now(), width)
+        ttl = self.ttl if end > current else self.closed_ttl
+        key = ('aggregates', station, width, start, end)
+        rows = self.cache.cached(key, ttl, lambda: self.db.aggregates(start, end, width, station))
+        if channels is None:
+            return rows
+        return [dict({'bucket': row['bucket'], 'samples': row['samples']}, **{ch: row[ch] for ch in channels}) for row in rows]
+
+    def latest(self, station=None):
+        return self.cache.cached(('latest', station), self.ttl, lambda: self.db.latest(station))
+
+    def export(self, start, end, station=None):
+        """Every sensors row from start up to end, streamed and never cached"""
+        return self.db.stream_sensors(start, end, station)
+
+def csv_value(value):
+    if value is None:
+        return ""
+    return str(value)
+
+class HistoryHandler(BaseHTTPRequestHandler):
+    history = None
+
+    def do_GET(self):
+        self.replied = False # Set once a 200 has been sent, errors after that can't be replied to
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            end = parse_time(query['end']) if 'end' in query else datetime.now()
+            start = parse_time(query['start']) if 'start' in query else end - timedelta(days=1)
+            station = query.get('station')
+            if url.path == '/aggregates':
+                channels = query['channels'].split(',') if 'channels' in query else None
+                unknown = set(channels or ()) - set(ROLLUP_CHANNELS)
+                if unknown:
+                    raise ValueError(f"unknown channels {', '.join(sorted(unknown))}, choose from {', '.join(ROLLUP_CHANNELS)}")
+                self.reply_json(self.history.aggregates(start, end, query.get('width', '1h'), station, channels))
+            elif url.path == '/latest':
+                self.reply_json(self.history.latest(station))
+            elif url.path in ('/export.csv', '/export.ndjson'):
+                self.stream(url.path.endswith('.csv'), self.history.export(start, end, station))
+            else:
+                self.send_error(404, "Try /aggregates, /latest, /export.csv or /export.ndjson")
+        except Exception as e:
+            if self.replied:
+                # A second status line would end up in the body, drop the connection so the client sees it was cut short
+                logging.error(f"History request {self.path} failed after the response started: {e}")
+                self.close_connection = True
+            elif isinstance(e, (ValueError, KeyError)):
+                self.send_error(400, str(e))
+            else:
+                logging.exception(f"History request {self.path} failed: {e}")
+                self.send_error(500, str(e))
+
+    def reply_json(self, value):
+        body = json.dumps(value, default=str).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.replied = True
+        self.wfile.write(body)
+
+    def stream(self, csv, rows):
+        """Write rows as they are read, the response ends when the connection closes"""
+        rows = iter(rows)
+        first = next(rows, None) # Fail before the headers are sent if the query can't run
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv" if csv else "application/x-ndjson")
+        self.end_headers()
+        self.replied = True
+        lines = [",".join(SENSOR_COLUMNS)] if csv else []
+        for row in ([] if first is None else chain([first], rows)):
+            if csv:
+                lines.append(",".join(csv_value(value) for value in row))
+            else:
+                lines.append(json.dumps(dict(zip(SENSOR_COLUMNS, row)), default=str))
+            if len(lines) >= 500:
+                self.wfile.write(("\n".join(lines) + "\n").encode())
+                lines = []
+        if lines:
+            self.wfile.write(("\n".join(lines) + "\n").encode())
+
+    def log_message(self, format, *args):
+        logging.debug(f"History request from {self.address_string()}: {format % args}")
+
+class HistoryServer:
+    """Serves the history API on a daemon thread, bound to localhost by default"""
+    def __init__(self, history, port=9111, host="127.0.0.1"):
+        HistoryHandler.history = history
+        self.server = ThreadingHTTPServer((host, port), HistoryHandler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True, name="Thread-History")
+
+    def start(self):
+        self.thread.start()
+        logging.info(f"Serving history on http://{self.server.server_address[0]}:{self.server.server_address[1]}/")
+
+    def stop(self):
+        self.server.shutdown()
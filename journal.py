@@ -0,0 +1,318 @@
+"""Append-only journal of raw samples: the speed of every anemometer pulse, every wind vane reading and
+every SDS011 frame, which reports otherwise reduce to one row per report_interval.
+Samples are fixed width records of time, channel and value, each with its own CRC, in segment files
+under path. They are buffered in memory and written together with one fsync every flush_interval,
+so the SD card sees a few large writes instead of one per sample. Segments rotate by size and age
+and the oldest are deleted once the journal outgrows max_mb.
+    python3 journal.py [--path journal] [--start 2025-01-01T12:00] [--end 2025-01-01T13:00] [--channel wdir]"""
+import argparse, heapq, logging, mmap, os, struct, zlib
+from bisect import bisect_left
+from datetime import datetime
+from threading import Thread, Event, Lock
+from time import time, monotonic
+import metrics
+
+# Channel numbers are stored in every record, never renumber them
+CHANNELS = {'wind_speed': 1, 'wdir': 2, 'pm25': 3, 'pm10': 4}
+CHANNEL_NAMES = {number: name for name, number in CHANNELS.items()}
+MAGIC = b'WXJ1'
+HEADER = struct.Struct('<4sHHddI4x') # Magic, format version, record size, segment start time, seconds samples may be late, CRC of the fields before it
+BODY = struct.Struct('<dHxxd') # Epoch time, channel, value
+RECORD = struct.Struct('<dHxxdI') # The body followed by its CRC, 24 bytes
+SUFFIX = '.wxj'
+MAX_FLUSH_INTERVAL = 300
+LATE_SECONDS = 2 * MAX_FLUSH_INTERVAL # Samples are written up to two flush intervals after they were taken, readers look this far into the previous segment
+
+def pack_record(when, channel, value):
+    body = BODY.pack(when, channel, value)
+    return body + struct.pack('<I', zlib.crc32(body))
+
+def segment_name(name, millis):
+    return f"{name}-{millis}{SUFFIX}"
+
+def list_segments(path, name=None):
+    """(start time, writer name, file path) of the segments in path, oldest first"""
+    segments = []
+    try:
+        files = os.listdir(path)
+    except FileNotFoundError:
+        return segments
+    for file in files:
+        writer, _, started = file[:-len(SUFFIX)].rpartition('-')
+        if not file.endswith(SUFFIX) or not started.isdigit() or (name is not None and writer != name):
+            continue
+        segments.append((int(started) / 1000, writer, os.path.join(path, file)))
+    return sorted(segments)
+
+class PulseFeed:
+    """Journals the speed of each anemometer pulse from the time since the pulse before it. Called by the
+    journal before each flush, so the pulse callback never does more than store the time."""
+    def __init__(self, journal, monitor):
+        self.journal = journal
+        self.monitor = monitor
+        self.count = monitor.count
+        self.last = None
+
+    def __call__(self):
+        times, self.count = self.monitor.pulses_since(self.count)
+        offset = time() - monotonic() # Pulse times are from monotonic()
+        samples = []
+        for t in times:
+            if self.last is not None and t > self.last:
+                samples.append((t + offset, self.monitor.speed(1, t - self.last)))
+            self.last = t
+        self.journal.extend('wind_speed', samples)
+
+class Journal:
+    """Writer of one set of segments, named so the station and each worker process keep their own"""
+    def __init__(self, path="journal", name="station", flush_interval=10, segment_bytes=4 << 20, segment_seconds=86400,
+            max_bytes=1 << 30, max_pending=200_000):
+        self.path = path
+        self.name = name
+        self.flush_interval = flush_interval # Seconds between group commits
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes # Size of this writer's segments before the oldest are deleted
+        self.max_pending = max_pending # Samples held in memory, newer ones are dropped if writes fall behind
+        self.pending = [] # (time, channel number, value) since the last flush
+        self.feeds = [] # Called before each flush to journal samples their monitors keep themselves
+        self.segment = None
+        self.segment_started = None
+        self.segment_size = 0
+        self.records = 0
+        self.dropped = 0
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, daemon=True, name="Thread-Journal")
+
+    @classmethod
+    def from_config(cls, journal_config, name="station"):
+        return cls(journal_config.get('path', 'journal'), name, journal_config.get('flush_interval', 10),
+            int(journal_config.get('segment_mb', 4) * (1 << 20)), journal_config.get('segment_hours', 24) * 3600,
+            int(journal_config.get('max_mb', 1024) * (1 << 20)))
+
+    def append(self, channel, value, when=None):
+        """Queue one sample, safe to call from any thread"""
+        if value is None:
+            return
+        when = time() if when is None else when
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append((when, CHANNELS[channel], value))
+
+    def extend(self, channel, samples):
+        """Queue (time, value) samples of one channel"""
+        number = CHANNELS[channel]
+        with self.lock:
+            room = self.max_pending - len(self.pending)
+            self.pending.extend((when, number, value) for when, value in samples[:room])
+            self.dropped += max(len(samples) - room, 0)
+
+    def add_feed(self, feed):
+        self.feeds.append(feed)
+
+    def remove_feed(self, feed):
+        if feed in self.feeds:
+            self.feeds.remove(feed)
+
+    def open_segment(self, started):
+        os.makedirs(self.path, exist_ok=True)
+        millis = int(started * 1000)
+        while True:
+            path = os.path.join(self.path, segment_name(self.name, millis))
+            try:
+                self.segment = open(path, 'xb') # Never appended to, a crash can only leave a partial record at the end
+                break
+            except FileExistsError:
+                millis += 1 # Rotated within the same millisecond, the next name still sorts in order
+        fields = (MAGIC, 1, RECORD.size, started, 2 * self.flush_interval)
+        self.segment.write(HEADER.pack(*fields, zlib.crc32(HEADER.pack(*fields, 0)[:24])))
+        self.segment_started = started
+        self.segment_size = HEADER.size
+        # Make the new file's directory entry durable too
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        logging.debug(f"Opened journal segment {path}")
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+            self.prune()
+
+    def prune(self):
+        """Delete this writer's oldest segments until they fit in max_bytes, called once its segment is closed"""
+        segments = list_segments(self.path, self.name)
+        sizes = []
+        for started, _, path in segments:
+            try:
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes)
+        for (started, _, path), size in zip(segments, sizes):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                logging.info(f"Deleted journal segment {path}, the journal is over {self.max_bytes >> 20} MiB")
+            except OSError as e:
+                logging.error(f"Unable to delete journal segment {path}: {e}")
+            total -= size
+
+    def flush(self):
+        """Write everything queued with one write and one fsync, returns how many samples were written"""
+        with self.flush_lock:
+            for feed in list(self.feeds):
+                try:
+                    feed()
+                except Exception as e:
+                    logging.error(f"Journal feed failed: {e}")
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            batch.sort() # Segments stay close to time order, which readers sort quickly
+            data = b''.join([pack_record(*sample) for sample in batch])
+            now = time()
+            try:
+                with metrics.timer('wx_journal_flush_seconds'):
+                    if self.segment is not None and (self.segment_size >= self.segment_bytes or now - self.segment_started >= self.segment_seconds):
+                        self.close_segment()
+                    if self.segment is None:
+                        self.open_segment(min(batch[0][0], now)) # Named after its oldest sample so readers can find it
+                    self.segment.write(data)
+                    self.segment.flush()
+                    os.fsync(self.segment.fileno())
+            except OSError as e:
+                logging.error(f"Unable to write {len(batch)} samples to the journal: {e}")
+                with self.lock:
+                    self.dropped += len(batch)
+                try:
+                    self.close_segment() # A partial write would misalign the records after it, start a new segment
+                except OSError:
+                    self.segment = None
+                return 0
+            self.segment_size += len(data)
+            self.records += len(batch)
+            return len(batch)
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+        self.close_segment()
+
+    def start(self):
+        logging.info(f"Journaling raw samples to {self.path} every {self.flush_interval} seconds")
+        self.thread.start()
+
+    def stop(self):
+        """Flush what is queued and close the segment"""
+        self.stop_event.set()
+        self.thread.join(30)
+
+def first_record(view, count, when, late):
+    """Index to start reading from for samples at or after when. Records are in time order apart from
+    samples written late, at most late seconds, so the search looks that far earlier."""
+    target = when - late
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = HEADER.size + mid * RECORD.size
+        time, _, _, crc = RECORD.unpack_from(view, offset)
+        # A corrupt record moves the search earlier, never past samples in range
+        if time < target and zlib.crc32(view[offset:offset + BODY.size]) == crc:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def read_segment(path, start, end, channels):
+    """Samples of a segment from start up to end, sorted by time. Records failing their CRC are skipped."""
+    samples, corrupt = [], 0
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < HEADER.size:
+            return samples
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, version, record_size, started, late, crc = HEADER.unpack_from(mapped)
+            if magic != MAGIC or record_size != RECORD.size or zlib.crc32(mapped[:24]) != crc:
+                logging.error(f"{path} is not a journal segment, skipping it")
+                return samples
+            view = memoryview(mapped)
+            try:
+                count = (size - HEADER.size) // RECORD.size # Whole records only, a crash can leave a partial one at the end
+                offset = HEADER.size + first_record(view, count, start, late) * RECORD.size
+                records = view[offset:HEADER.size + count * RECORD.size]
+                rows = RECORD.iter_unpack(records)
+                try:
+                    stop = end + late # Every record after one this new is at or after end
+                    for when, channel, value, crc in rows:
+                        wanted = start <= when < end and (channels is None or channel in channels)
+                        # Only records passing their CRC are used, a corrupt time must not end the scan early
+                        if wanted or when >= stop:
+                            if zlib.crc32(view[offset:offset + BODY.size]) != crc:
+                                corrupt += 1
+                            elif wanted:
+                                samples.append((when, channel, value))
+                            else:
+                                break
+                        offset += RECORD.size
+                finally:
+                    del rows # The iterator holds records open until it is freed
+                    records.release()
+            finally:
+                view.release()
+    if corrupt:
+        logging.warning(f"Skipped {corrupt} corrupt records in {path}")
+    samples.sort()
+    return samples
+
+def writer_samples(segments, start, end, channels):
+    """Samples of one writer's segments in time order, reading one segment at a time"""
+    carry = []
+    for i, (started, file) in enumerate(segments):
+        merged = list(heapq.merge(carry, read_segment(file, start, end, channels)))
+        # Later segments only hold samples from after the next one started, less LATE_SECONDS
+        following = segments[i + 1][0] - LATE_SECONDS if i + 1 < len(segments) else float('inf')
+        done = bisect_left(merged, (following,))
+        yield from merged[:done]
+        carry = merged[done:]
+    yield from carry
+
+def read_journal(path="journal", start=None, end=None, channels=None):
+    """Yield (time, channel name, value) from every writer's segments, from start up to end in time order.
+    start and end are epoch seconds, channels is a list of channel names."""
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    numbers = None if channels is None else {CHANNELS[channel] for channel in channels}
+    writers = {}
+    for started, writer, file in list_segments(path):
+        writers.setdefault(writer, []).append((started, file))
+    streams = []
+    for segments in writers.values():
+        # A segment holds samples from a little before it started up to a little after the next one started
+        selected = [(started, file) for i, (started, file) in enumerate(segments) if started - LATE_SECONDS < end
+            and (segments[i + 1][0] if i + 1 < len(segments) else float('inf')) + LATE_SECONDS > start]
+        streams.append(writer_samples(selected, start, end, numbers))
+    for when, channel, value in heapq.merge(*streams):
+        yield when, CHANNEL_NAMES.get(channel, str(channel)), value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print journaled raw samples as CSV")
+    parser.add_argument('--path', default='journal', help="Journal directory")
+    parser.add_argument('--start', type=datetime.fromisoformat, help="Samples from this local time")
+    parser.add_argument('--end', type=datetime.fromisoformat, help="Samples before this local time")
+    parser.add_argument('--channel', action='append', choices=sorted(CHANNELS), help="Only this channel, can be repeated")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print("time,channel,value")
+    for when, channel, value in read_journal(args.path, args.start and args.start.timestamp(), args.end and args.end.timestamp(), args.channel):
+        print(f"{datetime.fromtimestamp(when).isoformat(timespec='milliseconds')},{channel},{value}")
@@ -0,0 +1,90 @@
+"""Load generator for collector.py. Simulates many stations pushing frames over UDP or HTTP
+and reports the rate sent and what the collector accepted.
+    python3 loadgen.py --stations 5000 --rate 2000 --duration 30
+Without --target an in process collector without a database is started and measured too."""
+import argparse, logging, random, socket
+from threading import Thread
+from time import monotonic, sleep, time
+from collector import Collector, StationPusher, encode_frame, UDP_PORT, HTTP_PORT
+
+def station_frames(stations, seq):
+    """One report from every station, with a little variety in the readings"""
+    for n in range(stations):
+        data = {'temperature': random.uniform(20, 90), 'wdir': random.randint(0, 359), 'wspeed': random.uniform(0, 30),
+            'wgusts': random.uniform(0, 40), 'humidity': random.uniform(10, 100), 'pressure': random.uniform(980, 1040),
+            'rainfall': random.choice((0, 0, 0, 0.011)), 'rain1h': 0.0, 'rain24h': 0.0, 'rain00m': 0.0}
+        yield encode_frame(f"LG{n:05d}", seq, time(), data)
+
+def run_udp(address, stations, rate, duration, duplicates):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = datagrams = seq = 0
+    start = next_send = monotonic()
+    while monotonic() - start < duration:
+        for frame in station_frames(stations, seq):
+            now = monotonic()
+            if now - start >= duration:
+                break
+            if next_send > now:
+                sleep(next_send - now)
+            # Retransmits, as a station repeating its last frames would send them
+            payload = frame * 2 if random.random() < duplicates else frame
+            sock.sendto(payload, address)
+            sent += 1
+            datagrams += 1
+            next_send += 1 / rate
+        seq += 1
+    return sent, datagrams, monotonic() - start
+
+def run_http(url, stations, rate, duration, batch):
+    """Each post carries batch frames, as stations catching up on a backlog would send"""
+    pusher = StationPusher("LOADGEN", url)
+    sent = posts = seq = 0
+    start = next_send = monotonic()
+    frames = []
+    while monotonic() - start < duration:
+        for frame in station_frames(stations, seq):
+            if monotonic() - start >= duration:
+                break
+            frames.append(frame)
+            if len(frames) < batch:
+                continue
+            now = monotonic()
+            if next_send > now:
+                sleep(next_send - now)
+            pusher.pending.extend(frames)
+            pusher.flush()
+            sent += len(frames)
+            posts += 1
+            frames = []
+            next_send += batch / rate
+        seq += 1
+    return sent, posts, monotonic() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Push frames from many simulated stations to a collector")
+    parser.add_argument('--stations', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1000, help="Frames per second")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run for")
+    parser.add_argument('--transport', choices=('udp', 'http'), default='udp')
+    parser.add_argument('--target', help="Collector host, an in process collector is started if not given")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="Fraction of UDP frames sent twice")
+    parser.add_argument('--batch', type=int, default=50, help="Frames per HTTP post")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    collector = None
+    host = args.target or "127.0.0.1"
+    if args.target is None:
+        collector = Collector()
+        collector.start(host, UDP_PORT, HTTP_PORT)
+        sleep(0.5)
+    if args.transport == 'udp':
+        sent, messages, elapsed = run_udp((host, UDP_PORT), args.stations, args.rate, args.duration, args.duplicates)
+    else:
+        sent, messages, elapsed = run_http(f"http://{host}:{HTTP_PORT}/ingest", args.stations, args.rate, args.duration, args.batch)
+    print(f"Sent {sent} frames in {messages} {args.transport} messages over {round(elapsed, 2)} seconds, {round(sent / elapsed)} frames per second")
+    if collector is not None:
+        sleep(1) # Let the collector finish what is buffered
+        stats = collector.stats
+        print(f"Collector: {stats['accepted']} accepted ({round(stats['accepted'] / elapsed)} per second), {stats['duplicates']} duplicates dropped, "
+            f"{stats['invalid']} invalid, {sent - stats['accepted']} lost, {len(collector.state)} stations")
+        collector.stop()
@@ -1,9 +1,19 @@
-from statistics import mean
-import logging, threading as th
-from time import sleep, time
-from db import WeatherDatabase
+import logging, metrics, threading as th
+from concurrent.futures import ThreadPoolExecutor
+from time import time, monotonic
 from aprs import SendAprs
+from rainwindow import RainWindow
+from scheduler import ReportScheduler, Stage
+from drivers import build_drivers, reload_drivers
+from configwatch import ConfigWatcher, validate_config, restart_changes
+from qc import QualityControl, pack_flags
+from derived import DerivedMetrics
 from yaml import safe_load
+# db (mariadb or sqlite), uplink (aprslib) and the sensor modules (gpiozero) are imported during startup, in parallel
+
+CONFIG_FILE = 'wxstation.yaml'
+# Settings of the APRS-IS sessions, changing any of them logs in again with a new uplink
+UPLINK_KEYS = ('callsign', 'passwd', 'servers', 'port', 'timeout', 'keepalive', 'sendall')
 
 data = {
     'callsign': "",
@@ -16,41 +26,12 @@ data = {
     'pm25_avg': 0,
     'pm10_avg': 0,
     'rainfall': 0,
+    'rain_rate': 0,
     'pressure' : 0,
     'temperature' : 0,
     'humidity' : 0
 }
 
-def start_bme280(address=0x76):
-    from bme280pi import Sensor
-    while True:
-        try:
-            sensor = Sensor(address)
-            break
-        except Exception as e:
-            logging.critical(f"Exception occured, {e}\nMaybe try reloading i2c-dev and i2c_bcm2835 kernel modules?")
-            logging.error(f"Waiting 10 seconds before retrying...")
-            sleep(10)
-            logging.error(f"Trying to start bme280 again.")
-            continue
-    try:
-        chipid, version = sensor._get_info_about_sensor()
-        logging.info(f"BME280 Information:\n\tChipID: {chipid}\n\tVersion: {version}")
-    except Exception as e:
-        logging.error(f"{e}: Unable to get BME280 ChipID and Version")
-    return sensor
-
-def wait_delay(start_time, interval):
-        end_time = time() # Capture end time
-        elapsed_time = end_time - start_time
-        wait_time = round(interval - elapsed_time, 2) # Calculate time to wait before restart loop
-        if wait_time < 0:
-            logging.error(f"WARNING: Minutes past since last report: {round(elapsed_time / 60, 2)}\n\
-                This is longer than the interval period of {interval / 60} minutes.")
-            wait_time = 0
-        logging.info(f"Generating next report in {round((wait_time / 60), 2)} minutes")
-        sleep(wait_time) # Flush buffered output and wait for seconds in wxstation.yaml report_interval:
-
 def parse_config(config_file):
     try:
         logging.info(f"Reading {config_file}.")
@@ -76,118 +57,255 @@ def gen_random_data():
     data['humidity'] = randint(0, 100)
     data['rainfall'] = randint(0, 5)
 
+def collect_readings():
+    """Read every sensor into data, runs on the collect stage's thread"""
+    if config['dev_mode']:
+        gen_random_data()
+        rain_window.add(data['rainfall'])
+
+    for name, driver in drivers.items():
+        reading = driver.report() # Cached last good values, never waits on the hardware
+        data.update(reading['values'])
+        if reading['stale']:
+            logging.warning(f"{name} reading is stale, last good reading was at {reading['updated']}")
+
+def report(report_time):
+    # Collect readings then hand a copy to the persist and uplink stages so they run concurrently
+    collect_readings()
+    readings = data.copy()
+    if quality is not None:
+        # Repair or flag bad readings before they are saved or sent, the flags are saved with the row
+        readings['qc_flags'] = pack_flags(quality.apply(readings))
+    # Dew point, pressure tendency and the rest from the rolling windows, saved and sent with the readings
+    derived.update(readings)
+    stages['persist'].submit(readings)
+    stages['uplink'].submit(readings)
+
+def persist(readings):
+    if pusher is not None:
+        pusher.push(readings, rain_window.totals()) # The collector saves it for this station
+    else:
+        db_writer.put(readings) # Saved to the database in the background
+    rain_window.snapshot()
+    derived.snapshot()
+
 def init_objects():
-    sensors = {}
-    threads = {}
-    # Create bme280 object if enabled        
-    if config['sensors']['bme280']:
-        sensors['bme280'] = start_bme280(config['bme280_addr'])
-    # Create bme280 object if enabled
-    if config['sensors']['rain1h']:
-        from rainfall import RainMonitor
-        sensors['rmonitor'] = RainMonitor()
-        logging.info("Starting rainfall monitoring thread.")
-        threads['rain'] = th.Thread(target=sensors['rmonitor'].monitor, daemon=True, name="Thread-Rain_Monitor")
-        threads['rain'].start()
-    if config['sensors']['wspeed']:
-        from wspeed import WindMonitor
-        sensors['wmonitor'] = WindMonitor()
-        logging.info("Starting wind speed monitoring thread.")
-        stop_event = th.Event()
-        threads['wmonitor'] = th.Thread(target=sensors['wmonitor'].monitor_wind, daemon=True, name="Thread-Wind_Monitor")
-        threads['wspeed'] = th.Thread(target=sensors['wmonitor'].calculate_speed, args=[stop_event], daemon=True, name="Thread-Wind_Speed")
-        threads['wmonitor'].start()
-        threads['wspeed'].start()
-    if config['sensors']['wdir']:
-        from wdir import WindDirectionMonitor
-        sensors['wdir_monitor'] = WindDirectionMonitor()
-        logging.info("Starting wind direction monitoring thread.")
-        threads['wdir'] = th.Thread(target=sensors['wdir_monitor'].monitor, daemon=True, name="Thread-Wind_Direction")
-        threads['wdir'].start()
-    if config['sds011']['enabled']:
-        from pysds011 import MonitorAirQuality
-        logging.info("Loading AirQuality monitoring modules.")
-        if config['sds011']['tty'] in config and config['sds011']['tty'] is not None:
-            sensors['air_monitor'] = MonitorAirQuality(tty=config['sds011']['tty'], interval=config['sds011']['interval'])
-        else:
-            sensors['air_monitor'] = MonitorAirQuality(interval=config['sds011']['interval'])
-    return sensors, threads
+    global hardware
+    if config.get('simulate'):
+        # Run the real monitors against simulated hardware and weather
+        from simulate import Simulator
+        simulator = Simulator.from_config(config)
+        simulator.start()
+        hardware = simulator.hardware()
+        logging.warning(f"Simulation mode is enabled, readings are not real: {config['simulate']}")
+    # Rolling rain totals are kept up to date on every tip
+    drivers = build_drivers(config, tip_callbacks=[rain_window.add], hardware=hardware, journal=journal)
+    for driver in drivers.values():
+        driver.start()
+    return drivers
+
+def timed(name, func, *args):
+    """Run one startup phase, recording how long it took"""
+    start = monotonic()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = monotonic() - start
+
+def start_database():
+    from db import open_database
+    from writebehind import WriteBehindQueue
+    # Connect once per attempt, the write behind queue retries with backoff instead of sleeping
+    db = open_database(config, connect_retries=1)
+    queue_config = config.get('db_queue', {})
+    db_writer = WriteBehindQueue(db, spool_path=queue_config.get('spool', 'sensors_spool.db'), maxsize=queue_config.get('size', 1000),
+        batch_size=queue_config.get('batch_size', 50), flush_interval=queue_config.get('flush_interval', 5))
+    if pusher is None:
+        if config.get('db_migrate', True):
+            import migrate
+            try:
+                migrate.upgrade(db)
+            except Exception as e:
+                logging.error(f"Unable to upgrade database schema, continuing with the current schema: {e}")
+        if not rain_loaded:
+            # Seed rolling rain totals from the database once if there was no snapshot
+            try:
+                rain_window.seed(db.rain_history(24))
+            except Exception as e:
+                logging.error(f"Unable to seed rain window from the database, starting from zero: {e}")
+    db_writer.start()
+    return db, db_writer
+
+def start_uplink(aprs_config):
+    # Log in to the APRS-IS servers now so the first report doesn't wait for it
+    from uplink import AprsUplink
+    uplink = AprsUplink.from_config(aprs_config)
+    uplink.start()
+    return uplink
+
+def start_services():
+    """Optional services reading the database, started once it exists"""
+    if (config.get('archive') or {}).get('enabled', False) and pusher is None:
+        # Move closed days of readings to columnar files, needs numpy
+        import archive
+        archive.from_config(db, config).start()
+    history_config = config.get('history') or {}
+    history = None
+    if history_config.get('enabled', False):
+        # Read API over the saved readings for dashboards and exports
+        from history import History, HistoryServer
+        history = History(db, history_config.get('cache_size', 256), history_config.get('ttl', 10),
+            max_buckets=history_config.get('max_buckets', 2000))
+        try:
+            HistoryServer(history, history_config.get('port', 9111), history_config.get('host', "127.0.0.1")).start()
+        except OSError as e:
+            logging.error(f"Unable to start the history service, continuing without it: {e}")
+    metrics_config = config.get('metrics') or {}
+    if metrics_config.get('enabled', False):
+        register_metrics(history)
+        try:
+            metrics.MetricsServer.from_config(metrics_config).start()
+        except OSError as e:
+            logging.error(f"Unable to start the metrics endpoint, continuing without it: {e}")
+
+def create_journal():
+    journal_config = config.get('journal') or {}
+    if not journal_config.get('enabled', False):
+        return None
+    # Raw samples from the monitors, written to segment files in batches
+    from journal import Journal
+    journal = Journal.from_config(journal_config)
+    journal.start()
+    return journal
+
+def create_quality_control():
+    qc_config = config.get('qc') or {}
+    return QualityControl.from_config(qc_config, config['report_interval']) if qc_config.get('enabled', True) else None
+
+def apply_config(new_config):
+    """Apply a reloaded and validated config. Drivers, the rain window and the wind and rain
+    monitors keep running, so accumulated readings aren't lost."""
+    global drivers, quality
+    old_config = dict(config)
+    # Everything holding config, such as the drivers and the uplink stage, sees the new values.
+    # Updated in place without emptying it first, stages reading it meanwhile see the old or new value of every key.
+    config.update(new_config)
+    for key in [key for key in config if key not in new_config]:
+        del config[key]
+    if config['report_interval'] != old_config['report_interval']:
+        logging.info(f"Report interval changed from {old_config['report_interval']} to {config['report_interval']} seconds")
+        scheduler.interval = config['report_interval']
+    rain_window.snapshot_path = config.get('rain_snapshot')
+    derived.snapshot_path = config.get('derived_snapshot')
+    old_aprs, new_aprs = old_config['aprs'], config['aprs']
+    if any(old_aprs.get(key) != new_aprs.get(key) for key in UPLINK_KEYS):
+        old_uplink = aprs.uplink
+        aprs.uplink = start_uplink(new_aprs) if new_aprs['sendall'] else None
+        if old_uplink is not None:
+            old_uplink.stop()
+        logging.info(f"APRS-IS settings changed, now sending to {list(new_aprs['servers']) if new_aprs['sendall'] else 'no servers'}")
+    if config['dev_mode'] is False and old_config['dev_mode'] is False:
+        drivers = reload_drivers(drivers, config, tip_callbacks=[rain_window.add], hardware=hardware, journal=journal)
+    if config.get('qc') != old_config.get('qc') or config['report_interval'] != old_config['report_interval']:
+        logging.info("Quality control settings changed, filters start again from the next report")
+        quality = create_quality_control()
+    changed = restart_changes(old_config, config)
+    if changed:
+        logging.warning(f"Changes to {', '.join(changed)} only take effect after a restart")
+
+def monitor_attr(key, attr, default=None):
+    """Value kept by a driver's monitor, None until the driver has opened its hardware"""
+    driver = drivers.get(key)
+    if driver is None or not driver.opened or driver.monitor is None: # No monitor in this process for drivers in worker processes
+        return default
+    return getattr(driver.monitor, attr)
+
+def register_metrics(history=None):
+    """Counters and gauges read from the running objects whenever the endpoint is scraped"""
+    metrics.describe('wx_stage_seconds', "Time taken by each report pipeline stage")
+    metrics.describe('wx_report_delay_seconds', "How late each report started after its scheduled time")
+    metrics.describe('wx_sensor_read_seconds', "Time taken to read each sensor's hardware")
+    metrics.describe('wx_db_seconds', "Time taken by database inserts and rain queries")
+    metrics.describe('wx_packet_build_seconds', "Time taken to build the APRS packet")
+    metrics.describe('wx_aprs_send_seconds', "Time taken to send a packet to each APRS-IS server")
+    metrics.describe('wx_journal_flush_seconds', "Time taken to write and fsync each batch of journaled samples")
+    registry = metrics.REGISTRY
+    registry.counter('wx_driver_errors_total', "Failed sensor reads", lambda: {name: d.errors for name, d in drivers.items()}, 'sensor')
+    registry.gauge('wx_reading_age_seconds', "Age of each sensor's last good reading",
+        lambda: {name: time() - d.updated for name, d in drivers.items() if d.updated is not None}, 'sensor')
+    registry.gauge('wx_reading_stale', "1 if a sensor's last good reading is stale", lambda: {name: d.read()['stale'] for name, d in drivers.items()}, 'sensor')
+    registry.counter('wx_wdir_failed_total', "Wind direction readings not matching a vane position", lambda: monitor_attr('wdir', 'failed_count'))
+    registry.counter('wx_wind_pulses_total', "Anemometer pulses recorded", lambda: monitor_attr('wspeed', 'count'))
+    registry.counter('wx_rain_tips_total', "Rain gauge tips recorded", lambda: monitor_attr('rain1h', 'tips'))
+    registry.counter('wx_pm_errors_total', "SDS011 readings rejected, by error", lambda: {key: value for key, value in
+        (monitor_attr('sds011', 'air_values') or {}).items() if key.endswith('errors')}, 'error')
+    registry.counter('wx_stage_overruns_total', "Stage runs skipped because the previous run was still busy",
+        lambda: {stage.name: stage.overruns for stage in stages.values()}, 'stage')
+    registry.gauge('wx_db_queue_depth', "Sensors rows waiting in memory to be written", db_writer.depth)
+    registry.gauge('wx_db_spool_rows', "Sensors rows spooled to disk while the database is unreachable", db_writer.spool.pending)
+    registry.gauge('wx_db_rejected_rows', "Sensors rows the database rejected as bad data, kept in the spool's rejected table", db_writer.spool.rejected)
+    if aprs.uplink is not None:
+        sessions = aprs.uplink.sessions
+        registry.counter('wx_aprs_connects_total', "APRS-IS logins, more than one means reconnects",
+            lambda: {name: s.stats['connects'] for name, s in sessions.items()}, 'server')
+        registry.counter('wx_aprs_failures_total', "Failed APRS-IS sends and connections",
+            lambda: {name: s.stats['failures'] for name, s in sessions.items()}, 'server')
+        registry.gauge('wx_aprs_connected', "1 while logged in to an APRS-IS server", lambda: {name: s.connected() for name, s in sessions.items()}, 'server')
+    registry.counter('wx_qc_flags_total', "Readings flagged by quality control, by channel and check",
+        lambda: {f"{channel}:{flag}": count for (channel, flag), count in quality.flag_counts().items()} if quality else {}, 'check')
+    if journal is not None:
+        registry.counter('wx_journal_samples_total', "Raw samples written to the journal", lambda: journal.records)
+        registry.counter('wx_journal_dropped_total', "Raw samples dropped because journal writes fell behind or failed", lambda: journal.dropped)
+    if history is not None:
+        registry.counter('wx_history_cache_total', "History cache lookups by result",
+            lambda: {'hit': history.cache.hits, 'miss': history.cache.misses}, 'result')
+    registry.gauge('wx_threads', "Running threads by name", metrics.threads_alive, 'thread')
+    registry.counter('wx_worker_restarts_total', "Sensor worker processes restarted by the supervisor",
+        lambda: {name: d.restarts for name, d in drivers.items() if hasattr(d, 'restarts')}, 'sensor')
+    registry.gauge('wx_driver_thread_alive', "1 while a sensor driver's thread or worker process is running",
+        lambda: {name: d.thread.is_alive() for name, d in drivers.items()}, 'sensor')
 
 if __name__=="__main__":
     logging.basicConfig(level=logging.DEBUG)
-    logging.info("Reading 'wxstation.yaml'")
-    config = parse_config('wxstation.yaml')
-    # Create database object
-    db = WeatherDatabase(password=config['db_pass'],host=config['db_host'])
-    # Create aprs object
-    aprs = SendAprs(db, config['loglevel'])
-    # If dev mode is disabled, enable sensors and import packages as needed
-    if config['dev_mode'] is False:
-        sensors, threads = init_objects()
-    logging.info("Done reading config file.\nStarting main program now.")
-    # Create stop event for wind monitor
-    stop_event = th.Event()
-
-    while True:
-        if config['dev_mode']:
-            gen_random_data()
-
-        start_time = time() # Capture loop start time
-        if 'air_monitor' in sensors: # If SDS011 is enabled make and start thread
-            logging.info('Starting air_monitor thread')
-            threads['sds011'] = th.Thread(target=sensors['air_monitor'].monitor, name="Thread-Air_Monitor")
-            threads['sds011'].start()
-            logging.debug(f"sds011 thread status: {threads['sds011'].is_Alive}")
-
-        if 'bme280' in sensors:
-            logging.info('Reading bme280 temperature, pressure, and humidity now.')
-            while True:
-                try:
-                    data['temperature'] = sensors['bme280'].get_temperature(unit='F')
-                    data['pressure'] = sensors['bme280'].get_pressure()
-                    data['humidity'] = sensors['bme280'].get_humidity()
-                    logging.debug(f"temperature: {data['temperature']}, pressure: {data['pressure']}, humidity: {data['humidity']}")
-                    break
-                except Exception as e:
-                    logging.exception(f"Exception occured while trying to read bme280: {e}")
-                    continue
-
-        if 'wmonitor' and 'wspeed' in threads:
-            if len(sensors['wmonitor'].wind_list) > 0:
-                logging.debug('Setting stop event for wmonitor now')
-                stop_event.set()
-                logging.debug('Aquiring lock for wind_count_lock now')
-                sensors['wmonitor'].wind_count_lock.acquire()
-                data['wspeed'], data['wgusts'] = mean(sensors['wmonitor'].wind_list), max(sensors['wmonitor'].wind_list)
-                logging.info(f"wind speed: {data['wspeed']} wind gusts: {data['wgusts']}")
-                sensors['wmonitor'].wind_list.clear()
-                sensors['wmonitor'].wind_count_lock.release()
-                stop_event.clear()
-            else:
-                logging.info(f"wind monitor's wind list was not greater than zero: {len(sensors['wmonitor'].wind_list)}")
-                data['wgusts'], data['wspeed'] = 0, 0
-
-        if 'wdir' in threads:            
-            data['wdir'] = sensors['wdir_monitor'].average() # Record average wind direction in degrees
-            sensors['wdir_monitor'].wind_angles.clear() # Clear readings to average
-
-        if 'rain' in threads:
-            data['rainfall'] = sensors['rmonitor'].total_rain()
-            sensors['rmonitor'].clear_total_rain()
-        
-        if 'air_monitor' in sensors:
-            # wait for thread to complete before getting average readings
-            threads['sds011'].join()
-            data['pm25_avg'], data['pm10_avg'] = sensors['air_monitor'].average()
-            sensors['air_monitor'].air_values['pm25_total'].clear()
-            # Reset readings used for averages
-            sensors['air_monitor'].air_values['pm10_total'].clear()
-
-        th_makepacket = th.Thread(target=aprs.send_data(data, config), name="Thread-Make_APRS_Packet")
-        th_sensorsave = th.Thread(target=db.read_save_sensors(data), name="Thread-Save_Sensor_Data")
-            
-        th_sensorsave.start()
-        th_makepacket.start()
-        th_sensorsave.join()
-        th_makepacket.join()
-        wait_delay(start_time, config['report_interval'])
+    timings = {}
+    started = monotonic()
+    logging.info(f"Reading '{CONFIG_FILE}'")
+    config = timed('config', parse_config, CONFIG_FILE)
+    problems = validate_config(config)
+    if problems:
+        logging.critical(f"{CONFIG_FILE} is not valid:\n\t" + "\n\t".join(problems))
+        raise SystemExit(1)
+    # Push readings to a central collector instead of a local database
+    pusher = None
+    if config.get('collector'):
+        from collector import StationPusher
+        pusher = StationPusher.from_config(config['aprs']['callsign'], config['collector'])
+    # Create rolling rain totals, restored from the snapshot or seeded from the database by start_database
+    rain_window = RainWindow(config.get('rain_snapshot'))
+    rain_loaded = rain_window.load()
+    # Pressure series and today's temperature extremes, restored so a restart doesn't reset them
+    derived = DerivedMetrics(config.get('derived_snapshot'))
+    derived.load()
+    hardware = None
+    drivers = {}
+    quality = create_quality_control()
+    journal = create_journal()
+    # Each phase is mostly waiting on imports, the database or the network, so they run side by side
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="Thread-Startup") as startup:
+        database = startup.submit(timed, 'database', start_database)
+        uplink = startup.submit(timed, 'uplink', start_uplink, config['aprs']) if config['aprs']['sendall'] else None
+        # If dev mode is disabled, enable sensors and import packages as needed
+        sensors = startup.submit(timed, 'drivers', init_objects) if config['dev_mode'] is False else None
+        db, db_writer = database.result()
+        aprs = SendAprs(db, config['loglevel'], rain_window, uplink.result() if uplink else None)
+        drivers = sensors.result() if sensors else {}
+    stages = {
+        'collect': Stage("Collect", report),
+        'persist': Stage("Persist", persist),
+        'uplink': Stage("Uplink", lambda readings: aprs.send_data(readings, config))
+    }
+    timed('services', start_services)
+    scheduler = ReportScheduler(config['report_interval'])
+    ConfigWatcher(CONFIG_FILE, apply_config, config.get('config_poll_interval', 5)).start()
+    logging.info(f"Started in {round(monotonic() - started, 3)} seconds: " + ", ".join(f"{name} {round(seconds, 3)}" for name, seconds in timings.items()))
+    scheduler.run(stages['collect'].submit)
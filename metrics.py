@@ -0,0 +1,271 @@
+"""Station instrumentation served in Prometheus text format on a local HTTP port.
+Durations are recorded where they happen with timer() or observe(). Counters the monitors
+already keep are read through gauge callbacks when the endpoint is scraped, so they cost
+nothing on the hot path.
+    curl localhost:9110/metrics
+    curl 'localhost:9110/profile?seconds=30'"""
+import logging, sys, threading
+from bisect import bisect_left
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event, Lock
+from time import perf_counter, monotonic
+from urllib.parse import urlparse, parse_qs
+
+# Upper bounds in seconds, from a fast sensor read up to an APRS send timing out
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Histogram:
+    """Cumulative duration histogram for each combination of labels"""
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {} # Sorted label tuples -> [bucket counts, sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+class Gauge:
+    """Value read from a callback at scrape time. The callback returns a number,
+    or a dictionary of {label value: number} for a gauge labelled with label."""
+    def __init__(self, name, help, func, label=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self.kind = kind
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            logging.error(f"Unable to read metric {self.name}: {e}")
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if isinstance(value, dict):
+            for key, number in sorted(value.items(), key=lambda item: str(item[0])):
+                if number is not None:
+                    lines.append(f"{self.name}{format_labels(((self.label, key),))} {float(number)}")
+        elif value is not None:
+            lines.append(f"{self.name} {float(value)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def histogram(self, name, help=""):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(name, help or name)
+            return self.metrics[name]
+
+    def gauge(self, name, help, func, label=None):
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, func, label)
+
+    def counter(self, name, help, func, label=None):
+        """A gauge callback returning a count that only goes up"""
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, func, label, kind="counter")
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class timer:
+    """Context manager adding the time spent in its block to a histogram.
+        with metrics.timer('wx_db_seconds', op='insert'):"""
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, name, **labels):
+        self.histogram = REGISTRY.histogram(name)
+        self.labels = tuple(sorted(labels.items()))
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, self.labels)
+        return False
+
+def observe(name, seconds, **labels):
+    REGISTRY.histogram(name).observe(seconds, tuple(sorted(labels.items())))
+
+def describe(name, help):
+    """Set the help text of a histogram, creating it if needed"""
+    REGISTRY.histogram(name).help = help
+
+def threads_alive():
+    """1 for every running thread, by name. Numbered pool workers are counted together."""
+    alive = Counter()
+    for thread in threading.enumerate():
+        alive[thread.name.rstrip('0123456789_')] += 1
+    return alive
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed rate and counts them in collapsed stack
+    format (thread;outer;inner count), ready for flamegraph.pl or speedscope. Only this thread
+    does any work, the sampled threads are never interrupted."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running():
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run, daemon=True, name="Thread-Profiler")
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            calls.append(names.get(ident, str(ident)))
+            stacks.append(";".join(reversed(calls)))
+        with self.lock:
+            self.stacks.update(stacks)
+            self.samples += 1
+
+    def run(self):
+        next_sample = monotonic()
+        while not self.stop_event.is_set():
+            self.sample()
+            next_sample += self.interval
+            self.stop_event.wait(max(next_sample - monotonic(), 0))
+
+    def collapsed(self, reset=False):
+        with self.lock:
+            stacks = self.stacks
+            if reset:
+                self.stacks, self.samples = Counter(), 0
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    profiler = None # SamplingProfiler shared by every request
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self.reply(200, REGISTRY.render(), "text/plain; version=0.0.4")
+        elif url.path == '/profile':
+            query = parse_qs(url.query)
+            seconds = None
+            if 'seconds' in query:
+                try:
+                    seconds = float(query['seconds'][0])
+                except ValueError:
+                    seconds = 0
+                if not seconds > 0: # Also rejects nan
+                    self.reply(400, "seconds must be a positive number\n", "text/plain")
+                    return
+                seconds = min(seconds, 300)
+            self.reply(200, self.profile(seconds), "text/plain")
+        else:
+            self.reply(404, "Try /metrics or /profile?seconds=30\n", "text/plain")
+
+    def profile(self, seconds=None):
+        """Stacks from the running profiler, or from a profile taken for the requested seconds"""
+        profiler = MetricsHandler.profiler
+        if seconds is None and profiler.running():
+            return profiler.collapsed()
+        seconds = 10 if seconds is None else seconds
+        if profiler.running():
+            profiler.collapsed(reset=True)
+            Event().wait(seconds)
+            return profiler.collapsed(reset=True)
+        session = SamplingProfiler(profiler.interval)
+        session.start()
+        Event().wait(seconds)
+        session.stop()
+        return session.collapsed()
+
+    def reply(self, status, body, content_type):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+class MetricsServer:
+    """Serves /metrics and /profile on a daemon thread, bound to localhost by default"""
+    def __init__(self, port=9110, host="127.0.0.1", profile=False, profile_interval=0.01):
+        self.profiler = SamplingProfiler(profile_interval)
+        MetricsHandler.profiler = self.profiler
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.profile = profile # Profile continuously from start instead of only on request
+        self.thread = Thread(target=self.server.serve_forever, daemon=True, name="Thread-Metrics")
+
+    @classmethod
+    def from_config(cls, metrics_config):
+        return cls(metrics_config.get('port', 9110), metrics_config.get('host', "127.0.0.1"),
+            metrics_config.get('profile', False), metrics_config.get('profile_interval', 0.01))
+
+    def start(self):
+        self.thread.start()
+        if self.profile:
+            self.profiler.start()
+        logging.info(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        self.profiler.stop()
+        self.server.shutdown()
@@ -0,0 +1,196 @@
+"""Versioned schema migrations for the weather database, MariaDB or SQLite.
+Run from the installer, on startup when db_migrate is enabled, or by hand:
+    python3 migrate.py [--config wxstation.yaml] [--partition]
+The database password can be passed in WX_DB_PASS instead of the config, as the installer does."""
+import argparse, logging, os
+from datetime import date
+from db import open_database, ROLLUP_CHANNELS, ROLLUPS, DERIVED_COLUMNS
+
+def rollup_table(table):
+    columns = []
+    for ch in ROLLUP_CHANNELS:
+        columns += [
+            f"{ch}_count INT NOT NULL DEFAULT 0",
+            f"{ch}_min DECIMAL(8,3)",
+            f"{ch}_max DECIMAL(8,3)",
+            f"{ch}_sum DECIMAL(14,3)",
+            f"{ch}_avg DECIMAL(8,3) AS ({ch}_sum / NULLIF({ch}_count, 0)) VIRTUAL"
+        ]
+    return f"""CREATE TABLE IF NOT EXISTS {table}(
+        stationid VARCHAR(10) NOT NULL DEFAULT '',
+        bucket DATETIME NOT NULL,
+        samples INT NOT NULL DEFAULT 0,
+        {', '.join(columns)},
+        PRIMARY KEY (stationid, bucket),
+        KEY {table}_bucket (bucket));"""
+
+def rollup_backfill(table, width):
+    # Summarise rows saved before the rollup tables existed
+    formats = {16: '%Y-%m-%d %H:%i:00', 13: '%Y-%m-%d %H:00:00', 10: '%Y-%m-%d 00:00:00'}
+    columns, selects = ['stationid', 'bucket', 'samples'], ["COALESCE(stationid, '')", f"DATE_FORMAT(created, '{formats[width]}') AS b", "COUNT(*)"]
+    for ch in ROLLUP_CHANNELS:
+        columns += [f"{ch}_count", f"{ch}_min", f"{ch}_max", f"{ch}_sum"]
+        selects += [f"COUNT({ch})", f"MIN({ch})", f"MAX({ch})", f"SUM({ch})"]
+    return f"""INSERT IGNORE INTO {table}({', '.join(columns)})
+        SELECT {', '.join(selects)} FROM sensors GROUP BY 1, b;"""
+
+# Each migration is a version, description and list of statements, applied in order and never edited once released
+MIGRATIONS = [
+    (1, "Index sensors by station and time", [
+        "CREATE TABLE IF NOT EXISTS schema_version(version INT NOT NULL PRIMARY KEY, description VARCHAR(255), applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE INDEX IF NOT EXISTS sensors_station_created ON sensors(stationid, created);",
+        "CREATE INDEX IF NOT EXISTS sensors_created ON sensors(created);"
+    ]),
+    (2, "Add 1 minute, 1 hour and 1 day rollup tables", [rollup_table(table) for table in ROLLUPS] + [rollup_backfill(table, width) for table, width in ROLLUPS.items()]),
+    # NULL for rows saved before quality control, 0 for rows that passed every check
+    (3, "Add quality control flags to sensors", [
+        "ALTER TABLE sensors ADD COLUMN IF NOT EXISTS qc_flags BIGINT UNSIGNED NULL;"
+    ]),
+    (4, "Add dew point, heat index, wind chill, pressure tendency and daily temperature extremes to sensors", [
+        f"ALTER TABLE sensors ADD COLUMN IF NOT EXISTS {column} DECIMAL(6,2) NULL;" for column in DERIVED_COLUMNS
+    ])
+]
+
+def sqlite_rollup_table(table):
+    columns = []
+    for ch in ROLLUP_CHANNELS:
+        columns += [f"{ch}_count INTEGER NOT NULL DEFAULT 0", f"{ch}_min REAL", f"{ch}_max REAL", f"{ch}_sum REAL"]
+    return f"""CREATE TABLE IF NOT EXISTS {table}(
+        stationid TEXT NOT NULL DEFAULT '',
+        bucket TIMESTAMP NOT NULL,
+        samples INTEGER NOT NULL DEFAULT 0,
+        {', '.join(columns)},
+        PRIMARY KEY (stationid, bucket)) WITHOUT ROWID;"""
+
+def sqlite_rollup_backfill(table, width):
+    formats = {16: '%Y-%m-%d %H:%M:00', 13: '%Y-%m-%d %H:00:00', 10: '%Y-%m-%d 00:00:00'}
+    columns, selects = ['stationid', 'bucket', 'samples'], ["COALESCE(stationid, '')", f"strftime('{formats[width]}', created) AS b", "COUNT(*)"]
+    for ch in ROLLUP_CHANNELS:
+        columns += [f"{ch}_count", f"{ch}_min", f"{ch}_max", f"{ch}_sum"]
+        selects += [f"COUNT({ch})", f"MIN({ch})", f"MAX({ch})", f"SUM({ch})"]
+    return f"""INSERT OR IGNORE INTO {table}({', '.join(columns)})
+        SELECT {', '.join(selects)} FROM sensors GROUP BY 1, b;"""
+
+# The same versions for the SQLite engine, which also creates the sensors table the installer creates in MariaDB.
+# created is local time text in the format sensor_row writes, declared TIMESTAMP so it's read back as datetime.
+SQLITE_MIGRATIONS = [
+    (1, "Index sensors by station and time", [
+        "CREATE TABLE IF NOT EXISTS schema_version(version INTEGER NOT NULL PRIMARY KEY, description TEXT, applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP);",
+        """CREATE TABLE IF NOT EXISTS sensors(
+            ID INTEGER PRIMARY KEY,
+            stationid TEXT,
+            created TIMESTAMP NOT NULL,
+            ambient_temperature REAL,
+            wind_direction INTEGER,
+            wind_speed REAL,
+            wind_gust_speed REAL,
+            humidity REAL,
+            rainfall REAL,
+            air_pressure REAL,
+            pm25 REAL,
+            pm10 REAL);""",
+        "CREATE INDEX IF NOT EXISTS sensors_station_created ON sensors(stationid, created);",
+        "CREATE INDEX IF NOT EXISTS sensors_created ON sensors(created);"
+    ]),
+    (2, "Add 1 minute, 1 hour and 1 day rollup tables", [sqlite_rollup_table(table) for table in ROLLUPS]
+        + [f"CREATE INDEX IF NOT EXISTS {table}_bucket ON {table}(bucket);" for table in ROLLUPS]
+        + [sqlite_rollup_backfill(table, width) for table, width in ROLLUPS.items()]),
+    (3, "Add quality control flags to sensors", [
+        "ALTER TABLE sensors ADD COLUMN qc_flags INTEGER;"
+    ]),
+    (4, "Add dew point, heat index, wind chill, pressure tendency and daily temperature extremes to sensors", [
+        f"ALTER TABLE sensors ADD COLUMN {column} REAL;" for column in DERIVED_COLUMNS
+    ])
+]
+
+def upgrade(db):
+    """Apply migrations newer than the database's schema version, returns the new version"""
+    with db.pool.connection() as conn:
+        version = db.schema_version(conn) # A failed read raises, so migrations are never reapplied
+        cur = conn.conn.cursor()
+        for number, description, statements in (SQLITE_MIGRATIONS if db.engine == 'sqlite' else MIGRATIONS):
+            if number <= version:
+                continue
+            logging.info(f"Applying schema migration {number}: {description}")
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_version(version, description) VALUES(?, ?);", (number, description))
+            conn.conn.commit()
+            version = number
+        if db.engine == 'mariadb' and is_partitioned(cur):
+            add_partitions(cur)
+            conn.conn.commit()
+        cur.close()
+    db.version = None # Recheck for rollup tables and new columns on the next insert
+    logging.info(f"Database schema is at version {version}")
+    return version
+
+def month_start(year, month):
+    return date(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+def is_partitioned(cur):
+    cur.execute("SELECT COUNT(*) FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'sensors' AND PARTITION_NAME IS NOT NULL;")
+    return cur.fetchone()[0] > 0
+
+def partition(first, months):
+    """Partition definitions for months starting at first"""
+    parts = []
+    for i in range(months):
+        start = month_start(first.year, first.month + i)
+        end = month_start(first.year, first.month + i + 1)
+        parts.append(f"PARTITION p{start:%Y%m} VALUES LESS THAN (UNIX_TIMESTAMP('{end:%Y-%m-%d}'))")
+    return parts
+
+def partition_sensors(db, months_ahead=3):
+    """Partition sensors by month. The primary key has to include created for MariaDB to allow this."""
+    if db.engine != 'mariadb':
+        logging.warning(f"Partitioning is only supported by MariaDB, not {db.engine}")
+        return
+    with db.pool.connection() as conn:
+        cur = conn.conn.cursor()
+        if is_partitioned(cur):
+            logging.info("sensors table is already partitioned")
+            add_partitions(cur, months_ahead)
+            cur.close()
+            return
+        cur.execute("SELECT MIN(created) FROM sensors;")
+        oldest = cur.fetchone()[0] or date.today()
+        today = date.today()
+        months = (today.year - oldest.year) * 12 + today.month - oldest.month + 1 + months_ahead
+        logging.info(f"Partitioning sensors into {months} monthly partitions, this can take a while on large tables")
+        cur.execute("ALTER TABLE sensors DROP PRIMARY KEY, ADD PRIMARY KEY (ID, created);")
+        parts = partition(date(oldest.year, oldest.month, 1), months) + ["PARTITION pfuture VALUES LESS THAN MAXVALUE"]
+        cur.execute(f"ALTER TABLE sensors PARTITION BY RANGE (UNIX_TIMESTAMP(created)) ({', '.join(parts)});")
+        conn.conn.commit()
+        cur.close()
+
+def add_partitions(cur, months_ahead=3):
+    """Split the catch-all partition so there is always a partition for the coming months"""
+    cur.execute("SELECT PARTITION_NAME FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'sensors' AND PARTITION_NAME != 'pfuture';")
+    existing = {row[0] for row in cur.fetchall()}
+    today = date.today()
+    wanted = [month_start(today.year, today.month + i) for i in range(months_ahead + 1)]
+    missing = [p for p, start in zip(partition(wanted[0], len(wanted)), wanted) if f"p{start:%Y%m}" not in existing]
+    # Only months after the newest existing partition can be split out of pfuture
+    newest = max(existing) if existing else ''
+    missing = [p for p in missing if p.split()[1] > newest]
+    if missing:
+        logging.info(f"Adding {len(missing)} monthly partitions to sensors")
+        cur.execute(f"ALTER TABLE sensors REORGANIZE PARTITION pfuture INTO ({', '.join(missing)}, PARTITION pfuture VALUES LESS THAN MAXVALUE);")
+
+if __name__ == "__main__":
+    from yaml import safe_load
+    parser = argparse.ArgumentParser(description="Upgrade the weather database schema")
+    parser.add_argument('--config', default='wxstation.yaml', help="wxstation config file with database settings")
+    parser.add_argument('--partition', action='store_true', help="Partition the sensors table by month")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as file:
+        config = safe_load(file)
+    if os.environ.get('WX_DB_PASS'):
+        config['db_pass'] = os.environ['WX_DB_PASS'] # Kept out of the command line where ps would show it
+    db = open_database(config)
+    upgrade(db)
+    if args.partition or config.get('db_partition', False):
+        partition_sensors(db)
+    db.close()
@@ -1,55 +1,191 @@
 import logging
-from statistics import mean
-from time import sleep, time
-from sds011 import SDS011
+from math import sqrt
+from threading import Thread, Event, Lock
+from time import monotonic, time
+from serial import Serial
+
+HEAD, TAIL = 0xAA, 0xAB
+DATA_FRAME = 0xC0 # Measurement frames sent by the sensor
+COMMAND = 0xB4
+CMD_REPORTING_MODE, CMD_WORK = 0x02, 0x06
+FRAME_LEN = 10
+MAX_READING = 999.9 # Sensor reports 999.9 when a reading is out of range
+
+class RunningStats:
+    """Welford's online mean and variance with min, max and count, O(1) per reading"""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.mean, 2) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'stdev': round(sqrt(self.m2 / (self.count - 1)), 2) if self.count > 1 else 0.0
+        }
+
+def command(cmd, data1=0, data2=0):
+    """Build a 19 byte command frame addressed to every sensor"""
+    body = bytes([cmd, data1, data2] + [0] * 10 + [0xFF, 0xFF])
+    return bytes([HEAD, COMMAND]) + body + bytes([sum(body) & 0xFF, TAIL])
 
 class MonitorAirQuality:
-    def __init__(self, baudrate=9600, tty="/dev/ttyUSB0", interval=60):
+    """Long running SDS011 reader. Cycles the fan and laser through warm up, sampling and sleep
+    independently of reports, and keeps the statistics of the latest completed sampling window."""
+    def __init__(self, baudrate=9600, tty="/dev/ttyUSB0", interval=60, warmup=30, sleep_time=0, port=None, journal=None, retry=10, max_retry=300):
         self.air_values = {
             'pm25': 0.0,
             'pm10': 0.0,
-            'pm25_total': [],
-            'pm10_total': [],
             'pm25_errors': 0,
-            'pm10_errors': 0
+            'pm10_errors': 0,
+            'checksum_errors': 0,
+            'port_errors': 0
         }
-        self.interval = float(interval)
-        self.sensor = SDS011(serial_port=tty, baudrate=baudrate)
-
-    def read_sds011(self):
-        self.air_values['pm25'], self.air_values['pm10'] = self.sensor.query()
-        if self.air_values['pm25'] < 999.9:
-            self.air_values['pm25_total'].append(self.air_values['pm25'])
-        else:
-            self.air_values['pm10_errors'] += 1
-            logging.error(f"PM25 value {self.air_values['pm25']} is out of range")
-        if self.air_values['pm10'] < 999.9:
-            self.air_values['pm10_total'].append(self.air_values['pm10'])
-        else:
-            self.air_values['pm10_errors'] += 1
-            logging.error(f"PM10 value {self.air_values['pm10']} is out of range")
-        return self.air_values['pm25'], self.air_values['pm10']
+        self.interval = float(interval) # Seconds of readings in each window
+        self.warmup = float(warmup) # Seconds of readings discarded after waking while the airflow settles
+        self.sleep_time = float(sleep_time) # Seconds to sleep between windows to save sensor lifespan, 0 keeps it running
+        self.baudrate = baudrate
+        self.tty = tty
+        self.retry = retry # Seconds before reopening the port after an error, doubled up to max_retry
+        self.max_retry = max_retry
+        self.owns_port = port is None # A port passed in, such as the simulator's, is kept and retried instead of reopened
+        self.port = port or Serial(tty, baudrate=baudrate, timeout=1)
+        self.journal = journal # Journal every frame after warm up is also written to, see journal.py
+        self.buffer = bytearray()
+        self.latest = None # Statistics of the last completed window
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = Thread(target=self.monitor, daemon=True, name="Thread-Air_Monitor")
 
-    def show_air_values(self):
-        #self.read_sds011()
-        logging.debug("PM2.5, µg/m3: ", self.air_values['pm25'])
-        logging.debug("PM10, µg/m3: ", self.air_values['pm10'])
-    
-    def average(self): # Return average from total readings
-        if len(self.air_values['pm25_total']) > 0 and len(self.air_values['pm10_total']) > 0:
-            if len(self.air_values['pm25_total']) > 5 and len(self.air_values['pm10_total']) > 5: # delete first 5 readings
-                self.air_values['pm25_total'] = self.air_values['pm25_total'][5:]
-                self.air_values['pm10_total'] = self.air_values['pm10_total'][5:]
-                return round(mean(self.air_values['pm25_total']), 2), round(mean(self.air_values['pm10_total']), 2)
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def set_working(self, working):
+        self.port.write(command(CMD_WORK, 1, 1 if working else 0))
+
+    def read_frames(self):
+        """Read what the port has and yield (pm25, pm10) for every complete, valid frame"""
+        self.buffer += self.port.read(max(1, self.port.in_waiting)) # Waits at most the port timeout
+        while True:
+            start = self.buffer.find(HEAD)
+            if start < 0:
+                self.buffer.clear()
+                return
+            del self.buffer[:start] # Drop noise before the next frame
+            if len(self.buffer) < FRAME_LEN:
+                return
+            frame = self.buffer[:FRAME_LEN]
+            if frame[1] != DATA_FRAME or frame[9] != TAIL:
+                del self.buffer[:1] # Not a measurement frame, resync on the next header byte
+                continue
+            if sum(frame[2:8]) & 0xFF != frame[8]:
+                self.air_values['checksum_errors'] += 1
+                del self.buffer[:1]
+                continue
+            del self.buffer[:FRAME_LEN]
+            yield (frame[2] | frame[3] << 8) / 10.0, (frame[4] | frame[5] << 8) / 10.0
+
+    def read_sds011(self, stats):
+        for pm25, pm10 in self.read_frames():
+            self.air_values['pm25'], self.air_values['pm10'] = pm25, pm10
+            if stats is None:
+                continue # Warming up
+            if self.journal is not None:
+                now = time()
+                self.journal.append('pm25', pm25, now)
+                self.journal.append('pm10', pm10, now)
+            if pm25 < MAX_READING:
+                stats['pm25'].add(pm25)
+            else:
+                self.air_values['pm25_errors'] += 1
+                logging.error(f"PM25 value {pm25} is out of range")
+            if pm10 < MAX_READING:
+                stats['pm10'].add(pm10)
             else:
-                return round(mean(self.air_values['pm25_total']), 2), round(mean(self.air_values['pm10_total']), 2)
-        else:
-            logging.error("pm25 and pm10 totals were empty, no readings to average.")
-    
+                self.air_values['pm10_errors'] += 1
+                logging.error(f"PM10 value {pm10} is out of range")
+
+    def show_air_values(self):
+        logging.debug(f"PM2.5, µg/m3: {self.air_values['pm25']}")
+        logging.debug(f"PM10, µg/m3: {self.air_values['pm10']}")
+
+    def average(self):
+        """Means of the latest completed window, returns immediately. None until the first window completes."""
+        with self.lock:
+            latest = self.latest
+        if latest is None or latest['pm25']['count'] == 0 or latest['pm10']['count'] == 0:
+            logging.error("No completed air quality window, no readings to average.")
+            return None
+        return latest['pm25']['mean'], latest['pm10']['mean']
+
+    def window(self):
+        with self.lock:
+            return self.latest
+
+    def cycle(self):
+        """One duty cycle of warm up, a sampling window and the optional sleep"""
+        self.set_working(True)
+        warm_until = monotonic() + self.warmup
+        while monotonic() < warm_until and not self.stop_event.is_set():
+            self.read_sds011(None)
+        stats = {'pm25': RunningStats(), 'pm10': RunningStats()}
+        started = time()
+        sample_until = monotonic() + self.interval
+        while monotonic() < sample_until and not self.stop_event.is_set():
+            self.read_sds011(stats)
+        with self.lock:
+            self.latest = {'pm25': stats['pm25'].summary(), 'pm10': stats['pm10'].summary(), 'started': started, 'finished': time()}
+        logging.debug(f"Air quality window completed: {self.latest}")
+        if self.sleep_time > 0:
+            self.set_working(False)
+            self.stop_event.wait(self.sleep_time)
+
+    def close_port(self):
+        if self.owns_port and self.port is not None:
+            try:
+                self.port.close()
+            except Exception as e:
+                logging.debug(f"Unable to close {self.tty}: {e}")
+            self.port = None
+
     def monitor(self):
-        self.sensor.sleep(sleep=False)
-        self.runtime = time() + self.interval
-        while self.runtime - time() > 0:
-            self.read_sds011()
-            sleep(1)
-        self.sensor.sleep()
\ No newline at end of file
+        # A serial error or an unplugged sensor must not end the thread, the window just stops updating until the port is back.
+        # The driver sees the stall as the window aging past max_age.
+        backoff = self.retry
+        while not self.stop_event.is_set():
+            try:
+                if self.port is None:
+                    self.port = Serial(self.tty, baudrate=self.baudrate, timeout=1)
+                    logging.info(f"Reopened SDS011 port {self.tty}")
+                self.port.write(command(CMD_REPORTING_MODE, 1, 0)) # Have the sensor send a frame every second
+                while not self.stop_event.is_set():
+                    self.cycle()
+                    backoff = self.retry
+            except Exception as e:
+                self.air_values['port_errors'] += 1
+                self.buffer.clear()
+                logging.error(f"SDS011 monitor failed: {e}\n\tReopening {self.tty} in {backoff} seconds")
+                self.close_port()
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_retry)
+        try:
+            self.set_working(False)
+        except Exception as e:
+            logging.debug(f"Unable to put the SDS011 to sleep: {e}")
+        self.close_port()
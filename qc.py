@@ -0,0 +1,167 @@
+"""Quality control of each report's readings before they are saved or sent.
+Every channel runs a range check, a rate of change limit and a Hampel filter (distance from the
+median of recent readings in units of their median absolute deviation). The filters see one
+reading per channel per report, the averages the drivers report, not the raw samples, so the
+Hampel window is sized in seconds of reports. Bad readings are repaired or flagged, and the flags
+are packed into the sensors.qc_flags column."""
+import logging
+from bisect import insort, bisect_left
+from collections import deque
+from threading import Lock
+from time import time
+
+# Flag bits for one channel
+RANGE = 1 # Outside the physically possible range
+RATE = 2 # Changed faster than the channel can
+SPIKE = 4 # Hampel filter outlier
+REPAIRED = 8 # Value was replaced
+FLAG_NAMES = {RANGE: 'range', RATE: 'rate', SPIKE: 'spike', REPAIRED: 'repaired'}
+FLAG_BITS = 4
+
+# Order of channels in the packed flags, new channels must only ever be appended
+QC_CHANNELS = ('temperature', 'pressure', 'humidity', 'wspeed', 'wgusts', 'wdir', 'rainfall', 'rain_rate', 'pm25_avg', 'pm10_avg')
+
+# low, high: possible range. max_rate: largest believable change per second.
+# window_seconds, threshold: Hampel filter over the reports from the past window_seconds, at least MIN_WINDOW of them,
+# outliers are over threshold scaled MADs from the median. A window override counts reports instead.
+# min_spread: smallest MAD used, so a flat series doesn't flag every tiny change.
+# Units match the data dictionary: Fahrenheit, hPa, percent, mph, degrees, inches and µg/m3.
+DEFAULT_LIMITS = {
+    'temperature': {'low': -60, 'high': 140, 'max_rate': 0.1, 'window_seconds': 2100, 'threshold': 4, 'min_spread': 1.0},
+    'pressure': {'low': 870, 'high': 1085, 'max_rate': 0.05, 'window_seconds': 2100, 'threshold': 4, 'min_spread': 0.5},
+    'humidity': {'low': 0, 'high': 100, 'max_rate': 0.5, 'window_seconds': 2100, 'threshold': 4, 'min_spread': 3.0},
+    'wspeed': {'low': 0, 'high': 200},
+    'wgusts': {'low': 0, 'high': 250},
+    'wdir': {'low': 0, 'high': 360},
+    'rainfall': {'low': 0, 'high': 10},
+    'rain_rate': {'low': 0, 'high': 40},
+    'pm25_avg': {'low': 0, 'high': 999, 'window_seconds': 2100, 'threshold': 5, 'min_spread': 5.0},
+    'pm10_avg': {'low': 0, 'high': 999, 'window_seconds': 2100, 'threshold': 5, 'min_spread': 5.0}
+}
+MAD_SCALE = 1.4826 # Makes the MAD an estimate of the standard deviation for normally distributed readings
+MAX_REJECTS = 3 # Consecutive rate failures before a new level is accepted, e.g. after a front passes
+MIN_WINDOW = 5 # Fewest reports in a Hampel window, a median of fewer can't outvote a spike
+
+class ChannelFilter:
+    def __init__(self, name, low=None, high=None, max_rate=None, window=0, threshold=3, min_spread=0.0, mode='repair'):
+        self.name = name
+        self.low = low
+        self.high = high
+        self.max_rate = max_rate
+        self.threshold = threshold
+        self.min_spread = min_spread
+        self.mode = mode # repair replaces bad readings, flag only records them
+        self.window = deque(maxlen=window) if window else None # Recent in range readings, oldest first
+        self.ordered = [] # The same readings kept sorted for the median
+        self.last = None # Last accepted reading and its time
+        self.last_time = None
+        self.rejects = 0
+
+    def remember(self, value):
+        if len(self.window) == self.window.maxlen:
+            del self.ordered[bisect_left(self.ordered, self.window[0])]
+        self.window.append(value)
+        insort(self.ordered, value)
+
+    def median(self, values):
+        n = len(values)
+        return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+    def hampel(self, value):
+        """Median of the window and whether value is an outlier from it, work is bounded by the window size"""
+        median = self.median(self.ordered)
+        mad = self.median(sorted(abs(v - median) for v in self.ordered))
+        return median, abs(value - median) > self.threshold * max(mad * MAD_SCALE, self.min_spread)
+
+    def check(self, value, when):
+        """Returns the value to use and the flags raised for it"""
+        if value is None:
+            return None, 0
+        flags, repair = 0, None
+        if (self.low is not None and value < self.low) or (self.high is not None and value > self.high):
+            flags |= RANGE
+            repair = self.last # Only flagged until there is a good reading to repair it with
+        else:
+            if self.max_rate is not None and self.last is not None:
+                allowed = self.max_rate * max(when - self.last_time, 1)
+                if abs(value - self.last) > allowed:
+                    self.rejects += 1
+                    if self.rejects <= MAX_REJECTS:
+                        flags |= RATE
+                        repair = self.last
+            if self.window is not None:
+                if len(self.window) >= 3:
+                    median, outlier = self.hampel(value)
+                    if outlier:
+                        flags |= SPIKE
+                        repair = median if repair is None else repair
+                self.remember(value) # Raw readings, so a real change moves the median within half a window
+        if not flags & RATE:
+            self.rejects = 0
+        if flags and self.mode == 'repair' and repair is not None:
+            flags |= REPAIRED
+            value = repair
+        if not flags:
+            self.last, self.last_time = value, when # Repaired values would hold the rate check at the repair
+        return value, flags
+
+class QualityControl:
+    """Filters for every channel of the data dictionary, with counts of the flags raised"""
+    def __init__(self, limits=None, mode='repair', report_interval=300):
+        self.filters = {}
+        for name in QC_CHANNELS:
+            options = dict(DEFAULT_LIMITS.get(name, {}), **((limits or {}).get(name) or {}))
+            window_seconds = options.pop('window_seconds', None)
+            if window_seconds and 'window' not in options:
+                options['window'] = max(MIN_WINDOW, round(window_seconds / report_interval))
+            self.filters[name] = ChannelFilter(name, mode=mode, **options)
+        self.counts = {} # (channel, flag name) -> readings flagged
+        self.checked = 0
+        self.lock = Lock() # The metrics server reads counts while reports add to them
+
+    @classmethod
+    def from_config(cls, qc_config, report_interval=300):
+        return cls(qc_config.get('channels'), qc_config.get('mode', 'repair'), report_interval)
+
+    def apply(self, readings, when=None):
+        """Check every channel in readings in place, returns {channel: flags} for the flagged ones"""
+        when = time() if when is None else when
+        flagged = {}
+        self.checked += 1
+        for name, channel in self.filters.items():
+            if name not in readings:
+                continue
+            readings[name], flags = channel.check(readings[name], when)
+            if flags:
+                flagged[name] = flags
+                with self.lock:
+                    for bit, flag in FLAG_NAMES.items():
+                        if flags & bit:
+                            self.counts[(name, flag)] = self.counts.get((name, flag), 0) + 1
+        if flagged:
+            logging.warning(f"Quality control flagged {describe_flags(flagged)}")
+        return flagged
+
+    def flag_counts(self):
+        """Copy of counts that is safe to iterate while readings are being checked"""
+        with self.lock:
+            return dict(self.counts)
+
+def pack_flags(flagged):
+    """Pack {channel: flags} into one integer, FLAG_BITS per channel in QC_CHANNELS order"""
+    packed = 0
+    for name, flags in flagged.items():
+        packed |= flags << (QC_CHANNELS.index(name) * FLAG_BITS)
+    return packed
+
+def unpack_flags(packed):
+    flagged = {}
+    for i, name in enumerate(QC_CHANNELS):
+        flags = (packed >> (i * FLAG_BITS)) & ((1 << FLAG_BITS) - 1)
+        if flags:
+            flagged[name] = flags
+    return flagged
+
+def describe_flags(flagged):
+    """e.g. temperature (spike, repaired), pm25_avg (range, repaired)"""
+    return ", ".join(f"{name} ({', '.join(flag for bit, flag in FLAG_NAMES.items() if flags & bit)})" for name, flags in flagged.items())
@@ -1,41 +1,119 @@
-from gpiozero import Button
-from threading import Lock
-from time import sleep
-import logging
+from array import array
+from time import time
+import logging, os
+
+RAIN_PIN = 5 # GPIO pin of the rain gauge's reed switch
+LOG_SIZE = 4096 # Tip times kept in memory
+RATE_TIMEOUT = 900 # Seconds without a tip before the rain rate is reported as zero
 
 class RainMonitor:
-    """ DEFAULT_RAIN_SENSOR = Button(5)
-        BUCKET_SIZE = 0.2794 # mm
+    """ BUCKET_SIZE = 0.2794 # mm
         BUCKET_SIZE = 0.011 # inches"""
-    def __init__(self, BUCKET=0.011, button=Button(5)):
-        self.tips = 0
-        self.button = button
+    def __init__(self, BUCKET=0.011, button=None, log_path=None, size=LOG_SIZE):
+        self.button = button # Button on RAIN_PIN is created by monitor() unless one is given
         self.bucket_size = BUCKET
-        self.tips_lock = Lock()
+        self.size = size
+        self.tip_times = array('d', bytes(8 * size)) # Ring of tip times, tip n is at n % size
+        # bucket_tipped is the only writer of tips and take() the only writer of reported,
+        # so counting needs no lock and a tip can never land between reading and resetting
+        self.tips = 0 # Total tips recorded
+        self.reported = 0 # Tips already returned by take()
+        self.tip_callbacks = [] # Called with the bucket size every time the bucket tips
+        self.log_path = log_path
+        self.log = None
+        if log_path is not None:
+            self.restore()
+            self.log = open(log_path, 'a', buffering=1) # Line buffered so every tip reaches the file
 
     def bucket_tipped(self):
-        while True:
-            if not self.tips_lock.locked():
-                self.tips_lock.acquire()
-                self.tips += 1
-                logging.info(f"Bucket tipped! Total rainfall calculated is {self.tips * self.bucket_size}")
-                self.tips_lock.release()
-                break
-            
-    # Convert tips to rain in hundreths of an inch and reset tips counter
+        now = time()
+        self.tip_times[self.tips % self.size] = now
+        self.tips += 1
+        if self.log is not None:
+            self.log.write(f"{now}\n")
+        logging.info(f"Bucket tipped! Rainfall since last report is {(self.tips - self.reported) * self.bucket_size}")
+        for callback in self.tip_callbacks:
+            callback(self.bucket_size)
+
+    # Convert tips to rain in hundreths of an inch
     def total_rain(self):
-        return self.tips * self.bucket_size
-
-    def clear_total_rain(self):
-        while True:
-            if not self.tips_lock.locked():
-                self.tips_lock.acquire()
-                self.tips = 0
-                self.tips_lock.release()
-                break
-            else:
-                logging.error("RainMonitor thread locked! Waiting 2 seconds to reset tips...")
-                sleep(2)
+        """Rain since the last take() without resetting it"""
+        return (self.tips - self.reported) * self.bucket_size
+
+    def take(self):
+        """Return rain since the last take() and start counting the next report from here"""
+        tips = self.tips
+        rain = (tips - self.reported) * self.bucket_size
+        self.reported = tips
+        self.save_cursor()
+        return rain
+
+    def rain_rate(self, now=None):
+        """Instantaneous rain rate in inches per hour from the time between the last two tips.
+        Decays while no tip arrives, so the rate falls as soon as the rain eases."""
+        now = time() if now is None else now
+        tips = self.tips
+        if tips == 0:
+            return 0.0
+        last = self.tip_times[(tips - 1) % self.size]
+        since_last = now - last
+        if since_last > RATE_TIMEOUT:
+            return 0.0
+        interval = since_last
+        if tips > 1:
+            interval = max(last - self.tip_times[(tips - 2) % self.size], since_last)
+        return round(self.bucket_size / max(interval, 1) * 3600, 3)
+
+    def save_cursor(self):
+        if self.log_path is None:
+            return
+        if self.log is not None:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+        tmp_path = f"{self.log_path}.reported.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(str(self.reported))
+        os.replace(tmp_path, f"{self.log_path}.reported") # Atomic so a crash keeps the old cursor
+
+    def restore(self):
+        """Load tips that were never reported before the last shutdown, then compact the log"""
+        try:
+            with open(self.log_path, 'r') as file:
+                times = [float(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Unable to read rain tip log {self.log_path}, starting with no pending tips: {e}")
+            return
+        try:
+            with open(f"{self.log_path}.reported", 'r') as file:
+                reported = int(file.read().strip() or 0)
+        except (OSError, ValueError):
+            reported = 0
+        pending = times[reported:][-self.size:]
+        for t in pending:
+            self.tip_times[self.tips % self.size] = t
+            self.tips += 1
+        # Rewrite the log with only the pending tips so it doesn't grow forever
+        tmp_path = f"{self.log_path}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.writelines(f"{t}\n" for t in pending)
+        os.replace(tmp_path, self.log_path)
+        self.save_cursor() # reported is 0, the compacted log only has pending tips
+        if pending:
+            logging.info(f"Restored {len(pending)} unreported rain tips from {self.log_path}")
 
     def monitor(self):
+        if self.button is None:
+            from gpiozero import Button # Imported here so importing this module never touches the GPIO pins
+            self.button = Button(RAIN_PIN)
         self.button.when_pressed = self.bucket_tipped
+
+    def close(self):
+        if self.button is not None:
+            self.button.when_pressed = None
+            self.button.close()
+        self.save_cursor()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
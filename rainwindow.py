@@ -0,0 +1,117 @@
+import json, logging, os
+from datetime import datetime
+from threading import Lock
+from time import time
+
+BUCKET_SECONDS = 60 # Width of each rain bucket in seconds
+DAY_BUCKETS = 1440 # 24 hours of 1 minute buckets
+HOUR_BUCKETS = 60 # 1 hour of 1 minute buckets
+
+class RainWindow:
+    """Rolling rainfall totals for the past hour, past 24 hours and since local midnight.
+    Rain is added into 1 minute buckets and running sums are adjusted as buckets expire,
+    so reading the totals does not depend on how many reports have been saved."""
+    def __init__(self, snapshot_path=None):
+        self.buckets = [0.0] * DAY_BUCKETS
+        self.head = None # Epoch minute of the newest bucket
+        self.day = None # Local date that since_midnight belongs to
+        self.sum_1h = 0.0
+        self.sum_24h = 0.0
+        self.since_midnight = 0.0
+        self.snapshot_path = snapshot_path
+        self.lock = Lock()
+
+    def _advance(self, now):
+        # Expire buckets that have fallen out of the 1 and 24 hour windows
+        day = datetime.fromtimestamp(now).date().isoformat()
+        if day != self.day:
+            self.day = day
+            self.since_midnight = 0.0
+        minute = int(now // BUCKET_SECONDS)
+        if self.head is None or minute - self.head >= DAY_BUCKETS:
+            self.buckets = [0.0] * DAY_BUCKETS
+            self.sum_1h, self.sum_24h = 0.0, 0.0
+            self.head = minute
+            return
+        for m in range(self.head + 1, minute + 1): # Does nothing if the clock stepped backwards
+            self.sum_1h -= self.buckets[(m - HOUR_BUCKETS) % DAY_BUCKETS]
+            self.sum_24h -= self.buckets[m % DAY_BUCKETS]
+            self.buckets[m % DAY_BUCKETS] = 0.0
+        self.head = max(self.head, minute)
+
+    def add(self, amount, when=None):
+        now = time()
+        when = now if when is None else when
+        with self.lock:
+            self._advance(now)
+            minute = int(when // BUCKET_SECONDS)
+            if minute > self.head or minute <= self.head - DAY_BUCKETS:
+                logging.debug(f"Rain reading at {when} is outside of the 24 hour window, not recorded")
+                return
+            self.buckets[minute % DAY_BUCKETS] += amount
+            self.sum_24h += amount
+            if minute > self.head - HOUR_BUCKETS:
+                self.sum_1h += amount
+            if datetime.fromtimestamp(when).date().isoformat() == self.day:
+                self.since_midnight += amount
+
+    def totals(self):
+        """Returns rain totals using the same keys as WeatherDatabase.get_all_rain_avg"""
+        with self.lock:
+            self._advance(time())
+            # Clamp to avoid floating point residue after many subtractions
+            return {
+                '00': round(max(self.since_midnight, 0.0), 3),
+                '1': round(max(self.sum_1h, 0.0), 3),
+                '24': round(max(self.sum_24h, 0.0), 3)
+            }
+
+    def seed(self, rows):
+        """Load rows of (created, rainfall) from the database, used once at startup"""
+        count = 0
+        for created, rainfall in rows:
+            if rainfall:
+                self.add(float(rainfall), created.timestamp())
+                count += 1
+        logging.info(f"Seeded rain window with {count} rows from the database")
+
+    def snapshot(self):
+        if self.snapshot_path is None:
+            return
+        with self.lock:
+            state = {
+                'head': self.head,
+                'day': self.day,
+                'since_midnight': self.since_midnight,
+                'buckets': {i: v for i, v in enumerate(self.buckets) if v} # Only store buckets with rain
+            }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump(state, file)
+            os.replace(tmp_path, self.snapshot_path) # Atomic so a crash never leaves a partial snapshot
+        except OSError as e:
+            logging.error(f"Unable to save rain window snapshot to {self.snapshot_path}: {e}")
+
+    def load(self):
+        """Restore from snapshot, returns False if there is no usable snapshot"""
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                state = json.load(file)
+            buckets = [0.0] * DAY_BUCKETS
+            for i, v in state['buckets'].items():
+                buckets[int(i)] = float(v)
+            head = int(state['head'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Unable to load rain window snapshot {self.snapshot_path}: {e}")
+            return False
+        with self.lock:
+            self.buckets, self.head = buckets, head
+            self.day, self.since_midnight = state['day'], float(state['since_midnight'])
+            self.sum_24h = sum(buckets)
+            self.sum_1h = sum(buckets[(head - i) % DAY_BUCKETS] for i in range(HOUR_BUCKETS))
+            self._advance(time()) # Expire anything that fell out of the windows while stopped
+        logging.info(f"Loaded rain window snapshot from {self.snapshot_path}")
+        return True
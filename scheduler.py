@@ -0,0 +1,71 @@
+import logging, metrics
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import time, monotonic
+
+class Stage:
+    """Runs one step of the report pipeline on its own worker thread.
+    If the previous run hasn't finished the new run is skipped, so a stage that
+    overruns never delays the other stages or the next report."""
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"Thread-{name}")
+        self.future = None
+        self.overruns = 0
+        self.last_duration = None
+
+    def busy(self):
+        return self.future is not None and not self.future.done()
+
+    def submit(self, *args):
+        if self.busy():
+            self.overruns += 1
+            logging.error(f"{self.name} stage is still running from the previous report, skipping this run. Total skipped: {self.overruns}")
+            return None
+        self.future = self.executor.submit(self._run, *args)
+        return self.future
+
+    def _run(self, *args):
+        start = monotonic()
+        try:
+            return self.func(*args)
+        except Exception as e:
+            logging.exception(f"Exception occured in {self.name} stage: {e}")
+        finally:
+            self.last_duration = monotonic() - start
+            metrics.observe('wx_stage_seconds', self.last_duration, stage=self.name)
+            logging.debug(f"{self.name} stage took {round(self.last_duration, 3)} seconds")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class ReportScheduler:
+    """Fires reports on wall-clock multiples of interval, e.g. :00, :05, :10 for 300 seconds,
+    so report times never drift no matter how long each report takes."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.stop_event = Event()
+
+    def next_report(self, now):
+        return (now // self.interval + 1) * self.interval
+
+    def run(self, report):
+        target = self.next_report(time())
+        while not self.stop_event.is_set():
+            logging.info(f"Generating next report in {round((target - time()) / 60, 2)} minutes")
+            if self.stop_event.wait(max(target - time(), 0)):
+                break
+            metrics.observe('wx_report_delay_seconds', max(time() - target, 0)) # Late wake ups show up here
+            report(target)
+            now = time()
+            following = self.next_report(target)
+            if following <= now:
+                # The report itself ran past one or more boundaries, skip to the next one ahead
+                missed = int((now - following) // self.interval) + 1
+                logging.error(f"WARNING: report took longer than the interval period of {self.interval / 60} minutes, skipping {missed} reports")
+                following = self.next_report(now)
+            target = following
+
+    def stop(self):
+        self.stop_event.set()
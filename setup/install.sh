@@ -89,6 +89,13 @@ setup_db() {
             PM25 DECIMAL(6,2),\
             PM10 DECIMAL(6,2));"
 }
+# Add indexes and rollup tables to the sensors table
+migrate_db() {
+    echo "Upgrading ${db_name} database schema"
+    cd ..
+    WX_DB_PASS="$db_userpass" python3 migrate.py --config wxstation.yaml
+    cd -
+}
 systemd_setup() {
     if [[ -d /usr/lib/systemd/system ]]; then
     echo -e "[Unit]\n\
@@ -222,6 +229,7 @@ main() {
         if [[ "${1}" == "--database-only" ]]; then
             echo "Setting up database only!"
             setup_db
+            migrate_db
             echo "Done setting up database!"
             exit 0
         elif [[ "${1}" == "--pkgs-only" ]]; then
@@ -237,6 +245,7 @@ main() {
         if [[ "${1}" != "--skip-database" ]]; then
             install_pkgs
             setup_db
+            migrate_db
         else
             echo "Skipping database install and setup"
             export deb_pkgs=$(echo ${deb_pkgs} | sed 's/mariadb-server //g')
@@ -0,0 +1,255 @@
+"""Hardware-free simulation of the weather station.
+Drives the real monitor classes with gpiozero's mock pins and fake MCP3008, SDS011 and BME280
+objects, using synthetic scenarios or weather recorded to a CSV file.
+    python3 simulate.py --scenario hurricane --duration 120
+    python3 simulate.py --replay recorded.csv --duration 600
+    python3 simulate.py --max-rate 5"""
+import argparse, csv, logging, math, random
+from threading import Thread, Event, Lock
+from time import monotonic, sleep
+
+from rainfall import RAIN_PIN
+from wspeed import WIND_PIN
+MPH_PER_HZ = 0.7463 # Wind speed for one anemometer pulse per second, see WindMonitor.speed
+BUCKET = 0.011 # RainMonitor's default bucket size in inches
+
+# Steady conditions with a gust cycle. stuck freezes the BME280 then makes it fail,
+# sends out of range SDS011 readings and leaves the wind vane open circuit.
+SCENARIOS = {
+    'calm': {'wspeed': 3, 'gust': 5, 'wdir': 180, 'wdir_spread': 10, 'rain_rate': 0, 'temperature': 68, 'pressure': 1013, 'humidity': 50, 'pm25': 5, 'pm10': 8},
+    'storm': {'wspeed': 35, 'gust': 60, 'wdir': 225, 'wdir_spread': 30, 'rain_rate': 1, 'temperature': 55, 'pressure': 990, 'humidity': 95, 'pm25': 3, 'pm10': 5},
+    'hurricane': {'wspeed': 100, 'gust': 150, 'wdir': 90, 'wdir_spread': 45, 'rain_rate': 4, 'temperature': 80, 'pressure': 950, 'humidity': 100, 'pm25': 2, 'pm10': 4},
+    'rain_burst': {'wspeed': 10, 'gust': 20, 'wdir': 270, 'wdir_spread': 20, 'rain_rate': 6, 'temperature': 70, 'pressure': 1005, 'humidity': 90, 'pm25': 4, 'pm10': 6},
+    'stuck': {'wspeed': 10, 'gust': 15, 'wdir': 0, 'wdir_spread': 0, 'rain_rate': 0, 'temperature': 70, 'pressure': 1010, 'humidity': 40, 'pm25': 999.9, 'pm10': 999.9, 'stuck': True}
+}
+GUST_PERIOD = 20 # Seconds between simulated gusts
+
+class Weather:
+    """Conditions at a number of seconds into the simulation"""
+    def __init__(self, scenario=None, replay=None):
+        self.rows = None
+        if replay is not None:
+            # Recorded weather, one row per time step with a seconds column and the SCENARIOS keys
+            with open(replay, 'r') as file:
+                self.rows = [{key: float(value) for key, value in row.items() if value not in (None, '')} for row in csv.DictReader(file)]
+            self.rows.sort(key=lambda row: row['seconds'])
+        self.scenario = SCENARIOS[scenario or 'calm']
+
+    def at(self, seconds):
+        if self.rows is not None:
+            row = self.rows[0]
+            for candidate in self.rows: # Step to the latest row at or before seconds, wrapping around at the end
+                if candidate['seconds'] > seconds % (self.rows[-1]['seconds'] + 1):
+                    break
+                row = candidate
+            return dict(self.scenario, **row)
+        conditions = dict(self.scenario)
+        surge = max(0.0, math.sin(2 * math.pi * seconds / GUST_PERIOD)) ** 4
+        conditions['wspeed'] = self.scenario['wspeed'] + (self.scenario['gust'] - self.scenario['wspeed']) * surge
+        conditions['wdir'] = (self.scenario['wdir'] + self.scenario['wdir_spread'] * math.sin(seconds / 7)) % 360
+        return conditions
+
+class FakeBME280:
+    def __init__(self, sim):
+        self.sim = sim
+        self.frozen = None
+
+    def reading(self, key):
+        conditions = self.sim.conditions()
+        if conditions.get('stuck'):
+            if self.sim.elapsed() > self.sim.duration / 2:
+                raise OSError("[Errno 121] Remote I/O error") # Sensor dropped off the bus
+            self.frozen = self.frozen or dict(conditions)
+            return self.frozen[key]
+        return conditions[key] + random.gauss(0, 0.05)
+
+    def get_temperature(self, unit='C'):
+        return self.reading('temperature')
+
+    def get_pressure(self):
+        return self.reading('pressure')
+
+    def get_humidity(self):
+        return min(self.reading('humidity'), 100)
+
+class FakeMCP3008:
+    """Raw ADC values for the simulated vane direction with a little noise"""
+    def __init__(self, sim):
+        from wdir import VANE_RESISTANCES, VIN, R1, ADC_STEPS
+        self.sim = sim
+        self.codes = [round(VIN * r2 / (R1 + r2) / VIN * (ADC_STEPS - 1)) for r2 in VANE_RESISTANCES]
+
+    @property
+    def raw_value(self):
+        conditions = self.sim.conditions()
+        if conditions.get('stuck'):
+            return 1023 # Open circuit
+        position = round(conditions['wdir'] / 22.5) % len(self.codes)
+        return max(0, min(1023, self.codes[position] + random.randint(-2, 2)))
+
+class FakeSerial:
+    """SDS011 on a serial port, sends a measurement frame every second while awake"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.awake = True
+        self.pending = bytearray()
+        self.next_frame = monotonic()
+
+    @property
+    def in_waiting(self):
+        self._generate()
+        return len(self.pending)
+
+    def _generate(self):
+        while self.awake and monotonic() >= self.next_frame:
+            conditions = self.sim.conditions()
+            pm25, pm10 = round(conditions['pm25'] * 10), round(conditions['pm10'] * 10)
+            data = [pm25 & 0xFF, pm25 >> 8, pm10 & 0xFF, pm10 >> 8, 0x01, 0x02]
+            self.pending += bytes([0xAA, 0xC0] + data + [sum(data) & 0xFF, 0xAB])
+            self.next_frame += 1
+
+    def read(self, size=1):
+        deadline = monotonic() + 1 # Same as the reader's port timeout
+        while True:
+            self._generate()
+            if self.pending or monotonic() >= deadline:
+                break
+            sleep(0.05)
+        chunk = bytes(self.pending[:size])
+        del self.pending[:size]
+        return chunk
+
+    def write(self, frame):
+        if frame[2] == 0x06 and frame[3] == 1: # Set work or sleep mode
+            self.awake = frame[4] == 1
+            self.next_frame = monotonic()
+
+class Simulator:
+    def __init__(self, scenario=None, replay=None, duration=3600):
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+        Device.pin_factory = MockFactory() # Must be set before the monitors create their buttons in monitor()
+        self.factory = Device.pin_factory
+        self.weather = Weather(scenario, replay)
+        self.duration = duration
+        self.started = monotonic()
+        self.stop_event = Event()
+        self.lock = Lock()
+        self.pulses_sent = 0
+        self.tips_sent = 0
+        self.pulse_lag = 0.0 # Longest time pulses fell behind schedule
+
+    @classmethod
+    def from_config(cls, config):
+        simulate = config['simulate']
+        if isinstance(simulate, dict):
+            return cls(simulate.get('scenario'), simulate.get('replay'))
+        return cls(simulate)
+
+    def elapsed(self):
+        return monotonic() - self.started
+
+    def conditions(self):
+        return self.weather.at(self.elapsed())
+
+    def hardware(self):
+        """Replacement hardware for build_drivers, buttons are driven through the mock pins instead"""
+        return {
+            'bme280': {'sensor': FakeBME280(self)},
+            'wdir': {'adc': FakeMCP3008(self)},
+            'sds011': {'port': FakeSerial(self)}
+        }
+
+    def pulse(self, pin):
+        pin.drive_low() # Buttons are pulled up, so low is a switch closure
+        pin.drive_high()
+
+    def drive(self, pin_number, rate, counter):
+        """Pulse a pin at rate(conditions) per second, catching up if sleep overshoots"""
+        pin = self.factory.pin(pin_number)
+        next_pulse = monotonic()
+        while not self.stop_event.is_set():
+            per_second = rate(self.conditions())
+            if per_second <= 0:
+                self.stop_event.wait(0.5)
+                next_pulse = monotonic()
+                continue
+            now = monotonic()
+            if next_pulse > now:
+                sleep(next_pulse - now)
+            else:
+                self.pulse_lag = max(self.pulse_lag, now - next_pulse)
+            self.pulse(pin)
+            with self.lock:
+                setattr(self, counter, getattr(self, counter) + 1)
+            next_pulse += 1 / per_second
+
+    def start(self, wind=True, rain=True):
+        """Start pulsing the anemometer and rain gauge pins, a sensor worker process only drives its own"""
+        self.started = monotonic()
+        if wind:
+            Thread(target=self.drive, args=[WIND_PIN, lambda c: c['wspeed'] / MPH_PER_HZ, 'pulses_sent'], daemon=True, name="Thread-Sim_Wind").start()
+        if rain:
+            Thread(target=self.drive, args=[RAIN_PIN, lambda c: c['rain_rate'] / BUCKET / 3600, 'tips_sent'], daemon=True, name="Thread-Sim_Rain").start()
+
+    def stop(self):
+        self.stop_event.set()
+
+def max_rate(seconds):
+    """Drive the anemometer pin as fast as possible through the real WindMonitor"""
+    sim = Simulator()
+    from wspeed import WindMonitor
+    monitor = WindMonitor()
+    monitor.monitor_wind()
+    pin = sim.factory.pin(WIND_PIN)
+    sent, start = 0, monotonic()
+    while monotonic() - start < seconds:
+        sim.pulse(pin)
+        sent += 1
+    elapsed = monotonic() - start
+    print(f"Sent {sent} pulses in {round(elapsed, 2)} seconds, {round(sent / elapsed)} pulses per second ({round(sent / elapsed * MPH_PER_HZ)} mph equivalent)")
+    print(f"WindMonitor recorded {monitor.count} pulses, {sent - monitor.count} lost")
+
+def run(scenario, replay, duration, report_interval):
+    from drivers import build_drivers
+    sim = Simulator(scenario, replay, duration)
+    config = {
+        'report_interval': report_interval,
+        'sensors': {'bme280': True, 'wspeed': True, 'wdir': True, 'rain1h': True},
+        'sds011': {'enabled': True, 'interval': 10, 'warmup': 2, 'sleep': 0},
+        'wdir_sample_rate': 10,
+        'drivers': {'bme280': {'interval': 2, 'retry': 2}, 'wspeed': {'interval': 2}, 'wdir': {'interval': 2}, 'sds011': {'interval': 2}}
+    }
+    drivers = build_drivers(config, hardware=sim.hardware())
+    sim.start()
+    for driver in drivers.values():
+        driver.start()
+    reports = 0
+    while sim.elapsed() < duration:
+        sleep(min(report_interval, max(duration - sim.elapsed(), 0)))
+        reports += 1
+        expected = sim.conditions()
+        print(f"\nReport {reports} at {round(sim.elapsed())} seconds, {sim.pulses_sent} anemometer pulses and {sim.tips_sent} tips sent")
+        for name, driver in drivers.items():
+            reading = driver.report()
+            print(f"  {name}: {reading['values']}{' STALE' if reading['stale'] else ''} errors: {driver.errors}")
+        print(f"  commanded: wspeed {round(expected['wspeed'], 1)} gust {expected['gust']} wdir {round(expected['wdir'])} rain_rate {expected['rain_rate']}")
+    sim.stop()
+    wind = drivers['wspeed'].monitor
+    print(f"\nWindMonitor recorded {wind.count} of {sim.pulses_sent} pulses, worst pulse lag {round(sim.pulse_lag * 1000, 1)} ms")
+    print(f"Wind vane readings not recorded: {drivers['wdir'].monitor.failed_count}")
+    print(f"SDS011 errors: {drivers['sds011'].monitor.air_values}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the station's monitors against simulated hardware")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='storm')
+    parser.add_argument('--replay', help="CSV of recorded weather with a seconds column")
+    parser.add_argument('--duration', type=float, default=120, help="Seconds to run for")
+    parser.add_argument('--report-interval', type=float, default=30, help="Seconds between printed reports")
+    parser.add_argument('--max-rate', type=float, metavar='SECONDS', help="Measure the highest anemometer pulse rate instead")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.max_rate:
+        max_rate(args.max_rate)
+    else:
+        run(args.scenario, args.replay, args.duration, args.report_interval)
@@ -0,0 +1,82 @@
+"""Embedded SQLite engine for stations too small to run a MariaDB server, selected with
+db_engine : sqlite in wxstation.yaml. It keeps the same sensors and rollup tables, created by
+migrate.py, in one file using WAL mode so the history service and archiver can read while
+reports are written. dbcopy.py moves readings between it and MariaDB."""
+import logging, sqlite3
+from datetime import date, datetime
+from decimal import Decimal
+from db import WeatherDatabase, PooledConnection, ConnectionPool, AGGREGATE_WIDTHS, ROLLUPS, rollup_upsert
+
+# Rows keep created as local time text, the same format sensor_row writes, so it sorts and compares as text
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+sqlite3.register_adapter(datetime, lambda value: value.strftime(TIME_FORMAT))
+sqlite3.register_adapter(date, lambda value: value.strftime(TIME_FORMAT))
+sqlite3.register_adapter(Decimal, float) # DECIMAL values read from MariaDB by dbcopy.py
+sqlite3.register_converter('timestamp', lambda value: datetime.fromisoformat(value.decode()))
+
+NOW = "datetime('now', 'localtime')"
+RAIN_SINCE_MIDNIGHT = f"""SELECT ROUND(SUM(rainfall), 3) FROM sensors WHERE created BETWEEN date('now', 'localtime') AND {NOW};"""
+RAIN_PAST_HOURS = f"""SELECT ROUND(SUM(rainfall), 3) FROM sensors WHERE created >= datetime({NOW}, '-' || ? || ' hours');"""
+RAIN_ROLLUP_SINCE_MIDNIGHT = """SELECT ROUND(SUM(rainfall_sum), 3) FROM sensors_1d WHERE bucket = date('now', 'localtime') || ' 00:00:00';"""
+RAIN_ROLLUP_PAST_HOURS = f"""WITH w(start) AS (SELECT datetime({NOW}, '-' || ? || ' hours')),
+    e(start, boundary) AS (SELECT start, datetime(strftime('%Y-%m-%d %H:00:00', start), '+1 hour') FROM w)
+    SELECT ROUND(COALESCE((SELECT SUM(rainfall_sum) FROM sensors_1m, e WHERE bucket >= e.start AND bucket < e.boundary), 0)
+        + COALESCE((SELECT SUM(rainfall_sum) FROM sensors_1h, e WHERE bucket >= e.boundary), 0), 3);"""
+RAIN_HISTORY = f"""SELECT created, rainfall FROM sensors WHERE created >= datetime({NOW}, '-' || ? || ' hours') AND rainfall > 0;"""
+BUCKET_FORMATS = {'1m': '%Y-%m-%d %H:%M:00', '1h': '%Y-%m-%d %H:00:00', '1d': '%Y-%m-%d 00:00:00'}
+# SQLite is usually built without DELETE ... LIMIT
+SENSORS_DELETE_RANGE = "DELETE FROM sensors WHERE rowid IN (SELECT rowid FROM sensors WHERE created >= ? AND created < ? LIMIT ?);"
+# Aggregates lose the column type, the alias converts them back to datetime
+SENSORS_FIRST = 'SELECT MIN(created) AS "created [timestamp]" FROM sensors;'
+SENSORS_LAST = 'SELECT MAX(created) AS "created [timestamp]" FROM sensors;'
+SCHEMA_VERSION_EXISTS = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'schema_version';"
+
+class SqliteConnection(PooledConnection):
+    """SQLite connection kept open by ConnectionPool. SQLite compiles each statement once and keeps it
+    in the connection's statement cache, so a cursor per statement is all that's needed to reuse it."""
+    error = sqlite3.Error
+    data_errors = (sqlite3.DataError, sqlite3.IntegrityError)
+
+    def statement(self, sql):
+        if sql not in self.statements:
+            self.statements[sql] = self.conn.cursor()
+        return self.statements[sql]
+
+    def healthy(self):
+        return True # There is no server to lose the connection to
+
+    def reconnect(self):
+        pass
+
+class SqliteDatabase(WeatherDatabase):
+    engine = 'sqlite'
+    rain_since_midnight = RAIN_SINCE_MIDNIGHT
+    rain_past_hours = RAIN_PAST_HOURS
+    rain_rollup_since_midnight = RAIN_ROLLUP_SINCE_MIDNIGHT
+    rain_rollup_past_hours = RAIN_ROLLUP_PAST_HOURS
+    rain_history_query = RAIN_HISTORY
+    rollup_upserts = {table: rollup_upsert(table, sqlite=True) for table in ROLLUPS}
+    bucket_expressions = {width: f"strftime('{BUCKET_FORMATS[width]}', created)" for width in AGGREGATE_WIDTHS}
+    sensors_delete_range = SENSORS_DELETE_RANGE
+    sensors_first = SENSORS_FIRST
+    sensors_last = SENSORS_LAST
+    schema_version_exists = SCHEMA_VERSION_EXISTS
+
+    def __init__(self, path="weather.db", pool_size=2, busy_timeout=30):
+        self.path = path
+        self.busy_timeout = busy_timeout # Seconds a write waits for another connection's transaction to finish
+        self.version = None # Schema version, checked on first use
+        # Readers don't block the writer in WAL mode, so a few connections let the history service and archiver run alongside reports
+        self.pool = ConnectionPool(self.db_connect, pool_size, SqliteConnection)
+
+    def db_connect(self, retries=None):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False, cached_statements=256,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;") # Durable at every checkpoint, a power cut can only lose the last few commits
+        logging.debug(f"Opened SQLite database {self.path}")
+        return conn
+
+    def stream_cursor(self, conn):
+        # SQLite steps through the query as rows are fetched, so a plain cursor already streams
+        return conn.conn.cursor()
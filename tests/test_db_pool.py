@@ -0,0 +1,72 @@
+import os, sys, threading, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import ConnectionPool, PooledConnection
+
+class FakeError(Exception):
+    pass
+
+class FakeConnection(PooledConnection):
+    error = FakeError
+
+    def healthy(self):
+        return True
+
+    def close(self):
+        pass
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_waiter_opens_a_connection_after_a_discard(self):
+        pool = ConnectionPool(lambda: object(), size=1, pooled=FakeConnection, timeout=5)
+        holding, waiting = threading.Event(), threading.Event()
+        results = []
+
+        def fail():
+            try:
+                with pool.connection():
+                    holding.set()
+                    waiting.wait(5)
+                    raise FakeError("query failed")
+            except FakeError:
+                pass
+
+        def wait_for_connection():
+            holding.wait(5)
+            waiting.set()
+            with pool.connection() as pooled:
+                results.append(pooled)
+
+        threads = [threading.Thread(target=fail), threading.Thread(target=wait_for_connection)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "waiter never got a connection")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(pool.created, 1)
+
+    def test_wait_times_out_with_the_engine_error(self):
+        pool = ConnectionPool(lambda: object(), size=1, pooled=FakeConnection, timeout=0.1)
+        with pool.connection():
+            with self.assertRaises(FakeError):
+                with pool.connection():
+                    pass
+        with pool.connection(): # The held connection was returned
+            pass
+
+    def test_failed_connect_frees_its_slot(self):
+        attempts = []
+        def connect():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise FakeError("server down")
+            return object()
+        pool = ConnectionPool(connect, size=1, pooled=FakeConnection, timeout=1)
+        with self.assertRaises(FakeError):
+            with pool.connection():
+                pass
+        with pool.connection():
+            pass
+        self.assertEqual(pool.created, 1)
+
+if __name__ == "__main__":
+    unittest.main()
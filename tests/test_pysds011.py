@@ -0,0 +1,66 @@
+import os, sys, time, unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import pysds011
+except ImportError: # pyserial isn't installed
+    pysds011 = None
+
+def frame(pm25, pm10):
+    data = [pm25 & 0xFF, pm25 >> 8, pm10 & 0xFF, pm10 >> 8, 0x01, 0x02]
+    return bytes([0xAA, 0xC0] + data + [sum(data) & 0xFF, 0xAB])
+
+class FlakyPort:
+    """Serial port that raises on its first failures reads, then returns a measurement frame per read"""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.closed = False
+        self.in_waiting = 10
+
+    def read(self, size=1):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("device reports readiness to read but returned no data")
+        time.sleep(0.01)
+        return frame(123, 456)
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        self.closed = True
+
+@unittest.skipIf(pysds011 is None, "pyserial is not installed")
+class MonitorAirQualityTest(unittest.TestCase):
+    def wait_for_window(self, monitor, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            window = monitor.window()
+            if window is not None and window['pm25']['count']:
+                return window
+            time.sleep(0.02)
+        self.fail("no air quality window completed")
+
+    def test_read_error_doesnt_end_the_monitor(self):
+        monitor = pysds011.MonitorAirQuality(port=FlakyPort(failures=2), interval=0.2, warmup=0, retry=0.01)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        window = self.wait_for_window(monitor)
+        self.assertEqual(window['pm25']['mean'], 12.3)
+        self.assertEqual(monitor.air_values['port_errors'], 2)
+        self.assertTrue(monitor.thread.is_alive())
+
+    def test_port_is_reopened_after_an_error(self):
+        ports = [FlakyPort(failures=1), FlakyPort()]
+        with mock.patch.object(pysds011, 'Serial', side_effect=lambda *args, **kwargs: ports.pop(0)):
+            first = ports[0]
+            monitor = pysds011.MonitorAirQuality(tty="/dev/null", interval=0.2, warmup=0, retry=0.01)
+            monitor.start()
+            self.addCleanup(monitor.stop)
+            self.wait_for_window(monitor)
+        self.assertTrue(first.closed)
+        self.assertEqual(ports, [])
+        self.assertEqual(monitor.air_values['port_errors'], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qc import QualityControl, RANGE, RATE, REPAIRED
+
+class ChannelFilterTest(unittest.TestCase):
+    def pressure(self):
+        return QualityControl().filters['pressure']
+
+    def test_out_of_range_first_reading_is_only_flagged(self):
+        qc = self.pressure()
+        self.assertEqual(qc.check(0, 0), (0, RANGE))
+        for i, value in enumerate((1013, 1013.1, 1013.2), 1):
+            self.assertEqual(qc.check(value, i * 60), (value, 0))
+
+    def test_repaired_readings_are_not_remembered(self):
+        qc = self.pressure()
+        qc.check(1013, 0)
+        self.assertEqual(qc.check(1030, 60), (1013, RATE | REPAIRED))
+        self.assertEqual(qc.last_time, 0)
+        self.assertEqual(qc.check(1013.1, 120), (1013.1, 0))
+
+class QualityControlTest(unittest.TestCase):
+    def test_hampel_window_covers_the_same_time_at_any_report_interval(self):
+        self.assertEqual(QualityControl(report_interval=300).filters['temperature'].window.maxlen, 7)
+        self.assertEqual(QualityControl(report_interval=60).filters['temperature'].window.maxlen, 35)
+        self.assertEqual(QualityControl(report_interval=3600).filters['temperature'].window.maxlen, 5)
+        limits = {'temperature': {'window': 9}}
+        self.assertEqual(QualityControl(limits, report_interval=60).filters['temperature'].window.maxlen, 9)
+
+if __name__ == "__main__":
+    unittest.main()
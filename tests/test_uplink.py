@@ -0,0 +1,130 @@
+import os, socket, sys, threading, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from uplink import AprsSession, AprsUplink, APRS_ERRORS
+except ImportError: # aprslib isn't installed
+    AprsSession = None
+
+class FakeAprsServer:
+    """Local APRS-IS server: sends a banner, answers logins and records every line it receives"""
+    def __init__(self):
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.lines = []
+        self.clients = []
+        self.received = threading.Condition()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=[client], daemon=True).start()
+
+    def serve(self, client):
+        client.sendall(b"# fake aprsc 2.1\r\n")
+        with client, client.makefile('rb') as lines:
+            try:
+                for line in lines:
+                    line = line.decode('latin-1').rstrip()
+                    if line.startswith('user '):
+                        client.sendall(f"# logresp {line.split()[1]} verified, server FAKE\r\n".encode())
+                    with self.received:
+                        self.lines.append(line)
+                        self.received.notify_all()
+            except OSError:
+                pass
+
+    def wait_for(self, text, timeout=5):
+        with self.received:
+            return self.received.wait_for(lambda: any(text in line for line in self.lines), timeout)
+
+    def drop_clients(self):
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # Already closed by the station
+        self.clients.clear()
+
+    def close(self):
+        self.drop_clients()
+        self.listener.close()
+
+@unittest.skipIf(AprsSession is None, "aprslib is not installed")
+class AprsSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAprsServer()
+        self.addCleanup(self.server.close)
+        self.session = AprsSession('fake', '127.0.0.1', self.server.port, 'N0CALL', 12345, timeout=5)
+        self.addCleanup(self.session.disconnect)
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_logs_in_and_sends(self):
+        self.session.send("N0CALL>APRS:_test")
+        self.assertTrue(self.server.wait_for("N0CALL>APRS:_test"))
+        self.assertTrue(self.server.lines[0].startswith("user N0CALL pass 12345"))
+        self.assertTrue(self.session.connected())
+        self.assertEqual(self.session.stats['connects'], 1)
+        self.assertEqual(self.session.stats['sent'], 1)
+
+    def test_dropped_connection_backs_off_then_reconnects(self):
+        self.session.send("N0CALL>APRS:_first")
+        self.assertTrue(self.server.wait_for("_first"))
+        self.server.drop_clients()
+        self.assertTrue(self.wait_until(lambda: self.session.ais.sock.recv(1, socket.MSG_PEEK) == b''))
+        with self.assertRaises(ConnectionError):
+            self.session.send("N0CALL>APRS:_lost") # The drop is noticed before writing
+        self.assertFalse(self.session.connected())
+        self.assertEqual(self.session.backoff, 2)
+        with self.assertRaisesRegex(ConnectionError, "reconnecting in"):
+            self.session.send("N0CALL>APRS:_too_soon")
+        self.session.next_attempt = 0 # Skip the wait
+        self.session.send("N0CALL>APRS:_again")
+        self.assertTrue(self.server.wait_for("_again"))
+        self.assertEqual(self.session.stats['connects'], 2)
+        self.assertEqual(self.session.stats['failures'], 2)
+        self.assertEqual(self.session.backoff, 1)
+        self.assertFalse(any("_lost" in line or "_too_soon" in line for line in self.server.lines))
+
+    def test_backoff_doubles_up_to_the_limit_while_the_server_is_down(self):
+        self.server.close()
+        self.session.max_backoff = 4
+        backoffs = []
+        for _ in range(4):
+            self.session.next_attempt = 0
+            with self.assertRaises(APRS_ERRORS):
+                self.session.send("N0CALL>APRS:_down")
+            backoffs.append(self.session.backoff)
+        self.assertEqual(backoffs, [2, 4, 4, 4])
+        self.assertGreater(self.session.next_attempt, time.time())
+
+@unittest.skipIf(AprsSession is None, "aprslib is not installed")
+class AprsUplinkTest(unittest.TestCase):
+    def test_background_thread_reconnects_after_a_drop(self):
+        server = FakeAprsServer()
+        self.addCleanup(server.close)
+        uplink = AprsUplink('N0CALL', 12345, {'fake': f"127.0.0.1:{server.port}"}, timeout=5)
+        self.addCleanup(uplink.stop)
+        session = uplink.sessions['fake']
+        uplink.start()
+        self.assertTrue(server.wait_for("user N0CALL"))
+        server.drop_clients()
+        self.assertEqual(uplink.send("N0CALL>APRS:_lost"), {'fake': None})
+        deadline = time.monotonic() + 10
+        while session.stats['connects'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(session.stats['connects'], 2, "session never reconnected")
+        self.assertIsNotNone(uplink.send("N0CALL>APRS:_after")['fake'])
+        self.assertTrue(server.wait_for("_after"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from writebehind import WriteBehindQueue
+
+class Outage(Exception):
+    pass
+
+class FakeDatabase:
+    """insert_many fails the whole batch on a row without a temperature, or on every call while down"""
+    def __init__(self):
+        self.rows = []
+        self.down = False
+
+    def insert_many(self, rows):
+        if self.down:
+            raise Outage("server has gone away")
+        if any(row['temperature'] is None for row in rows):
+            raise ValueError("temperature cannot be NULL")
+        self.rows += rows
+
+    def bad_data(self, error):
+        return isinstance(error, ValueError)
+
+class WriteBehindQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db = FakeDatabase()
+        self.writer = WriteBehindQueue(self.db, spool_path=os.path.join(directory.name, "spool.db"), retry_interval=0)
+        self.addCleanup(self.writer.spool.conn.close)
+
+    def rows(self, *temperatures):
+        return [{'id': i, 'temperature': t} for i, t in enumerate(temperatures)]
+
+    def test_bad_row_is_rejected_and_the_rest_written(self):
+        self.writer._write(self.rows(70, None, 71))
+        self.assertEqual([row['id'] for row in self.db.rows], [0, 2])
+        self.assertEqual(self.writer.spool.rejected(), 1)
+        self.assertEqual(self.writer.spool.pending(), 0)
+
+    def test_bad_spooled_row_doesnt_block_replay(self):
+        self.db.down = True
+        self.writer._write(self.rows(70, None))
+        self.writer._write(self.rows(72))
+        self.assertEqual(self.writer.spool.pending(), 3)
+        self.db.down = False
+        self.writer._replay()
+        self.assertEqual([row['temperature'] for row in self.db.rows], [70, 72])
+        self.assertEqual(self.writer.spool.pending(), 0)
+        self.assertEqual(self.writer.spool.rejected(), 1)
+
+    def test_outage_while_isolating_spools_only_unwritten_rows(self):
+        db, writes = self.db, []
+        def insert_many(rows):
+            writes.append(rows)
+            if len(writes) == 3: # The batch, the first row alone, then the server goes away
+                raise Outage("server has gone away")
+            FakeDatabase.insert_many(db, rows)
+        db.insert_many = insert_many
+        self.writer._write(self.rows(70, None, 71))
+        self.assertEqual([row['id'] for row in db.rows], [0])
+        self.assertEqual([row['id'] for row in self.writer.spool.peek(10)[1]], [1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
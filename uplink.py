@@ -0,0 +1,164 @@
+import aprslib, logging, metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Thread, Event, Lock
+from time import time, monotonic
+
+# aprslib raises its own ConnectionError and LoginError, socket failures are OSErrors
+APRS_ERRORS = (aprslib.exceptions.GenericError, OSError)
+
+class AprsSession:
+    """Logged in APRS-IS connection to one server.
+    A background thread reconnects with backoff, drains server traffic and sends keepalives."""
+    def __init__(self, name, host, port, callsign, passwd, timeout=10, keepalive=60, max_backoff=300):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.callsign = callsign
+        self.passwd = passwd
+        self.timeout = timeout # Seconds a send may take before it counts as failed
+        self.keepalive = keepalive # Seconds between keepalive comments on an idle connection
+        self.max_backoff = max_backoff
+        self.backoff = 1
+        self.next_attempt = 0
+        self.ais = None
+        self.lock = Lock() # Only one of connect, send or keepalive uses the socket at a time
+        self.last_activity = 0
+        self.stats = {'sent': 0, 'failures': 0, 'connects': 0, 'last_latency': None, 'total_latency': 0.0}
+
+    def connected(self):
+        return self.ais is not None and self.ais._connected
+
+    def connect(self):
+        ais = aprslib.IS(self.callsign, str(self.passwd), self.host, self.port)
+        ais.connect(blocking=False) # Raises on failure, retries are handled by run()
+        self.ais = ais
+        self.last_activity = monotonic()
+        self.backoff = 1
+        self.stats['connects'] += 1
+        logging.info(f"Logged in to APRS-IS server {self.name} ({self.host}:{self.port})")
+
+    def disconnect(self):
+        if self.ais is not None:
+            self.ais.close()
+            self.ais = None
+
+    def _failed(self, e):
+        self.stats['failures'] += 1
+        self.disconnect()
+        self.next_attempt = time() + self.backoff
+        logging.error(f"APRS-IS server {self.name} failed: {e}\n\tReconnecting in {self.backoff} seconds")
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def _drain(self):
+        # Servers send a feed and keepalive comments, read them so the socket buffer never fills up
+        sock = self.ais.sock
+        sock.setblocking(0)
+        try:
+            while True:
+                received = sock.recv(4096)
+                if not received:
+                    raise ConnectionError("connection closed by server")
+        except BlockingIOError:
+            pass
+        finally:
+            sock.setblocking(1)
+
+    def send(self, packet):
+        start = monotonic()
+        if not self.lock.acquire(timeout=self.timeout):
+            self.stats['failures'] += 1
+            raise TimeoutError(f"APRS-IS server {self.name} is still busy with a previous send")
+        if not self.connected() and time() < self.next_attempt:
+            self.lock.release()
+            self.stats['failures'] += 1
+            raise ConnectionError(f"not connected, reconnecting in {round(self.next_attempt - time())} seconds")
+        try:
+            if not self.connected():
+                self.connect()
+            self._drain()
+            self.ais.sendall(packet)
+            self.last_activity = monotonic()
+        except APRS_ERRORS as e:
+            self._failed(e)
+            raise
+        finally:
+            self.lock.release()
+        latency = monotonic() - start
+        metrics.observe('wx_aprs_send_seconds', latency, server=self.name)
+        self.stats['sent'] += 1
+        self.stats['last_latency'] = latency
+        self.stats['total_latency'] += latency
+        return latency
+
+    def run(self, stop_event):
+        while not stop_event.wait(1):
+            if not self.lock.acquire(blocking=False):
+                continue # A send is using the connection
+            try:
+                if not self.connected():
+                    if time() >= self.next_attempt:
+                        self.connect()
+                elif monotonic() - self.last_activity >= self.keepalive:
+                    self._drain()
+                    self.ais.sendall(f"#keepalive {self.callsign}")
+                    self.last_activity = monotonic()
+            except APRS_ERRORS as e:
+                self._failed(e)
+            finally:
+                self.lock.release()
+        self.disconnect()
+
+class AprsUplink:
+    """Keeps a session open to every configured APRS-IS server and sends packets to all of them at once"""
+    def __init__(self, callsign, passwd, servers, port=14580, timeout=10, keepalive=60):
+        self.timeout = timeout
+        self.sessions = {}
+        for name, server in servers.items():
+            host, _, server_port = str(server).partition(':') # Servers may be host or host:port
+            self.sessions[name] = AprsSession(name, host, int(server_port or port), callsign, passwd, timeout, keepalive)
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.sessions), 1), thread_name_prefix="Thread-APRS_Send")
+        self.stop_event = Event()
+        self.threads = []
+
+    @classmethod
+    def from_config(cls, aprs_config):
+        return cls(aprs_config['callsign'], aprs_config['passwd'], aprs_config['servers'], aprs_config['port'],
+            aprs_config.get('timeout', 10), aprs_config.get('keepalive', 60))
+
+    def start(self):
+        for name, session in self.sessions.items():
+            thread = Thread(target=session.run, args=[self.stop_event], daemon=True, name=f"Thread-APRS_{name}")
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(self.timeout)
+        self.executor.shutdown(wait=False)
+
+    def send(self, packet):
+        """Send packet to every server, returns {server: latency in seconds or None if it failed}"""
+        futures = {self.executor.submit(session.send, packet): name for name, session in self.sessions.items()}
+        done, not_done = wait(futures, timeout=self.timeout)
+        results = {}
+        for future, name in futures.items():
+            if future in not_done:
+                self.sessions[name].stats['failures'] += 1
+                logging.error(f"Sending packet to APRS-IS server {name} took longer than {self.timeout} seconds")
+                results[name] = None
+            elif future.exception() is not None:
+                logging.error(f"An exception occured trying to send packet to {name}\nException: {future.exception()}")
+                results[name] = None
+            else:
+                results[name] = future.result()
+                logging.info(f"Packet transmitted to {name} in {round(results[name] * 1000)} ms")
+        return results
+
+    def stats(self):
+        stats = {}
+        for name, session in self.sessions.items():
+            sent = session.stats['sent']
+            stats[name] = dict(session.stats, connected=session.connected(),
+                average_latency=session.stats['total_latency'] / sent if sent else None)
+        return stats
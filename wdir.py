@@ -1,5 +1,6 @@
-from gpiozero import MCP3008
-from time import sleep
+from bisect import bisect_left
+from threading import Event, Lock
+from time import monotonic
 import math, logging
 
 VIN = 3.3 # Input voltage can be 5.0 or 3.3
@@ -22,59 +23,91 @@ VANE_RESISTANCES = [ # Resistor values inside wind vain
 42_120,
 64_900,
 21_880]
+ADC_STEPS = 1024 # MCP3008 is a 10 bit ADC
+SAMPLE_RATE = 1 # Vane readings per second
 
 class WindDirectionMonitor:
-    def __init__(self, resistances=VANE_RESISTANCES, vin=VIN, R1=R1, adc_channel=ADC_CHANNEL):
-        self.wind_angles = [] # List to store wind direction in degrees every 5 seconds, cleared after every transmission
+    def __init__(self, resistances=VANE_RESISTANCES, vin=VIN, R1=R1, adc_channel=ADC_CHANNEL, sample_rate=SAMPLE_RATE, adc=None, journal=None):
         self.R1 = R1 # Static resistor value on board
         self.resistances = resistances
         self.failed_count = 0 #TODO log failed count and voltage from failure in database
+        self.reported_failures = 0 # failed_count at the last report
         self.vin = vin
         self.adc_channel = adc_channel
+        self.sample_rate = sample_rate
+        self.adc = adc # MCP3008 created by monitor() unless one is given, e.g. by the simulator
+        self.journal = journal # Journal every reading is also written to, see journal.py
+        self.lookup = self.populate_lookup()
+        # Running sums of the unit vectors of every reading since the last report
+        self.sin_sum, self.cos_sum, self.samples = 0.0, 0.0, 0
+        self.lock = Lock()
+        self.stop_event = Event()
 
     def voltage_divider(self, r1, r2, vin):
         vout = (vin * r2) / (r1 + r2)
-        return round(vout, 1)
+        return vout
 
-    def populate_V2D(self):
-        degrees, volts = 0, {}
-        for r2 in self.resistances:
-            voltage = self.voltage_divider(self.R1, r2, self.vin)
-            volts[voltage] = degrees
-            degrees += 22.5 # Degrees between each resistor/reed switch in wind vane
-        return volts
+    def populate_lookup(self):
+        """Map every raw ADC value to the (degrees, sin, cos) of the nearest vane position,
+        or None if it is too far from any position to be a valid reading"""
+        vanes = sorted((self.voltage_divider(self.R1, r2, self.vin), i * 22.5) for i, r2 in enumerate(self.resistances)) # 22.5 degrees between each resistor/reed switch
+        volts = [v for v, _ in vanes]
+        lookup = []
+        for code in range(ADC_STEPS):
+            voltage = code * self.vin / (ADC_STEPS - 1)
+            i = bisect_left(volts, voltage)
+            if i == 0:
+                nearest, tolerance = 0, (volts[1] - volts[0]) / 2
+            elif i == len(volts):
+                nearest, tolerance = i - 1, (volts[-1] - volts[-2]) / 2
+            else:
+                # Between two positions the nearest one is always within tolerance
+                nearest = i - 1 if voltage - volts[i - 1] < volts[i] - voltage else i
+                tolerance = None
+            if tolerance is not None and abs(voltage - volts[nearest]) > tolerance:
+                lookup.append(None) # Open circuit or short, beyond the lowest or highest vane voltage
+                continue
+            r = math.radians(vanes[nearest][1])
+            lookup.append((vanes[nearest][1], math.sin(r), math.cos(r)))
+        return lookup
 
-    def average(self):
-        self.wind_angles
-        avg = 0.0
-        sin_sum, cos_sum = 0.0, 0.0
-        try:
-            for angle in self.wind_angles:
-                r = math.radians(angle)
-                sin_sum += math.sin(r)
-                cos_sum += math.cos(r)
-            
-            flen = float(len(self.wind_angles))
-            s, c = sin_sum / flen, cos_sum / flen
-            arc = math.degrees(math.atan(s / c))
+    def record(self, code):
+        entry = self.lookup[code]
+        if entry is None:
+            self.failed_count += 1
+            logging.debug(f"Unkown wind direction voltage: {round(code * self.vin / (ADC_STEPS - 1), 2)}")
+            return
+        with self.lock:
+            self.sin_sum += entry[1]
+            self.cos_sum += entry[2]
+            self.samples += 1
+        if self.journal is not None:
+            self.journal.append('wdir', entry[0])
 
-            if s > 0 and c > 0:
-                avg = arc
-            elif c < 0:
-                avg = arc + 180
-            elif s < 0 and c > 0:
-                avg = arc + 360
-            return 0.0 if avg == 360 else round(avg)
-        except ZeroDivisionError as e:
-            logging.exception(f"ZeroDivisionError: {e}\nWind direction could not be calculated!")
+    def average(self, reset=True):
+        """Circular mean of readings since the last report in degrees, None if there were none"""
+        with self.lock:
+            s, c, samples = self.sin_sum, self.cos_sum, self.samples
+            if reset:
+                self.sin_sum, self.cos_sum, self.samples = 0.0, 0.0, 0
+        failures = self.failed_count - self.reported_failures
+        if failures:
+            logging.error(f"{failures} wind direction readings were not recorded\n\tTotal readings not recorded: {self.failed_count}")
+            self.reported_failures = self.failed_count
+        if samples == 0:
+            logging.error("No wind direction readings to average, wind direction could not be calculated!")
+            return None
+        return round(math.degrees(math.atan2(s, c))) % 360
 
     def monitor(self):
-        adc, volts = MCP3008(channel=self.adc_channel), self.populate_V2D()
-        while True:
-            vane_voltage = round(adc.value * self.vin, 1)
-            if vane_voltage in volts:
-                self.wind_angles.append(volts[vane_voltage])
-            else:
-                self.failed_count += 1
-                logging.error(f"Unkown wind direction voltage: {vane_voltage}\n\tReading was not recorded\n\tTotal readings not recorded: {self.failed_count}")
-            sleep(5)
+        if self.adc is None:
+            from gpiozero import MCP3008
+            self.adc = MCP3008(channel=self.adc_channel)
+        next_sample = monotonic()
+        while not self.stop_event.is_set():
+            self.record(self.adc.raw_value)
+            next_sample += 1 / self.sample_rate # Fixed schedule so the rate doesn't drift with read time, sample_rate can change while running
+            self.stop_event.wait(max(next_sample - monotonic(), 0))
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,167 @@
+import json, logging, sqlite3
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Lock
+from time import time
+
+class SensorSpool:
+    """Append-only SQLite spool holding sensors rows that could not be written to MariaDB,
+    and the rows the database rejected as bad data so they don't block the rest"""
+    def __init__(self, path="sensors_spool.db"):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS spool(id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL);")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rejected(id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, error TEXT, rejected REAL);")
+        self.conn.commit()
+
+    def append(self, rows):
+        with self.lock:
+            self.conn.executemany("INSERT INTO spool(row) VALUES(?);", [(json.dumps(row),) for row in rows])
+            self.conn.commit()
+        logging.warning(f"Spooled {len(rows)} sensors rows to {self.path}")
+
+    def reject(self, row, error):
+        with self.lock:
+            self.conn.execute("INSERT INTO rejected(row, error, rejected) VALUES(?, ?, ?);", (json.dumps(row), str(error), time()))
+            self.conn.commit()
+        logging.error(f"Database rejected sensors row {row}: {error}\n\tKept in the rejected table of {self.path}")
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM spool;").fetchone()[0]
+
+    def rejected(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM rejected;").fetchone()[0]
+
+    def peek(self, limit):
+        """Returns the ids and the oldest rows in the spool"""
+        with self.lock:
+            spooled = self.conn.execute("SELECT id, row FROM spool ORDER BY id LIMIT ?;", (limit,)).fetchall()
+        return [id for id, _ in spooled], [json.loads(row) for _, row in spooled]
+
+    def remove(self, last_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM spool WHERE id <= ?;", (last_id,))
+            self.conn.commit()
+
+class WriteBehindQueue:
+    """Queues sensors rows in memory and writes them to the database from a background thread in batches.
+    Rows are spooled to disk while the database is unreachable and replayed once it is back."""
+    def __init__(self, db, spool_path="sensors_spool.db", maxsize=1000, batch_size=50, flush_interval=5, retry_interval=30, max_retry_interval=600):
+        self.db = db
+        self.queue = Queue(maxsize)
+        self.spool = SensorSpool(spool_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # Seconds to wait for more rows before writing a batch
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.backoff = retry_interval
+        self.next_attempt = 0 # Don't try the database before this time after a failure
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, daemon=True, name="Thread-DB_Writer")
+
+    def start(self):
+        pending = self.spool.pending()
+        if pending:
+            logging.info(f"{pending} spooled sensors rows will be replayed when the database is reachable")
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.thread.join(timeout)
+
+    def put(self, data, created=None):
+        """Queue a report's data for saving, never blocks on the database"""
+        row = self.db.sensor_row(data, created) # Timestamp now so replayed rows keep their original time
+        try:
+            self.queue.put_nowait(row)
+        except Full:
+            logging.error(f"Database write queue is full ({self.queue.maxsize} rows), spooling row to disk")
+            self.spool.append([row])
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _drain(self):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _failed(self, e):
+        self.next_attempt = time() + self.backoff
+        logging.error(f"Unable to write to the database: {e}\n\tRetrying in {self.backoff} seconds")
+        self.backoff = min(self.backoff * 2, self.max_retry_interval)
+
+    def _insert(self, rows):
+        """Write rows, setting aside any the database rejects as bad data.
+        Returns None, or the error that stopped the writes and the rows that weren't written."""
+        try:
+            self.db.insert_many(rows)
+            return None
+        except Exception as e:
+            if not self.db.bad_data(e):
+                return e, rows
+            if len(rows) == 1:
+                self.spool.reject(rows[0], e)
+                return None
+        for i, row in enumerate(rows): # One at a time to find the bad rows
+            failed = self._insert([row])
+            if failed:
+                return failed[0], rows[i:]
+        return None
+
+    def _write(self, rows):
+        if time() < self.next_attempt:
+            self.spool.append(rows)
+            return
+        failed = self._insert(rows)
+        if failed:
+            error, unwritten = failed
+            self._failed(error)
+            self.spool.append(unwritten)
+            return
+        self.backoff = self.retry_interval
+        logging.debug(f"Wrote {len(rows)} sensors rows to the database")
+
+    def _replay(self):
+        while time() >= self.next_attempt and not self.stop_event.is_set():
+            ids, rows = self.spool.peek(self.batch_size)
+            if not rows:
+                return
+            failed = self._insert(rows)
+            written = len(rows) - len(failed[1]) if failed else len(rows)
+            if written:
+                self.spool.remove(ids[written - 1])
+            if failed:
+                self._failed(failed[0])
+                return
+            self.backoff = self.retry_interval
+            logging.info(f"Replayed {len(rows)} spooled sensors rows")
+
+    def run(self):
+        while not self.stop_event.is_set():
+            batch = self._drain()
+            if batch:
+                self._write(batch)
+            if time() >= self.next_attempt:
+                self._replay()
+        # Don't lose queued rows on shutdown
+        remaining = self._drain_nowait()
+        if remaining:
+            self.spool.append(remaining)
+
+    def _drain_nowait(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except Empty:
+                return rows
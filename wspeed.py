@@ -1,48 +1,102 @@
-from gpiozero import Button
+from array import array
+from bisect import bisect_left
 from math import pi
-from time import sleep
-from threading import Lock
+from time import monotonic
 
-DEFAULT_WIND_SENSOR = Button(6) # Button(6)
+WIND_PIN = 6 # GPIO pin of the anemometer's reed switch
+RADIUS_CM = 9.0
+CM_IN_MILE = 160934.4
+CIRCUMFERENCE_MILES = ((2 * pi) * RADIUS_CM) / CM_IN_MILE
+PULSES_PER_ROTATION = 2 # Reed switch closes twice per rotation
+BUFFER_SIZE = 131072 # Pulse timestamps kept, about 10 minutes of pulses at 150 mph
+GUST_SECONDS = 3 # WMO gusts are the highest 3 second average
 
 class WindMonitor:
 
-    def __init__(self, button=DEFAULT_WIND_SENSOR):
-        self.wind_count = 0
-        self.wind_list = []
-        self.button = button
-        self.wind_count_lock = Lock()
-        self.wind_list_lock = Lock()
+    def __init__(self, button=None, size=BUFFER_SIZE):
+        self.button = button # Button on WIND_PIN is created by monitor_wind() unless one is given
+        self.size = size
+        self.pulses = array('d', bytes(8 * size)) # Ring buffer of pulse times from monotonic()
+        self.count = 0 # Total pulses recorded, the newest is at (count - 1) % size
+        self.started = monotonic()
         self.ADJUSTMENT = 1.18 # compensate for anemometer factor
 
-    def calculate_speed(self, stop_event):
-        delay = 5 # 5 seconds
-        extra_delay = 0 # If a stop event occurs, add to time needed to calculate wind speed
-        while True:
-            with self.wind_count_lock and self.wind_list_lock:
-                if self.wind_count > 0:
-                    delay += extra_delay
-                    if extra_delay > 0:
-                        extra_delay = 0
-                    radius_cm = 9.0
-                    cm_in_mile = 160934.4
-                    circumference_cm = (2 * pi) * radius_cm
-                    rotations = self.wind_count / 2.0
-                    dist_miles = (circumference_cm * rotations) / cm_in_mile
-                    miles_per_sec = dist_miles / delay # Divide distance by time
-                    miles_per_hour = (miles_per_sec * 3600) * self.ADJUSTMENT # miles per second times seconds in an hour
-                    self.wind_list.append(miles_per_hour) #; print(f"Wind speed of {miles_per_hour} recorded")
-                    self.wind_count = 0 ; print("wind_count has been reset!") # Reset wind count
-                    extra_delay = 0 # Reset extra delay
-                sleep(delay)
-            if stop_event.wait(5):
-                extra_delay += 5
-                continue
-
     def spin(self):
-        with self.wind_count_lock:
-            self.wind_count += 1
-            print(f"Wind count is now {self.wind_count}")
+        # Runs on gpiozero's callback thread for every closure, so it only stores the time.
+        # It is the only writer, readers copy the buffer instead of locking it.
+        self.pulses[self.count % self.size] = monotonic()
+        self.count += 1
 
     def monitor_wind(self):
-        self.button.when_pressed = self.spin
\ No newline at end of file
+        if self.button is None:
+            from gpiozero import Button # Imported here so importing this module never touches the GPIO pins
+            self.button = Button(WIND_PIN)
+        self.button.when_pressed = self.spin
+
+    def close(self):
+        if self.button is not None:
+            self.button.when_pressed = None
+            self.button.close()
+
+    def speed(self, pulses, seconds):
+        """Convert a pulse count over seconds to miles per hour"""
+        if seconds <= 0:
+            return 0.0
+        rotations = pulses / PULSES_PER_ROTATION
+        miles_per_sec = (CIRCUMFERENCE_MILES * rotations) / seconds # Divide distance by time
+        return (miles_per_sec * 3600) * self.ADJUSTMENT # miles per second times seconds in an hour
+
+    def first_since(self, cutoff, count):
+        """Number of the first pulse at or after cutoff, numbered like count, found without copying the ring"""
+        size, pulses = self.size, self.pulses
+        if count <= size:
+            return bisect_left(pulses, cutoff, 0, count)
+        # Each half of the ring is in order, the oldest pulses run from newest to the end and the rest wrap around to the start
+        newest = count % size
+        if newest and pulses[0] < cutoff:
+            return count - newest + bisect_left(pulses, cutoff, 0, newest)
+        return count - size + bisect_left(pulses, cutoff, newest, size) - newest
+
+    def timestamps(self, seconds, now=None):
+        """Pulse times from the past seconds in the order they happened, only those are copied"""
+        now = monotonic() if now is None else now
+        count = self.count
+        first = self.first_since(now - seconds, count)
+        if first == count:
+            return self.pulses[:0]
+        start, stop = first % self.size, count % self.size
+        if start < stop:
+            return self.pulses[start:stop]
+        return self.pulses[start:] + self.pulses[:stop] # Unwrap the ring, oldest first
+
+    def pulses_since(self, count):
+        """Pulse times recorded after the first count pulses, oldest first, and the count to pass next time.
+        Pulses overwritten before they were read are skipped."""
+        newest = self.count
+        start = max(count, newest - self.size)
+        return [self.pulses[i % self.size] for i in range(start, newest)], newest
+
+    def average(self, seconds, now=None):
+        now = monotonic() if now is None else now
+        seconds = min(seconds, now - self.started) # Don't under report right after starting
+        count = self.count
+        return self.speed(count - self.first_since(now - seconds, count), seconds)
+
+    def gust(self, seconds, now=None, window=GUST_SECONDS):
+        """Highest average speed over any window seconds long in the past seconds"""
+        times = self.timestamps(seconds, now)
+        most, start = 0, 0
+        for end, t in enumerate(times): # Slide the window along the pulses, each pulse enters and leaves once
+            while t - times[start] >= window:
+                start += 1
+            most = max(most, end - start + 1)
+        return self.speed(most, window)
+
+    def wind(self, report_seconds, now=None):
+        """Speeds for a report, gust is the highest 3 second gust since the last report"""
+        now = monotonic() if now is None else now
+        return {
+            'speed_2m': self.average(120, now),
+            'speed_10m': self.average(600, now),
+            'gust': self.gust(report_seconds, now)
+        }